@@ -0,0 +1,219 @@
+import argparse
+import json
+import multiprocessing
+import os
+from collections import deque
+
+from game import GameSession, GameStates
+
+
+# Stat tables played by default, overriding the constants of GameSession
+# and GameMap by name
+DEFAULT_SWEEP = [
+    {"name": "base", "stats": {}},
+    {"name": "weak_player", "stats": {"PLAYER_STATS": (24, 2, 5)}},
+    {"name": "strong_small", "stats": {"SMALL_MONSTER_STATS": (10, 0, 4)}},
+    {"name": "strong_big", "stats": {"BIG_MONSTER_STATS": (20, 1, 5)}},
+    {"name": "heal_10", "stats": {"ITEM_HEALING": 10}},
+    {"name": "slow_decay", "stats": {"FOV_DECAY_MOVES": 16}},
+    {"name": "field_ai", "stats": {"FIELD_AI": True}},
+]
+
+MAX_TURNS = 2000
+
+NEIGHBOURS = [(0, -1), (0, 1), (-1, 0), (1, 0),
+              (-1, -1), (1, -1), (-1, 1), (1, 1)]
+
+
+def choose_action(session):
+    """ Scripted player: walk to the closest monster in view, item in
+        view when hurt or unexplored cell, and pick up the items when hurt.
+        Walking into a monster attacks it """
+
+    player = session.player
+    game_map = session.game_map
+    fov_map = session.fov_map
+    entity_index = session.entity_index
+
+    for entity in entity_index.at(player.x, player.y):
+        if entity.item and player.fighter.hp < player.fighter.max_hp:
+            return {"pickup": True}
+
+    # Breadth first search from the player, the first step of the path
+    # to each cell is kept
+    first_steps = {(player.x, player.y): None}
+    queue = deque([(player.x, player.y)])
+    while queue:
+        x, y = queue.popleft()
+        for dx, dy in NEIGHBOURS:
+            nx = x + dx
+            ny = y + dy
+            if ((nx, ny) in first_steps or not 0 <= nx < game_map.width
+                    or not 0 <= ny < game_map.height
+                    or game_map.is_blocked(nx, ny)):
+                continue
+            step = first_steps[(x, y)] or (dx, dy)
+
+            entities = entity_index.at(nx, ny)
+            visible = fov_map.is_in_fov(nx, ny)
+            if visible and any(entity.fighter for entity in entities):
+                return {"move": step}
+            if (visible and player.fighter.hp < player.fighter.max_hp
+                    and any(entity.item for entity in entities)):
+                return {"move": step}
+            if not game_map.explored.test(nx, ny):
+                return {"move": step}
+            if any(entity.blocks for entity in entities):
+                continue
+
+            first_steps[(nx, ny)] = step
+            queue.append((nx, ny))
+
+    # Nothing left to do on the level
+    return None
+
+
+def play_game(task):
+    """ Play one seeded game with a stat table, return its statistics """
+
+    name, stats, seed, max_turns = task
+    session = GameSession(seed=seed, stats=stats)
+    player = session.player
+
+    turns = 0
+    damage_taken = 0
+    healed = 0
+    items = 0
+    kills = 0
+
+    while turns < max_turns and session.game_state != GameStates.PLAYER_DEAD:
+        action = choose_action(session)
+        if action is None:
+            break
+
+        hp = player.fighter.hp
+        events = session.step(action)
+        turns += 1
+
+        if player.fighter.hp < hp:
+            damage_taken += hp - player.fighter.hp
+        else:
+            healed += player.fighter.hp - hp
+        for event in events:
+            if event.get("item"):
+                items += 1
+            dead_entity = event.get("dead")
+            if dead_entity and dead_entity != player:
+                kills += 1
+
+    return {"config": name,
+            "seed": seed,
+            "turns": turns,
+            "dead": session.game_state == GameStates.PLAYER_DEAD,
+            "damage": damage_taken,
+            "healed": healed,
+            "items": items,
+            "kills": kills}
+
+
+def read_results(filename):
+    """ Results already in the file, the unreadable lines (an interrupted
+        write) are skipped """
+
+    results = []
+    if not os.path.exists(filename):
+        return results
+    with open(filename) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(result, dict) and "config" in result and "seed" in result:
+                results.append(result)
+    return results
+
+
+def summarize(results):
+    """ Averages of the results, by stat table """
+
+    summary = {}
+    for result in results:
+        summary.setdefault(result["config"], []).append(result)
+
+    lines = []
+    for name, games in summary.items():
+        count = len(games)
+        lines.append(f"{name:16} games {count:6} "
+                     f"survival {1 - sum(g['dead'] for g in games) / count:6.1%} "
+                     f"turns {sum(g['turns'] for g in games) / count:7.1f} "
+                     f"damage {sum(g['damage'] for g in games) / count:6.1f} "
+                     f"items {sum(g['items'] for g in games) / count:5.2f} "
+                     f"kills {sum(g['kills'] for g in games) / count:5.2f}")
+    return "\n".join(lines)
+
+
+def run_sweep(sweep, games, output, workers=None, max_turns=MAX_TURNS,
+              first_seed=0):
+    """ Play games seeds for each stat table of the sweep on a process
+        pool, appending each result to output as soon as it is known.
+        The games already in output are not played again """
+
+    # A misspelled stat would silently play the base game
+    for config in sweep:
+        GameSession.check_stats(config["stats"])
+
+    results = read_results(output)
+    done = set((result["config"], result["seed"]) for result in results)
+
+    # Rewrite the file without the unreadable lines
+    with open(output, "w") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+
+    tasks = [(config["name"], config["stats"], seed, max_turns)
+             for seed in range(first_seed, first_seed + games)
+             for config in sweep
+             if (config["name"], seed) not in done]
+    print(f"{len(done)} games done, {len(tasks)} to play")
+
+    with multiprocessing.Pool(workers) as pool, open(output, "a") as f:
+        for count, result in enumerate(pool.imap_unordered(play_game, tasks,
+                                                           chunksize=4), 1):
+            f.write(json.dumps(result) + "\n")
+            f.flush()
+            results.append(result)
+            if count % 100 == 0:
+                print(f"{count}/{len(tasks)} games")
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play seeded games with a "
+                                     "scripted player for each stat table")
+    parser.add_argument("--games", type=int, default=1000,
+                        help="number of seeds per stat table")
+    parser.add_argument("--first-seed", type=int, default=0)
+    parser.add_argument("--max-turns", type=int, default=MAX_TURNS)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of processes, all the cores by default")
+    parser.add_argument("--sweep",
+                        help="JSON file with a list of "
+                        "{\"name\": ..., \"stats\": {...}} stat tables")
+    parser.add_argument("--output", default="balance.jsonl",
+                        help="results file, resumed if it exists")
+    args = parser.parse_args()
+
+    sweep = DEFAULT_SWEEP
+    if args.sweep:
+        with open(args.sweep) as f:
+            sweep = json.load(f)
+
+    results = run_sweep(sweep, args.games, args.output, args.workers,
+                        args.max_turns, args.first_seed)
+    print(summarize(results))
+
+
+if __name__ == '__main__':
+    main()
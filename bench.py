@@ -0,0 +1,827 @@
+import argparse
+import heapq
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import libtcodpy as libtcod
+
+from balance import choose_action
+from game import (PATHFINDERS, AStar, Camera, DijkstraMap, Entity, FlowField,
+                  EntityIndex, Fighter, GameMap, GameSession, GameStates, BasicMonster, Message,
+                  MessageLog, Recorder, RenderOrder, draw_map,
+                  get_blocking_entities_at_location, initialize_fov,
+                  read_recording, recompute_fov, replay_headless,
+                  path_stats, use_flow_fields, use_pathfinder)
+
+
+# Timings of the machine that wrote it with --save, not in the repository:
+# each machine saves its own before comparing
+BASELINE_FILE = "bench_baseline.json"
+
+# A benchmark slower than its baseline by more than this is reported as
+# a regression
+THRESHOLD = 0.10
+
+COLORS = {
+    "dark_wall": libtcod.light_sepia,
+    "dark_ground": libtcod.lighter_sepia,
+    "light_wall": libtcod.lighter_sepia,
+    "light_ground": libtcod.lightest_sepia,
+}
+
+# Name and setup function of each benchmark, the setup function returns
+# the function to time
+BENCHMARKS = []
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+def _player():
+    return Entity(0, 0, "@", libtcod.white, "Selen", blocks=True,
+                  render_order=RenderOrder.ACTOR,
+                  fighter=Fighter(30, 2, 5))
+
+
+def _level(width=80, height=43, seed=0):
+    player = _player()
+    entities = [player]
+    game_map = GameMap(width, height)
+    game_map.make_map(30, 6, 10, width, height, player, entities, 3, 2,
+                      random.Random(seed))
+    return game_map, player, entities
+
+
+def _open_map(width, height):
+    """ A single room filling the whole map """
+
+    game_map = GameMap(width, height)
+    for x in range(1, width - 1):
+        for y in range(1, height - 1):
+            game_map.tiles[x][y].blocked = False
+            game_map.tiles[x][y].block_sight = False
+    return game_map
+
+
+def _cavern_map(width, height, seed, fill=0.42, passes=4):
+    """ Open caverns: random walls smoothed by a cellular automaton """
+
+    rng = random.Random(seed)
+    walls = [[x in (0, width - 1) or y in (0, height - 1) or rng.random() < fill
+              for y in range(height)] for x in range(width)]
+    for i in range(passes):
+        smoothed = [[True] * height for x in range(width)]
+        for x in range(1, width - 1):
+            for y in range(1, height - 1):
+                smoothed[x][y] = sum(walls[x + dx][y + dy]
+                                     for dx in (-1, 0, 1)
+                                     for dy in (-1, 0, 1)) >= 5
+        walls = smoothed
+
+    game_map = GameMap(width, height)
+    for x in range(width):
+        for y in range(height):
+            game_map.tiles[x][y].blocked = walls[x][y]
+            game_map.tiles[x][y].block_sight = walls[x][y]
+    return game_map
+
+
+def _path_cost(path, x, y):
+    cost = 0
+    for (next_x, next_y) in path:
+        if max(abs(next_x - x), abs(next_y - y)) != 1:
+            return None
+        cost += 141 if next_x != x and next_y != y else 100
+        (x, y) = (next_x, next_y)
+    return cost
+
+
+def _bench_make_map(width, height):
+    def setup():
+        rooms = 30 * width * height // (80 * 43)
+        player = _player()
+
+        def run():
+            game_map = GameMap(width, height)
+            game_map.make_map(rooms, 6, 10, width, height, player, [player],
+                              3, 2, random.Random(0))
+        return run
+    return setup
+
+
+for (width, height) in [(80, 43), (200, 120), (400, 240)]:
+    benchmark(f"make_map {width}x{height}")(_bench_make_map(width, height))
+
+
+@benchmark("initialize_fov 80x43")
+def bench_initialize_fov():
+    game_map, player, entities = _level()
+    return lambda: initialize_fov(game_map)
+
+
+@benchmark("recompute_fov radius 6")
+def bench_recompute_fov():
+    game_map, player, entities = _level()
+    fov_map = initialize_fov(game_map)
+    return lambda: recompute_fov(fov_map, player.x, player.y, 6, True, 1)
+
+
+@benchmark("draw_map 80x43")
+def bench_draw_map():
+    game_map, player, entities = _level()
+    fov_map = initialize_fov(game_map)
+    recompute_fov(fov_map, player.x, player.y, 6, True, 1)
+    game_map.explored.or_rect(*fov_map.visible_rect(player.x, player.y, 6))
+    con = libtcod.console_new(80, 43)
+    camera = Camera(80, 43, game_map.width, game_map.height)
+    camera.update(player)
+    return lambda: draw_map(con, game_map, fov_map, COLORS, camera)
+
+
+def _bench_move_astar(blockers):
+    def setup():
+        rng = random.Random(0)
+        game_map = _open_map(50, 30)
+        # A wall between the monster and the target, in the window of the
+        # pathfinder so that every call runs a search around it
+        for y in range(8, 23):
+            game_map.tiles[20][y].blocked = True
+            game_map.tiles[20][y].block_sight = True
+        target = _player()
+        target.x, target.y = 30, 15
+        monster = Entity(10, 15, "#", libtcod.darkest_grey, "Petit cauchemar",
+                         blocks=True, fighter=Fighter(10, 0, 3),
+                         ai=BasicMonster())
+        entities = [target, monster]
+        while len(entities) < blockers + 2:
+            x = rng.randint(12, 28)
+            y = rng.randint(2, 28)
+            if (not game_map.is_blocked(x, y)
+                    and not get_blocking_entities_at_location(entities, x, y)):
+                entities.append(Entity(x, y, "#", libtcod.darkest_grey,
+                                       "Petit cauchemar", blocks=True))
+
+        def run():
+            # No cached path, every call searches
+            monster.path = []
+            monster.route = []
+            monster.place(10, 15)
+            monster.move_astar(target, entities, game_map)
+
+        path_stats.reset()
+        run()
+        if path_stats.found != 1:
+            raise RuntimeError(f"move_astar {blockers} blockers found no "
+                               f"path: {path_stats.stats()}")
+        path_stats.reset()
+        return run
+    return setup
+
+
+for blockers in [0, 10, 50]:
+    benchmark(f"move_astar {blockers} blockers")(_bench_move_astar(blockers))
+
+
+@benchmark("RoomGraph.plan 400x240")
+def bench_room_graph_plan():
+    player = _player()
+    game_map = GameMap(400, 240)
+    game_map.make_map(30 * 400 * 240 // (80 * 43), 6, 10, 400, 240, player,
+                      [player], 0, 0, random.Random(0))
+    rooms = game_map.room_graph.rooms
+    (x, y) = rooms[0].center()
+    (target_x, target_y) = rooms[-1].center()
+    return lambda: game_map.room_graph.plan(x, y, target_x, target_y)
+
+
+def _bench_cavern(engine, max_length):
+    def setup():
+        rng = random.Random(0)
+        game_map = _cavern_map(200, 200, 0)
+        pathfinder = PATHFINDERS[engine](max_length)
+        reference = AStar(max_length)
+        free = [(x, y) for x in range(200) for y in range(200)
+                if not game_map.tiles[x][y].blocked]
+
+        # Searches with a path, from across the window
+        searches = []
+        while len(searches) < 10:
+            (x, y) = rng.choice(free)
+            target_x = x + rng.randint(-max_length, max_length)
+            target_y = y + rng.randint(-max_length, max_length)
+            if (0 <= target_x < 200 and 0 <= target_y < 200
+                    and reference.compute(game_map, x, y, target_x, target_y)):
+                searches.append((x, y, target_x, target_y))
+
+        def run():
+            for search in searches:
+                pathfinder.compute(game_map, *search)
+        return run
+    return setup
+
+
+for engine in PATHFINDERS:
+    for max_length in [24, 80]:
+        benchmark(f"{engine} 10 paths cavern {max_length} steps")(
+            _bench_cavern(engine, max_length))
+
+
+def _bench_swarm(flow):
+    def setup():
+        rng = random.Random(0)
+        game_map, player, entities = _level(seed=0)
+        entities = [player]
+        cells = [(x, y) for x in range(game_map.width)
+                 for y in range(game_map.height)
+                 if not game_map.tiles[x][y].blocked
+                 and 2 <= max(abs(x - player.x), abs(y - player.y)) <= 20]
+        monsters = [Entity(x, y, "#", libtcod.darkest_grey, "Petit cauchemar",
+                           blocks=True, fighter=Fighter(10, 0, 3),
+                           ai=BasicMonster())
+                    for (x, y) in rng.sample(cells, 40)]
+        entities.extend(monsters)
+        EntityIndex(entities)
+        starts = [(monster.x, monster.y) for monster in monsters]
+
+        def run():
+            # One turn of the swarm, the flow field is built again
+            use_flow_fields(flow)
+            for monster, (x, y) in zip(monsters, starts):
+                monster.place(x, y)
+                monster.path = []
+                monster.route = []
+            for monster in monsters:
+                if flow:
+                    monster.move_flow(player, entities, game_map)
+                else:
+                    monster.move_astar(player, entities, game_map)
+            use_flow_fields(False)
+        return run
+    return setup
+
+
+benchmark("swarm 40 monsters move_astar")(_bench_swarm(False))
+benchmark("swarm 40 monsters flow field")(_bench_swarm(True))
+
+
+@benchmark("DijkstraMap 80x43 3 goals")
+def bench_dijkstra_map():
+    game_map, player, entities = _level()
+    goals = [(entity.x, entity.y, 0) for entity in entities[:3]]
+    return lambda: DijkstraMap(game_map, 0, 0, 80, 43).compute(goals)
+
+
+@benchmark("DijkstraMap 80x43 flee")
+def bench_dijkstra_flee():
+    game_map, player, entities = _level()
+    approach = DijkstraMap(game_map, 0, 0, 80, 43).compute([(player.x,
+                                                             player.y, 0)])
+    return lambda: approach.scaled(-1.2)
+
+
+def _bench_blocking_entities(count):
+    def setup():
+        rng = random.Random(0)
+        entities = [Entity(rng.randint(0, 79), rng.randint(0, 42), "#",
+                           libtcod.darkest_grey, "Petit cauchemar",
+                           blocks=rng.random() < 0.5)
+                    for i in range(count)]
+        return lambda: get_blocking_entities_at_location(entities, 40, 20)
+    return setup
+
+
+for count in [10, 100, 1000]:
+    benchmark(f"get_blocking_entities {count} entities")(
+        _bench_blocking_entities(count))
+
+
+@benchmark("MessageLog.add_message")
+def bench_add_message():
+    message_log = MessageLog(22, 58, 6)
+    message = Message("Petit cauchemar attaque Selen pour 1 points de degats, "
+                      "Selen se sent un peu moins sereine.", libtcod.darkest_grey)
+    return lambda: message_log.add_message(message)
+
+
+@benchmark("session 1000 turns")
+def bench_session():
+    def run():
+        turns = 0
+        seed = 0
+        while turns < 1000:
+            session = GameSession(seed=seed)
+            while (turns < 1000
+                   and session.game_state != GameStates.PLAYER_DEAD):
+                action = choose_action(session)
+                if action is None:
+                    break
+                session.step(action)
+                turns += 1
+            seed += 1
+    return run
+
+
+def _flow_path(field, x, y):
+    """ Cells from (x, y) to the target of a flow field, following it """
+
+    path = []
+    while field.distance_at(x, y) > 0:
+        (x, y) = field.step(x, y, lambda x, y: True)
+        path.append((x, y))
+    return path
+
+
+def check_pathfinders(seeds=20, searches=50, flow_searches=10):
+    """ Compare every pathfinder to AStar on seeded maps, with entities in
+        the way: the paths must be valid, and found or not and cost the
+        same. The distances of flow fields must be the costs of the AStar
+        paths where both searches cover the path. Returns the descriptions
+        of the differences """
+
+    errors = []
+    maps = []
+    for seed in range(seeds):
+        maps.append((f"make_map seed {seed}", _level(seed=seed)[0]))
+        maps.append((f"cavern seed {seed}", _cavern_map(80, 43, seed)))
+
+    reference = AStar()
+    pathfinders = dict([(name, engine()) for name, engine in PATHFINDERS.items()
+                        if engine is not AStar])
+    for seed, (name, game_map) in enumerate(maps):
+        rng = random.Random(seed)
+        free = [(x, y) for x in range(game_map.width)
+                for y in range(game_map.height)
+                if not game_map.tiles[x][y].blocked]
+        for i in range(searches):
+            (x, y) = rng.choice(free)
+            (target_x, target_y) = rng.choice(free)
+            blocked = set(rng.sample(free, rng.choice([0, 5, 30])))
+            blocked -= set([(x, y), (target_x, target_y)])
+            expected = reference.compute(game_map, x, y, target_x, target_y,
+                                         blocked)
+
+            for engine, pathfinder in pathfinders.items():
+                path = pathfinder.compute(game_map, x, y, target_x, target_y,
+                                          blocked)
+                search = f"{engine} {name}: ({x}, {y}) -> ({target_x}, {target_y})"
+                if path is None or expected is None:
+                    if path != expected:
+                        errors.append(f"{search} gives {path} not {expected}")
+                    continue
+                if path and (path[-1] != (target_x, target_y)
+                             or _path_cost(path, x, y) is None
+                             or any(game_map.tiles[cx][cy].blocked
+                                    or (cx, cy) in blocked
+                                    for (cx, cy) in path)):
+                    errors.append(f"{search} invalid path {path}")
+                elif (bool(path) != bool(expected)
+                      or _path_cost(path, x, y) != _path_cost(expected, x, y)):
+                    errors.append(f"{search} costs {_path_cost(path, x, y)} "
+                                  f"not {_path_cost(expected, x, y)}")
+
+        # Flow fields only go around the walls
+        for i in range(flow_searches):
+            (x, y) = rng.choice(free)
+            (target_x, target_y) = rng.choice(
+                [(cx, cy) for (cx, cy) in free
+                 if max(abs(cx - x), abs(cy - y)) <= reference.max_length])
+            field = FlowField(game_map, target_x, target_y)
+            expected = reference.compute(game_map, x, y, target_x, target_y)
+            cost = _path_cost(expected, x, y) if expected else None
+            distance = field.distance_at(x, y)
+            search = f"flow {name}: ({x}, {y}) -> ({target_x}, {target_y})"
+            if distance > 0:
+                path = _flow_path(field, x, y)
+                if _path_cost(path, x, y) != distance:
+                    errors.append(f"{search} distance {distance} but its "
+                                  f"path costs {_path_cost(path, x, y)}")
+                    continue
+                # A path of the field short enough for AStar
+                if len(path) <= reference.max_length and (cost is None
+                                                          or cost > distance):
+                    errors.append(f"{search} distance {distance} but AStar "
+                                  f"costs {cost}")
+                    continue
+            # An AStar path in the field
+            if cost is not None and all(
+                    max(abs(cx - target_x), abs(cy - target_y)) <= field.radius
+                    for (cx, cy) in expected) and not 0 <= distance <= cost:
+                errors.append(f"{search} distance {distance} but AStar "
+                              f"costs {cost}")
+    return errors
+
+
+def _short_path_cost(game_map, x, y, target_x, target_y, blocked,
+                     max_length):
+    """ Cost of the cheapest path of at most max_length steps, None if
+        there is none: the cheapest costs in 1, 2... steps, relaxing only
+        the cells that got cheaper at the previous step """
+
+    costs = {(x, y): 0}
+    changed = [(x, y)]
+    for step in range(max_length):
+        relaxed = {}
+        for (cx, cy) in changed:
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    (nx, ny) = (cx + dx, cy + dy)
+                    if ((not dx and not dy) or not 0 <= nx < game_map.width
+                            or not 0 <= ny < game_map.height
+                            or game_map.tiles[nx][ny].blocked
+                            or (nx, ny) in blocked):
+                        continue
+                    cost = costs[(cx, cy)] + (141 if dx and dy else 100)
+                    if cost < relaxed.get((nx, ny), costs.get((nx, ny), cost + 1)):
+                        relaxed[(nx, ny)] = cost
+        costs.update(relaxed)
+        changed = list(relaxed)
+    return costs.get((target_x, target_y))
+
+
+def check_step_budget(seeds=20, searches=40):
+    """ Searches of every pathfinder toward targets near the edge of its
+        square on seeded caverns: the path must be the cheapest of at most
+        max_length steps, and be found whenever there is one. Returns the
+        descriptions of the differences """
+
+    errors = []
+    pathfinders = dict([(name, engine()) for name, engine in PATHFINDERS.items()])
+    reach = AStar().max_length
+    for seed in range(seeds):
+        game_map = _cavern_map(80, 43, seed)
+        rng = random.Random(seed)
+        free = [(x, y) for x in range(game_map.width)
+                for y in range(game_map.height)
+                if not game_map.tiles[x][y].blocked]
+        for i in range(searches):
+            (x, y) = rng.choice(free)
+            far = [(cx, cy) for (cx, cy) in free
+                   if reach - 2 <= max(abs(cx - x), abs(cy - y)) <= reach]
+            if not far:
+                continue
+            (target_x, target_y) = rng.choice(far)
+            blocked = set(rng.sample(free, rng.choice([0, 30])))
+            blocked -= set([(x, y), (target_x, target_y)])
+            expected = _short_path_cost(game_map, x, y, target_x, target_y,
+                                        blocked, reach)
+            for engine, pathfinder in pathfinders.items():
+                path = pathfinder.compute(game_map, x, y, target_x, target_y,
+                                          blocked)
+                search = f"{engine} cavern seed {seed}: ({x}, {y}) -> ({target_x}, {target_y})"
+                cost = _path_cost(path, x, y) if path else None
+                if path and (len(path) > reach
+                             or path[-1] != (target_x, target_y)
+                             or cost is None
+                             or any(game_map.tiles[cx][cy].blocked
+                                    or (cx, cy) in blocked
+                                    for (cx, cy) in path)):
+                    errors.append(f"{search} invalid path {path}")
+                elif cost != expected:
+                    errors.append(f"{search} costs {cost} not {expected}")
+    return errors
+
+
+def _dijkstra_values(game_map, x, y, width, height, goals):
+    """ Values of the cells of a rectangle of the map from goals, as
+        DijkstraMap should find them: plain Dijkstra, one per step """
+
+    def walkable(cx, cy):
+        return (x <= cx < x + width and y <= cy < y + height
+                and 0 <= cx < game_map.width and 0 <= cy < game_map.height
+                and not game_map.tiles[cx][cy].blocked)
+
+    values = {}
+    heap = [(value, gx, gy) for (gx, gy, value) in goals if walkable(gx, gy)]
+    heapq.heapify(heap)
+    while heap:
+        (value, cx, cy) = heapq.heappop(heap)
+        if (cx, cy) in values:
+            continue
+        values[(cx, cy)] = value
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                if walkable(cx + dx, cy + dy) and (cx + dx, cy + dy) not in values:
+                    heapq.heappush(heap, (value + 1, cx + dx, cy + dy))
+    return values
+
+
+def check_dijkstra_maps(seeds=10, maps=5):
+    """ Compare DijkstraMap to plain Dijkstra on seeded maps: goals of
+        different values, rectangles running off the map, and the maps
+        scaled from them. Returns the descriptions of the differences """
+
+    errors = []
+    for seed in range(seeds):
+        levels = [(f"make_map seed {seed}", _level(seed=seed)[0]),
+                  (f"cavern seed {seed}", _cavern_map(80, 43, seed))]
+        for name, game_map in levels:
+            rng = random.Random(seed)
+            free = [(x, y) for x in range(game_map.width)
+                    for y in range(game_map.height)
+                    if not game_map.tiles[x][y].blocked]
+            for i in range(maps):
+                # Partly off the map now and then
+                width = rng.randint(10, game_map.width)
+                height = rng.randint(10, game_map.height)
+                x = rng.randint(-width // 2, game_map.width - width // 2)
+                y = rng.randint(-height // 2, game_map.height - height // 2)
+                goals = [(gx, gy, rng.randint(-10, 10))
+                         for (gx, gy) in rng.sample(free, rng.randint(1, 6))]
+                base = DijkstraMap(game_map, x, y, width, height)
+                base.compute(goals)
+                base_values = _dijkstra_values(game_map, x, y, width, height,
+                                               goals)
+                search = f"dijkstra {name}: {width}x{height} at ({x}, {y})"
+
+                for scale in (1, -1.2, 0.5, 2):
+                    dijkstra_map = base
+                    expected = base_values
+                    if scale != 1:
+                        dijkstra_map = base.scaled(scale)
+                        expected = _dijkstra_values(
+                            game_map, x, y, width, height,
+                            [(cx, cy, int(round(value * scale)))
+                             for ((cx, cy), value) in base_values.items()])
+                    wrong = [(cx, cy) for cx in range(x - 1, x + width + 1)
+                             for cy in range(y - 1, y + height + 1)
+                             if dijkstra_map.value_at(cx, cy)
+                             != expected.get((cx, cy), DijkstraMap.UNREACHED)]
+                    if wrong:
+                        (cx, cy) = wrong[0]
+                        errors.append(f"{search} scaled {scale}: "
+                                      f"{len(wrong)} cells wrong, ({cx}, {cy}) "
+                                      f"is {dijkstra_map.value_at(cx, cy)} not "
+                                      f"{expected.get((cx, cy), DijkstraMap.UNREACHED)}")
+    return errors
+
+
+def _session_state(session):
+    graph = session.game_map.room_graph
+    return ([(entity.name, entity.x, entity.y,
+              entity.fighter.hp if entity.fighter else None,
+              type(entity.ai).__name__)
+             for entity in session.entities],
+            session.game_state, session.fov_radius, session.move_count,
+            session.game_map.explored.to_rle(),
+            graph and (len(graph.rooms), graph.edges))
+
+
+def check_resume(seeds=10, turns=400, resume_every=10):
+    """ Play seeded sessions saved, quit and resumed every resume_every
+        turns, recorded as main() does, with each pathfinder in turn, with
+        and without flow fields and with both AIs. The loaded sessions
+        must be the saved ones, paths aside, and the replay of the
+        recording, started with the other settings, must end in the same
+        state. Returns the descriptions of the differences """
+
+    errors = []
+    mouse = libtcod.Mouse()
+    with tempfile.TemporaryDirectory() as directory:
+        save_file = os.path.join(directory, "savegame.dat")
+        record_file = os.path.join(directory, "session.rec")
+        engines = sorted(PATHFINDERS)
+        for seed in range(seeds):
+            engine = engines[seed % len(engines)]
+            flow = seed // len(engines) % 2 == 1
+            # The recordings don't keep the constants, the game and the
+            # replay both see this one
+            field_ai = GameMap.FIELD_AI = seed // len(engines) // 2 % 2 == 1
+            use_pathfinder(engine)
+            use_flow_fields(flow)
+            session = GameSession(seed=seed)
+            recorder = Recorder(record_file, seed, 80, 43, False)
+            for turn in range(1, turns + 1):
+                if session.game_state == GameStates.PLAYER_DEAD:
+                    break
+                action = choose_action(session)
+                if action is None:
+                    break
+                recorder.record(action, mouse)
+                session.step(action)
+                if turn % resume_every == 0:
+                    recorder.record({"exit": True}, mouse)
+                    recorder.close()
+                    session.save(save_file)
+                    saved = _session_state(session)
+                    session = GameSession.load(save_file, None)
+                    # Loading computes the FOV again, it can explore more
+                    # cells when an item widened it since the last move
+                    loaded = _session_state(session)
+                    if loaded[:4] + loaded[5:] != saved[:4] + saved[5:]:
+                        errors.append(f"resume seed {seed} turn {turn}: the "
+                                      f"loaded session is not the saved one")
+                    recorder = Recorder(record_file)
+            recorder.close()
+
+            use_pathfinder(engines[(seed + 1) % len(engines)])
+            use_flow_fields(not flow)
+            recording = read_recording(record_file)
+            search = (f"resume {engine}{' flow' if flow else ''}"
+                      f"{' field_ai' if field_ai else ''} seed {seed}")
+            if recording[4:6] != (engine, flow):
+                errors.append(f"{search}: the recording has other settings")
+            replayed, elapsed = replay_headless(record_file)
+            if _session_state(replayed) != _session_state(session):
+                errors.append(f"{search}: the replay ends in another state "
+                              f"than the game")
+    use_pathfinder("astar")
+    use_flow_fields(False)
+    GameMap.FIELD_AI = False
+    return errors
+
+
+def check_path_cache(seeds=10, turns=200, monsters=4, min_hit_rate=0.5):
+    """ Chase a player walking from room to room with a few monsters and
+        check that move_astar follows its cached paths for at least
+        min_hit_rate of the lookups over all the seeds. Returns the
+        descriptions of the failures """
+
+    path_stats.reset()
+    for seed in range(seeds):
+        rng = random.Random(seed)
+        game_map, player, entities = _level(seed=seed)
+        entities = [player]
+        floor = [(x, y) for x in range(game_map.width)
+                 for y in range(game_map.height)
+                 if not game_map.tiles[x][y].blocked]
+
+        def spawn_cell():
+            return rng.choice([(x, y) for (x, y) in floor
+                               if 4 <= max(abs(x - player.x),
+                                           abs(y - player.y)) <= 8
+                               and not get_blocking_entities_at_location(
+                                   entities, x, y)])
+
+        chasers = []
+        while len(chasers) < monsters:
+            chasers.append(Entity(*spawn_cell(), "#", libtcod.darkest_grey,
+                                  "Petit cauchemar", blocks=True,
+                                  fighter=Fighter(10, 0, 3),
+                                  ai=BasicMonster()))
+            entities.append(chasers[-1])
+        EntityIndex(entities)
+
+        rooms = game_map.room_graph.rooms
+        room = 0
+        distances = {}
+        for turn in range(turns):
+            # The player kills the monsters that caught up with it, new
+            # ones join the chase
+            for monster in chasers:
+                if monster.distance_to(player) < 2:
+                    monster.place(*spawn_cell())
+                    monster.path = []
+                    monster.route = []
+            # The player walks down to the center of the next room, or waits
+            # behind a monster in the way
+            while distances.get((player.x, player.y), 0) == 0:
+                room = (room + 1) % len(rooms)
+                (goal_x, goal_y) = rooms[room].center()
+                distances = _dijkstra_values(game_map, 0, 0, game_map.width,
+                                             game_map.height,
+                                             [(goal_x, goal_y, 0)])
+            steps = [(distances[(x, y)], x, y)
+                     for x in range(player.x - 1, player.x + 2)
+                     for y in range(player.y - 1, player.y + 2)
+                     if (x, y) in distances
+                     and not get_blocking_entities_at_location(entities,
+                                                               x, y)]
+            steps.append((distances[(player.x, player.y)], player.x,
+                          player.y))
+            player.place(*min(steps)[1:])
+            for monster in chasers:
+                if monster.distance_to(player) >= 2:
+                    monster.move_astar(player, entities, game_map)
+
+    hit_rate = path_stats.stats()["cache_hit_rate"]
+    path_stats.reset()
+    if hit_rate < min_hit_rate:
+        return [f"path cache: hit rate {hit_rate:.2f} under {min_hit_rate}"]
+    return []
+
+
+def measure(run, repeat=5, min_time=0.05):
+    """ Time run, in seconds per call: the loops are calibrated so each
+        repeat lasts at least min_time, the best and median repeats are
+        returned """
+
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(loops):
+            run()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+
+    times = [elapsed / loops]
+    for i in range(repeat - 1):
+        start = time.perf_counter()
+        for j in range(loops):
+            run()
+        times.append((time.perf_counter() - start) / loops)
+
+    return {"min": min(times), "median": statistics.median(times),
+            "loops": loops}
+
+
+def _format_time(seconds):
+    if seconds >= 1:
+        return f"{seconds:8.3f} s "
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:8.3f} ms"
+    return f"{seconds * 1e6:8.3f} us"
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """ Report of the results against the baseline, and whether a
+        benchmark got slower than the threshold """
+
+    lines = [f"{'benchmark':36} {'baseline':>11} {'current':>11}  change"]
+    regression = False
+    for name, result in results.items():
+        current = result["min"]
+        if name not in baseline:
+            lines.append(f"{name:36} {'':>11} {_format_time(current)}  new")
+            continue
+        base = baseline[name]["min"]
+        change = current / base - 1
+        mark = ""
+        if change > threshold:
+            mark = "  REGRESSION"
+            regression = True
+        elif change < -threshold:
+            mark = "  faster"
+        lines.append(f"{name:36} {_format_time(base)} {_format_time(current)} "
+                     f"{change:+7.1%}{mark}")
+    return "\n".join(lines), regression
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the hot "
+                                     "paths of the game, compared to a "
+                                     "baseline stored by --save on the same "
+                                     "machine: run with --save first, "
+                                     "without baseline nothing is compared")
+    parser.add_argument("-k", dest="filter", default="",
+                        help="only run the benchmarks containing this text")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save", action="store_true",
+                        help="store the results as the new baseline of this "
+                        "machine")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--check", action="store_true",
+                        help="compare the pathfinders and the flow fields to "
+                        "AStar, check the paths near the step limit, the "
+                        "Dijkstra maps and the path cache hit rate, and "
+                        "replay resumed sessions instead")
+    args = parser.parse_args()
+
+    if args.check:
+        errors = (check_pathfinders() + check_step_budget()
+                  + check_dijkstra_maps() + check_path_cache()
+                  + check_resume())
+        for error in errors:
+            print(error)
+        print(f"{len(errors)} differences")
+        sys.exit(1 if errors else 0)
+
+    results = {}
+    for name, setup in BENCHMARKS:
+        if args.filter in name:
+            results[name] = measure(setup())
+            print(f"{name:36} {_format_time(results[name]['min'])}")
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    report, regression = compare(results, baseline, args.threshold)
+    print()
+    print(report)
+    if not baseline and not args.save:
+        print(f"No baseline in {args.baseline}, run with --save first to "
+              f"compare the next runs of this machine")
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Baseline saved in {args.baseline}")
+    elif regression:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
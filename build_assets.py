@@ -0,0 +1,98 @@
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import zipfile
+
+
+SOUND_FILES = ["theme.wav",
+               "sound_selen_aie.wav",
+               "sound_selen_holala.wav",
+               "sound_nightmares.wav",
+               "pas2.wav"]
+
+# Ogg Vorbis quality, from -1 (smallest) to 10 (best)
+OGG_QUALITY = 4
+
+# Files needed to play, the sounds go in the package compressed only
+GAME_FILES = ["game.py",
+              "libtcodpy/__init__.py",
+              "libtcodpy/cprotos.py",
+              "arial10x10.png",
+              "README.md",
+              "INSTALL",
+              "LICENSE",
+              "LIBTCOD-LICENSE"]
+
+# The libtcod and SDL libraries shipped next to the game, if any
+LIBRARY_PATTERNS = ["*.so", "*.so.*", "*.dll", "*.dylib"]
+
+DIST_FILE = os.path.join("dist", "selen.zip")
+
+
+def compressed_name(filename):
+    """ Name of the compressed version of a sound file """
+
+    return os.path.splitext(filename)[0] + ".ogg"
+
+
+def encode_command(source, target):
+    """ Command line converting a WAV file to Ogg Vorbis """
+
+    if shutil.which("ffmpeg"):
+        return ["ffmpeg", "-loglevel", "error", "-y", "-i", source,
+                "-c:a", "libvorbis", "-q:a", str(OGG_QUALITY), target]
+    if shutil.which("oggenc"):
+        return ["oggenc", "--quiet", "-q", str(OGG_QUALITY),
+                "-o", target, source]
+    return None
+
+
+def build_sounds(directory):
+    """ Convert the WAV sounds to Ogg Vorbis, skipping up to date files """
+
+    for filename in SOUND_FILES:
+        source = os.path.join(directory, filename)
+        target = os.path.join(directory, compressed_name(filename))
+
+        if (os.path.exists(target)
+                and os.path.getmtime(target) >= os.path.getmtime(source)):
+            continue
+
+        command = encode_command(source, target)
+        if command is None:
+            print("Error: ffmpeg or oggenc is needed to build the sounds")
+            return False
+
+        subprocess.run(command, check=True)
+        print(f"{filename}: {os.path.getsize(source)} -> "
+              f"{os.path.getsize(target)} bytes")
+
+    return True
+
+
+def build_dist(directory, output=DIST_FILE):
+    """ Zip the game with the compressed sounds instead of the WAV files """
+
+    files = list(GAME_FILES)
+    for pattern in LIBRARY_PATTERNS:
+        files.extend(sorted(os.path.relpath(path, directory)
+                            for path in glob.glob(os.path.join(directory,
+                                                               pattern))))
+    files.extend(compressed_name(filename) for filename in SOUND_FILES)
+
+    output = os.path.join(directory, output)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as archive:
+        for filename in files:
+            archive.write(os.path.join(directory, filename), filename)
+    print(f"{output}: {os.path.getsize(output)} bytes")
+
+
+if __name__ == '__main__':
+    directory = os.path.dirname(os.path.abspath(__file__))
+    if not build_sounds(directory):
+        sys.exit(1)
+    if "--dist" in sys.argv[1:]:
+        build_dist(directory)
@@ -1,9 +1,23 @@
 import libtcodpy as libtcod
+import random
 from random import randint
 from enum import Enum
+from collections import OrderedDict, deque
+import argparse
+import array
+import heapq
+import json
 import math
+import mmap
+import os
+import pickle
+import re
+import shutil
+import struct
+import sys
+import tempfile
 import textwrap
-import pygame
+import time
 
 
 def handle_keys(key):
@@ -33,6 +47,12 @@ def handle_keys(key):
     if key_char == "g":
         return {"pickup": True}
 
+    if key_char == "m":
+        return {"minimap": True}
+
+    if key_char == "p":
+        return {"profiler": True}
+
     if key.vk == libtcod.KEY_ENTER and key.lalt:
         # left Alt + Enter: toggle fullscreen mode
         return {"fullscreen": True}
@@ -45,24 +65,276 @@ def handle_keys(key):
     return {}
 
 
-def initialize_fov(game_map):
-    """ Field of view initialization """
+# FOV flag bytes to binary digits
+FOV_DIGITS = bytes.maketrans(b"\x00\x01", b"01")
+
+
+class FovMap:
+    """ libtcod FOV map covering a window of the game map.
+        The window follows the player, so its size does not depend
+        on the size of the map """
+
+    def __init__(self, game_map, size=64):
+        self.game_map = game_map
+        self.width = min(size, game_map.width)
+        self.height = min(size, game_map.height)
+        self.x = None
+        self.y = None
+        self.map = libtcod.map_new(self.width, self.height)
+
+    def _move_window(self, x, y):
+        """ Copy the cells of the game map in the window at x, y """
+
+        self.x = x
+        self.y = y
+        for window_y in range(self.height):
+            for window_x in range(self.width):
+                tile = self.game_map.tiles[x + window_x][y + window_y]
+                libtcod.map_set_properties(self.map,
+                                           window_x,
+                                           window_y,
+                                           not tile.block_sight,
+                                           not tile.blocked)
+
+    def compute(self, x, y, radius, light_walls=True, algorithm=0):
+        # The window only moves when the radius around x, y leaves it
+        x1 = max(x - radius, 0)
+        y1 = max(y - radius, 0)
+        x2 = min(x + radius, self.game_map.width - 1)
+        y2 = min(y + radius, self.game_map.height - 1)
+        if (self.x is None
+                or x1 < self.x or x2 >= self.x + self.width
+                or y1 < self.y or y2 >= self.y + self.height):
+            self._move_window(
+                min(max(x - self.width // 2, 0), self.game_map.width - self.width),
+                min(max(y - self.height // 2, 0), self.game_map.height - self.height))
+
+        libtcod.map_compute_fov(self.map,
+                                x - self.x,
+                                y - self.y,
+                                radius,
+                                light_walls,
+                                algorithm)
+
+    def visible_rect(self, x, y, radius):
+        """ Cells in FOV in the square of the radius around x, y,
+            as a rectangle mask for ExploredMask.or_rect """
+
+        x1 = max(x - radius, self.x)
+        y1 = max(y - radius, self.y)
+        x2 = min(x + radius, self.x + self.width - 1)
+        y2 = min(y + radius, self.y + self.height - 1)
+
+        # The rectangle in one call, each row is turned into an int through
+        # its binary digits
+        width = x2 - x1 + 1
+        fov = libtcod.map_get_fov_rect(self.map, x1 - self.x, y1 - self.y,
+                                       width, y2 - y1 + 1)
+        rows = [int(b"0" + fov[start:start + width].translate(FOV_DIGITS), 2)
+                for start in range(0, len(fov), width)]
+
+        return (x1, y1, x2 - x1 + 1, y2 - y1 + 1, rows)
+
+    def is_in_fov(self, x, y):
+        if self.x is None:
+            return False
+        x -= self.x
+        y -= self.y
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return libtcod.map_is_in_fov(self.map, x, y)
+        return False
 
-    fov_map = libtcod.map_new(game_map.width, game_map.height)
 
-    for y in range(game_map.height):
-        for x in range(game_map.width):
-            libtcod.map_set_properties(fov_map,
-                                       x,
-                                       y,
-                                       not game_map.tiles[x][y].block_sight,
-                                       not game_map.tiles[x][y].blocked)
+def initialize_fov(game_map):
+    """ Field of view initialization """
 
-    return fov_map
+    return FovMap(game_map)
 
 
 def recompute_fov(fov_map, x, y, radius, light_walls=True, algorithm=0):
-    libtcod.map_compute_fov(fov_map, x, y, radius, light_walls, algorithm)
+    fov_map.compute(x, y, radius, light_walls, algorithm)
+
+
+class FrameProfiler:
+    """ Time the phases of the frames with perf_counter_ns.
+        The time of each phase is added up over a frame, kept over the last
+        frames for the percentiles and written to a CSV or JSON lines file
+        if one is open. Disabled, begin() and end() only test a flag """
+
+    PHASES = ["fov", "map", "entities", "panel", "flush", "enemies", "path"]
+
+    def __init__(self, window=120):
+        self.enabled = False
+        self.samples = {phase: deque(maxlen=window)
+                        for phase in self.PHASES + ["frame"]}
+        self.frame = dict.fromkeys(self.PHASES, 0)
+        self.frame_start = None
+        self.frame_count = 0
+        self.output = None
+        self.csv = False
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled or self.output is not None
+        self.frame_start = None
+        self.frame = dict.fromkeys(self.PHASES, 0)
+
+    def open(self, filename):
+        """ Write the phase times of every frame to a CSV file, or a JSON
+            lines file if the name does not end with .csv """
+
+        self.output = open(filename, "w")
+        self.csv = filename.endswith(".csv")
+        if self.csv:
+            self.output.write(",".join(["frame"] + self.PHASES + ["total"]) + "\n")
+        self.set_enabled(True)
+
+    def close(self):
+        if self.output:
+            self.output.close()
+            self.output = None
+
+    def begin(self):
+        if self.enabled:
+            return time.perf_counter_ns()
+        return 0
+
+    def end(self, phase, start):
+        if self.enabled:
+            self.frame[phase] += time.perf_counter_ns() - start
+
+    def end_frame(self):
+        """ Keep the times of the frame that ends """
+
+        if not self.enabled:
+            return
+
+        now = time.perf_counter_ns()
+        if self.frame_start is not None:
+            frame = self.frame
+            total = now - self.frame_start
+            for phase in self.PHASES:
+                self.samples[phase].append(frame[phase])
+            self.samples["frame"].append(total)
+
+            if self.output:
+                if self.csv:
+                    self.output.write(",".join([str(self.frame_count)]
+                                               + [str(frame[phase])
+                                                  for phase in self.PHASES]
+                                               + [str(total)]) + "\n")
+                else:
+                    row = {"frame": self.frame_count}
+                    row.update(frame)
+                    row["total"] = total
+                    self.output.write(json.dumps(row) + "\n")
+
+        self.frame_count += 1
+        self.frame_start = now
+        self.frame = dict.fromkeys(self.PHASES, 0)
+
+    def percentile(self, phase, percent):
+        """ Time of a phase in ns under which percent of the frames are """
+
+        samples = sorted(self.samples[phase])
+        if not samples:
+            return 0
+        return samples[min(len(samples) - 1, len(samples) * percent // 100)]
+
+    def lines(self):
+        """ Text of the overlay: the percentiles of the phases in ms and
+            the pathfinding counters """
+
+        lines = ["phase      p50    p95    p99"]
+        for phase in self.PHASES + ["frame"]:
+            lines.append(f"{phase:8} "
+                         + " ".join([f"{self.percentile(phase, percent) / 1e6:6.2f}"
+                                     for percent in (50, 95, 99)]))
+
+        stats = path_stats.stats()
+        lines.append("")
+        lines.append(f"paths {stats['paths_found']}/{stats['calls']}"
+                     f" {stats['avg_time_us']:.0f}us")
+        lines.append("fallback " + " ".join([f"{reason} {count}"
+                                             for reason, count in stats["fallback_reasons"].items()]))
+        lines.append(f"len {stats['avg_path_length']:.1f}"
+                     f" exp {stats['avg_expansions']:.0f}"
+                     f" cache {stats['cache_hit_rate']:.0%}")
+        lines.append(f"flow {stats['flow_moves']} wait {stats['flow_waits']}"
+                     f" fields {stats['flow_fields_built']}")
+        return lines
+
+    def draw(self, console, lines=None):
+        """ Print the overlay on a console at least as large as the lines """
+
+        if lines is None:
+            lines = self.lines()
+        libtcod.console_set_default_background(console, libtcod.black)
+        libtcod.console_set_default_foreground(console, libtcod.white)
+        libtcod.console_clear(console)
+        for y, line in enumerate(lines):
+            libtcod.console_print(console, 0, y, line)
+
+
+# Times the phases of the frames, enabled by the overlay or a --profile file
+profiler = FrameProfiler()
+
+
+class PathStats:
+    """ Counters of the pathfinding of the monsters """
+
+    # Why move_astar fell back to move_towards
+    FALLBACKS = ["far", "no_path", "too_long"]
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.computed = 0
+        self.found = 0
+        self.fallbacks = dict.fromkeys(self.FALLBACKS, 0)
+        self.path_length = 0
+        self.expansions = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Moves planned across the rooms of the map
+        self.planned = 0
+        # Moves along a flow field, turns waiting behind another monster,
+        # and flow fields computed
+        self.flow_moves = 0
+        self.flow_waits = 0
+        self.flow_fields = 0
+        # Dijkstra maps computed for the monsters
+        self.dijkstra_maps = 0
+        self.time_ns = 0
+
+    def stats(self):
+        """ Counters and averages since the last reset """
+
+        calls = max(self.calls, 1)
+        computed = max(self.computed, 1)
+        lookups = max(self.cache_hits + self.cache_misses, 1)
+        return {"calls": self.calls,
+                "paths_computed": self.computed,
+                "paths_found": self.found,
+                "fallbacks": sum(self.fallbacks.values()),
+                "fallback_reasons": dict(self.fallbacks),
+                "avg_path_length": self.path_length / max(self.found, 1),
+                "avg_expansions": self.expansions / computed,
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+                "cache_hit_rate": self.cache_hits / lookups,
+                "routes_planned": self.planned,
+                "flow_moves": self.flow_moves,
+                "flow_waits": self.flow_waits,
+                "flow_fields_built": self.flow_fields,
+                "dijkstra_maps_built": self.dijkstra_maps,
+                "time_ms": self.time_ns / 1e6,
+                "avg_time_us": self.time_ns / calls / 1e3}
+
+
+# Pathfinding counters, shown under the profiler overlay
+path_stats = PathStats()
 
 
 class RenderOrder(Enum):
@@ -73,13 +345,12 @@ class RenderOrder(Enum):
     ACTOR = 3
 
 
-def get_names_under_mouse(mouse, entities, fov_map):
+def get_names_under_mouse(mouse, entity_index, fov_map, camera):
     """ Get the name of the item under the mouse """
 
-    (x, y) = (mouse.cx, mouse.cy)
-    names = [entity.name for entity in entities
-             if entity.x == x and entity.y == y
-             and libtcod.map_is_in_fov(fov_map, entity.x, entity.y)]
+    (x, y) = camera.to_map(mouse.cx, mouse.cy)
+    names = [entity.name for entity in entity_index.at(x, y)
+             if fov_map.is_in_fov(entity.x, entity.y)]
     names = ", ".join(names)
 
     return names.capitalize()
@@ -114,9 +385,282 @@ def render_bar(panel,
                              '{0}: {1}/{2}'.format(name, value, maximum))
 
 
+class DirtyRects:
+    """ Keep track of what changed on screen during a frame,
+        so that only those regions get blitted on the root console """
+
+    def __init__(self, max_rects=16):
+        self.max_rects = max_rects
+        self.rects = []
+        self.everything = True
+        # Cells where entities were drawn on the previous frame
+        self.drawn = []
+        # Square around the player covered by the last FOV computation
+        self.fov_rect = None
+        # What was printed on each line of the panel on the previous frame
+        self.panel_lines = {}
+
+    def add(self, x, y, w=1, h=1):
+        """ Mark a rectangle of the map console as changed """
+        self.rects.append((x, y, w, h))
+
+    def add_everything(self):
+        """ Mark the whole screen as changed """
+        self.everything = True
+        self.panel_lines = {}
+
+    def add_fov(self, x, y, radius):
+        """ Mark the cells that can change when the FOV is recomputed:
+            the ones around the player now and at the last recompute """
+
+        rect = (x - radius, y - radius, 2 * radius + 1, 2 * radius + 1)
+        if self.fov_rect:
+            self.add(*self.fov_rect)
+        self.add(*rect)
+        self.fov_rect = rect
+
+    def add_drawn(self, x, y):
+        """ Mark a cell where an entity is drawn, it will be erased
+            on the next frame """
+        self.add(x, y)
+        self.drawn.append((x, y))
+
+    def new_frame(self):
+        """ The entities drawn on the last frame have been erased since """
+        for (x, y) in self.drawn:
+            self.add(x, y)
+        self.drawn = []
+
+    def panel_line_changed(self, y, content):
+        """ Returns true if line y of the panel shows something new """
+        if self.panel_lines.get(y) == content:
+            return False
+        self.panel_lines[y] = content
+        return True
+
+    def _merged_rects(self, width, height):
+        if self.everything:
+            return [(0, 0, width, height)]
+
+        # Clip to the console, drop the rectangles inside another one
+        clipped = []
+        for (x, y, w, h) in set(self.rects):
+            x1, y1 = max(x, 0), max(y, 0)
+            x2, y2 = min(x + w, width), min(y + h, height)
+            if x1 < x2 and y1 < y2:
+                clipped.append((x1, y1, x2, y2))
+        rects = [r for r in clipped
+                 if not any(o != r and o[0] <= r[0] and o[1] <= r[1]
+                            and o[2] >= r[2] and o[3] >= r[3]
+                            for o in clipped)]
+
+        if len(rects) > self.max_rects:
+            # Too many pieces, one blit of the bounding box is cheaper
+            rects = [(min(r[0] for r in rects), min(r[1] for r in rects),
+                      max(r[2] for r in rects), max(r[3] for r in rects))]
+
+        return [(x1, y1, x2 - x1, y2 - y1) for (x1, y1, x2, y2) in rects]
+
+    def blit(self, con, width, height):
+        """ Blit the changed rectangles of con on the root console """
+
+        for (x, y, w, h) in self._merged_rects(width, height):
+            libtcod.console_blit(con, x, y, w, h, 0, x, y)
+
+        self.rects = []
+        self.everything = False
+
+
+class Camera:
+    """ Window of the map shown on the map console,
+        following the player on maps larger than the screen """
+
+    def __init__(self, width, height, map_width, map_height):
+        self.width = min(width, map_width)
+        self.height = min(height, map_height)
+        self.map_width = map_width
+        self.map_height = map_height
+        self.x = 0
+        self.y = 0
+        # Set when the view shows other cells and must be fully redrawn
+        self.moved = True
+
+    def update(self, target):
+        """ Center the camera on the target, without going past the edges
+            of the map """
+
+        x = min(max(target.x - self.width // 2, 0),
+                self.map_width - self.width)
+        y = min(max(target.y - self.height // 2, 0),
+                self.map_height - self.height)
+
+        if (x, y) != (self.x, self.y):
+            self.x = x
+            self.y = y
+            self.moved = True
+
+    def to_screen(self, x, y):
+        """ Console coordinates of a map cell """
+        return (x - self.x, y - self.y)
+
+    def to_map(self, x, y):
+        """ Map coordinates of a console cell """
+        return (x + self.x, y + self.y)
+
+
+class Minimap:
+    """ Downsampled view of the explored map, with markers for the player
+        and the monsters in view.
+        Each cell of the minimap covers a block of map cells. The blocks
+        are reduced with bitwise operations on whole rows of the map, and
+        only when new cells get explored """
+
+    def __init__(self, game_map, width, height, colors):
+        self.game_map = game_map
+        self.width = width
+        self.height = height
+        self.block_width = -(-game_map.width // width)
+        self.block_height = -(-game_map.height // height)
+        self.colors = colors
+        self.console = libtcod.console_new(width, height)
+        self.visible = False
+        self.explored_changes = None
+        self.markers = []
+
+        # One int per map row, with a bit set for each floor cell,
+        # column 0 being the highest bit
+        self.floor_rows = [int("".join(["0" if game_map.tiles[x][y].block_sight
+                                        else "1"
+                                        for x in range(game_map.width)]), 2)
+                           for y in range(game_map.height)]
+
+    def _reduce(self):
+        """ Kind of each cell of the minimap, row after row:
+            0 unexplored, 1 explored walls only, 2 explored floor """
+
+        width = self.game_map.width
+        height = self.game_map.height
+        mask = self.game_map.explored
+        padding = len(mask.bits) * 8 - width * height
+        explored = int.from_bytes(mask.bits, "big") >> padding
+        row_mask = (1 << width) - 1
+
+        column_masks = []
+        for block_x in range(self.width):
+            x1 = block_x * self.block_width
+            x2 = min(x1 + self.block_width, width)
+            if x1 < x2:
+                column_masks.append(((1 << (x2 - x1)) - 1) << (width - x2))
+            else:
+                column_masks.append(0)
+
+        kinds = []
+        for block_y in range(self.height):
+            y1 = block_y * self.block_height
+            y2 = min(y1 + self.block_height, height)
+            explored_any = 0
+            explored_floor = 0
+            if y1 < y2:
+                # The rows of the block, then OR-ed together
+                rows = ((explored >> ((height - y2) * width))
+                        & ((1 << ((y2 - y1) * width)) - 1))
+                for y in range(y1, y2):
+                    row = (rows >> ((y2 - 1 - y) * width)) & row_mask
+                    explored_any |= row
+                    explored_floor |= row & self.floor_rows[y]
+
+            for column_mask in column_masks:
+                if explored_floor & column_mask:
+                    kinds.append(2)
+                elif explored_any & column_mask:
+                    kinds.append(1)
+                else:
+                    kinds.append(0)
+
+        return kinds
+
+    def update(self, player, entity_index, fov_map, fov_radius):
+        """ Redraw the map if new cells were explored, move the markers """
+
+        if self.game_map.explored.changes != self.explored_changes:
+            self.explored_changes = self.game_map.explored.changes
+            palette = [libtcod.black,
+                       self.colors.get("dark_wall"),
+                       self.colors.get("dark_ground")]
+            cells = [palette[kind] for kind in self._reduce()]
+            libtcod.console_fill_background(self.console,
+                                            [color.r for color in cells],
+                                            [color.g for color in cells],
+                                            [color.b for color in cells])
+
+        for (x, y) in self.markers:
+            libtcod.console_put_char(self.console, x, y, " ", libtcod.BKGND_NONE)
+        self.markers = []
+
+        # Monsters can only be seen around the player
+        nearby = entity_index.in_rect(player.x - fov_radius,
+                                      player.y - fov_radius,
+                                      2 * fov_radius + 1,
+                                      2 * fov_radius + 1)
+        monsters = [entity for entity in nearby
+                    if entity.ai and fov_map.is_in_fov(entity.x, entity.y)]
+
+        for entity in monsters + [player]:
+            x = entity.x // self.block_width
+            y = entity.y // self.block_height
+            if entity == player:
+                libtcod.console_set_default_foreground(self.console, libtcod.white)
+            else:
+                libtcod.console_set_default_foreground(self.console, libtcod.dark_red)
+            libtcod.console_put_char(self.console, x, y, entity.char, libtcod.BKGND_NONE)
+            self.markers.append((x, y))
+
+    def blit(self, x, y):
+        libtcod.console_blit(self.console, 0, 0, self.width, self.height, 0, x, y)
+
+
+def draw_map(con, game_map, fov_map, colors, camera):
+    """ Draw the cells of the map in the camera view """
+
+    # Only the cells in the camera view are drawn
+    for screen_y in range(camera.height):
+        y = camera.y + screen_y
+        for screen_x in range(camera.width):
+            x = camera.x + screen_x
+            is_visible = fov_map.is_in_fov(x, y)
+            is_wall = game_map.tiles[x][y].block_sight
+
+            if is_visible:
+                if is_wall:
+                    libtcod.console_set_char_background(con,
+                                                        screen_x,
+                                                        screen_y,
+                                                        colors.get("light_wall"),
+                                                        libtcod.BKGND_SET)
+                else:
+                    libtcod.console_set_char_background(con,
+                                                        screen_x,
+                                                        screen_y,
+                                                        colors.get("light_ground"),
+                                                        libtcod.BKGND_SET)
+            elif game_map.explored.test(x, y):
+                if is_wall:
+                    libtcod.console_set_char_background(con,
+                                                        screen_x,
+                                                        screen_y,
+                                                        colors.get("dark_wall"),
+                                                        libtcod.BKGND_SET)
+                else:
+                    libtcod.console_set_char_background(con,
+                                                        screen_x,
+                                                        screen_y,
+                                                        colors.get("dark_ground"),
+                                                        libtcod.BKGND_SET)
+
+
 def render_all(con,
                panel,
-               entities,
+               entity_index,
                player,
                game_map,
                fov_map,
@@ -128,52 +672,50 @@ def render_all(con,
                panel_height,
                panel_y,
                mouse,
-               colors):
+               colors,
+               dirty,
+               camera):
     """ Draw all entities in the list and in the fov """
 
     # libtcod.console_set_default_background(con, libtcod.white)
 
-    if fov_recompute:
-        for y in range(game_map.height):
-            for x in range(game_map.width):
-                is_visible = libtcod.map_is_in_fov(fov_map, x, y)
-                is_wall = game_map.tiles[x][y].block_sight
-
-                if is_visible:
-                    if is_wall:
-                        libtcod.console_set_char_background(con,
-                                                            x,
-                                                            y,
-                                                            colors.get("light_wall"),
-                                                            libtcod.BKGND_SET)
-                    else:
-                        libtcod.console_set_char_background(con,
-                                                            x,
-                                                            y,
-                                                            colors.get("light_ground"),
-                                                            libtcod.BKGND_SET)
-                    game_map.tiles[x][y].explored = True
-                elif game_map.tiles[x][y].explored:
-                    if is_wall:
-                        libtcod.console_set_char_background(con,
-                                                            x,
-                                                            y,
-                                                            colors.get("dark_wall"),
-                                                            libtcod.BKGND_SET)
-                    else:
-                        libtcod.console_set_char_background(con,
-                                                            x,
-                                                            y,
-                                                            colors.get("dark_ground"),
-                                                            libtcod.BKGND_SET)
-
-    entities_in_render_order = sorted(entities,
+    dirty.new_frame()
+
+    start = profiler.begin()
+    if fov_recompute or camera.moved:
+        if camera.moved:
+            # The whole view shows other cells, start from a blank console
+            libtcod.console_clear(con)
+            dirty.add(0, 0, camera.width, camera.height)
+            camera.moved = False
+
+        draw_map(con, game_map, fov_map, colors, camera)
+    profiler.end("map", start)
+
+    # Only the entities in the camera view are drawn
+    start = profiler.begin()
+    entities_in_view = entity_index.in_rect(camera.x,
+                                            camera.y,
+                                            camera.width,
+                                            camera.height)
+    entities_in_render_order = sorted(entities_in_view,
                                       key=lambda x: x.render_order.value)
 
     for entity in entities_in_render_order:
-        _draw_entity(con, entity, fov_map)
+        if _draw_entity(con, entity, fov_map, camera):
+            dirty.add_drawn(*camera.to_screen(entity.x, entity.y))
+    profiler.end("entities", start)
+
+    # Only the map part of con is blitted, the panel covers the rest
+    start = profiler.begin()
+    dirty.blit(con, camera.width, camera.height)
+    profiler.end("map", start)
 
-    libtcod.console_blit(con, 0, 0, screen_width, screen_height, 0, 0, 0)
+    start = profiler.begin()
+    names_under_mouse = get_names_under_mouse(mouse,
+                                              entity_index,
+                                              fov_map,
+                                              camera)
 
     libtcod.console_set_default_background(panel, libtcod.lightest_sepia)
     libtcod.console_clear(panel)
@@ -206,34 +748,52 @@ def render_all(con,
                              0,
                              libtcod.BKGND_NONE,
                              libtcod.LEFT,
-                             get_names_under_mouse(mouse, entities, fov_map))
+                             names_under_mouse)
 
-    libtcod.console_blit(panel, 0, 0, screen_width, panel_height, 0, 0, panel_y)
+    # Only blit the lines of the panel that changed since the last frame
+    lines = [[] for y in range(panel_height)]
+    lines[0].append(names_under_mouse)
+    lines[1].append((player.fighter.hp, player.fighter.max_hp))
+    for y, message in enumerate(message_log.messages, 1):
+        lines[y].append((message.text, tuple(message.color)))
 
+    for y in range(panel_height):
+        if dirty.panel_line_changed(y, lines[y]):
+            libtcod.console_blit(panel, 0, y, screen_width, 1, 0, 0, panel_y + y)
+    profiler.end("panel", start)
 
-def clear_all(con, entities):
-    """ Erase all entities in the list """
 
-    for entity in entities:
-        _clear_entity(con, entity)
+def clear_all(con, entity_index, camera):
+    """ Erase all entities in the camera view """
+
+    for entity in entity_index.in_rect(camera.x,
+                                       camera.y,
+                                       camera.width,
+                                       camera.height):
+        _clear_entity(con, entity, camera)
 
 
-def _draw_entity(con, entity, fov_map):
+def _draw_entity(con, entity, fov_map, camera):
     """ Draw the character that represents this object """
 
-    if libtcod.map_is_in_fov(fov_map, entity.x, entity.y):
+    if fov_map.is_in_fov(entity.x, entity.y):
+        (x, y) = camera.to_screen(entity.x, entity.y)
         libtcod.console_set_default_foreground(con, entity.color)
         libtcod.console_put_char(con,
-                                 entity.x,
-                                 entity.y,
+                                 x,
+                                 y,
                                  entity.char,
                                  libtcod.BKGND_NONE)
+        return True
+
+    return False
 
 
-def _clear_entity(con, entity):
+def _clear_entity(con, entity, camera):
     """ Erase the character that represents this object """
 
-    libtcod.console_put_char(con, entity.x, entity.y, " ", libtcod.BKGND_NONE)
+    (x, y) = camera.to_screen(entity.x, entity.y)
+    libtcod.console_put_char(con, x, y, " ", libtcod.BKGND_NONE)
 
 
 def kill_player(player):
@@ -273,12 +833,18 @@ def use_item(entity, player, new_fov_radius, max_fov_radius, sound):
     new_fov_radius = max_fov_radius
 
     use_message = Message(f"{entity.name} utilisee, Selen regagne de la serenite !!!", libtcod.darkest_grey)
+    spend_item(entity)
+
+    return use_message, new_fov_radius
+
+
+def spend_item(entity):
+    """ Leave the remains of a used item """
+
     entity.char = "."
     entity.name = "Restes de " + entity.name
     entity.item = None
 
-    return use_message, new_fov_radius
-
 
 class Fighter:
     """ Fighter component """
@@ -325,11 +891,16 @@ class BasicMonster:
         monster = self.owner
         monster.color = libtcod.darkest_grey
 
-        if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
+        if fov_map.is_in_fov(monster.x, monster.y):
             # Monster color changes to red when chasing or attacking
             monster.color = libtcod.dark_red
             if monster.distance_to(target) >= 2:
-                monster.move_astar(target, entities, game_map)
+                start = profiler.begin()
+                if flow_fields:
+                    monster.move_flow(target, entities, game_map)
+                else:
+                    monster.move_astar(target, entities, game_map)
+                profiler.end("path", start)
             elif target.fighter.hp > 0:
                 attack_results = monster.fighter.attack(target, sound)
                 results.extend(attack_results)
@@ -337,14 +908,887 @@ class BasicMonster:
         return results
 
 
+class FieldMonster:
+    """ Monster running on the shared Dijkstra maps: it chases the target
+        in view, runs away from it when badly hurt, and goes back to the
+        items when hurt and out of view, to heal with them """
+
+    # Part of the hit points under which the monster flees
+    FLEE_HP = 0.34
+
+    def take_turn(self, target, fov_map, game_map, entities, sound):
+        results = []
+        monster = self.owner
+        fighter = monster.fighter
+        monster.color = libtcod.darkest_grey
+
+        start = profiler.begin()
+        if fov_map.is_in_fov(monster.x, monster.y):
+            monster.color = libtcod.dark_red
+            if fighter.hp <= fighter.max_hp * self.FLEE_HP:
+                monster.move_field(ai_fields.flee(game_map, target), entities)
+            elif monster.distance_to(target) >= 2:
+                monster.move_field(ai_fields.approach(game_map, target),
+                                   entities)
+            elif target.fighter.hp > 0:
+                results.extend(fighter.attack(target, sound))
+        elif fighter.hp < fighter.max_hp and not self._use_item(entities):
+            monster.move_field(ai_fields.items(game_map, entities, target),
+                               entities)
+        profiler.end("path", start)
+
+        return results
+
+    def _use_item(self, entities):
+        """ Heal with an item on the cell of the monster, if there is one """
+
+        monster = self.owner
+        if monster.index:
+            here = monster.index.at(monster.x, monster.y)
+        else:
+            here = [entity for entity in entities
+                    if entity.x == monster.x and entity.y == monster.y]
+        for entity in here:
+            if entity.item:
+                fighter = monster.fighter
+                fighter.hp = min(fighter.hp + entity.item.healing,
+                                 fighter.max_hp)
+                spend_item(entity)
+                return True
+        return False
+
+
 class Item:
     def __init__(self, healing=0):
         self.healing = healing
 
 
+def fill_window(passable, side, game_map, origin_x, origin_y, blocked=()):
+    """ Copy the walkable tiles of the square of side cells at the origin
+        into passable, leaving its border unwalkable, then block the cells
+        in blocked """
+
+    inner = bytes(side - 2)
+    walkable = game_map.walkable_cells()
+    x1 = max(origin_x + 1, 0)
+    x2 = min(origin_x + side - 1, game_map.width)
+
+    for row in range(1, side - 1):
+        row_start = row * side
+        passable[row_start + 1:row_start + side - 1] = inner
+        map_y = origin_y + row
+        if not 0 <= map_y < game_map.height or x1 >= x2:
+            continue
+        if walkable is not None:
+            map_start = map_y * game_map.width
+            passable[row_start + x1 - origin_x:row_start + x2 - origin_x] = \
+                walkable[map_start + x1:map_start + x2]
+        else:
+            for map_x in range(x1, x2):
+                passable[row_start + map_x - origin_x] = \
+                    not game_map.tiles[map_x][map_y].blocked
+
+    for (x, y) in blocked:
+        if 0 < x - origin_x < side - 1 and 0 < y - origin_y < side - 1:
+            passable[(y - origin_y) * side + x - origin_x] = 0
+
+
+class AStar:
+    """ A* over the walkable tiles of a map, without libtcod.
+        Paths are at most max_length steps long, so a search stays in the
+        square of max_length cells around the start. The buffers of that
+        square are preallocated, with a border of unwalkable cells, and a
+        search bumps a generation counter instead of clearing them.
+        The open list is a binary heap of ints: the f score times the
+        buffer size plus the flat index of the cell.
+        The search runs over the whole square, when the cheapest path is
+        too long a second search counts the steps to find the cheapest of
+        the short enough ones """
+
+    STRAIGHT_COST = 100
+
+    def __init__(self, max_length=24, diagonal_cost=1.41):
+        self.max_length = max_length
+        # The square around the start and its border
+        self.side = 2 * max_length + 3
+        self.size = self.side * self.side
+        self.diagonal_cost = int(round(diagonal_cost * self.STRAIGHT_COST))
+        # More than any g score in the square, to break the ties between
+        # f scores
+        self.g_range = (self.side - 2) ** 2 * self.diagonal_cost + 1
+
+        self.passable = bytearray(self.size)
+        self.g = array.array("i", [0]) * self.size
+        self.parent = array.array("i", [0]) * self.size
+        self.steps = array.array("i", [0]) * self.size
+        # Generation of the search that last reached / closed each cell
+        self.seen = array.array("I", [0]) * self.size
+        self.closed = array.array("I", [0]) * self.size
+        self.generation = 0
+
+        self.moves = []
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                if dx or dy:
+                    cost = self.diagonal_cost if dx and dy else self.STRAIGHT_COST
+                    self.moves.append((dy * self.side + dx, cost))
+
+        # Nodes expanded by the last search, and whether it gave up on
+        # paths longer than max_length
+        self.expansions = 0
+        self.cut = False
+
+    def _next_generation(self):
+        self.generation += 1
+        if self.generation == 2 ** 32:
+            # The counter wraps around, forget every search for real
+            self.seen = array.array("I", [0]) * self.size
+            self.closed = array.array("I", [0]) * self.size
+            self.generation = 1
+        return self.generation
+
+    def _fill_passable(self, game_map, origin_x, origin_y, blocked):
+        """ Copy the walkable tiles of the square inside the border """
+        fill_window(self.passable, self.side, game_map, origin_x, origin_y,
+                    blocked)
+
+    def compute(self, game_map, x, y, target_x, target_y, blocked=()):
+        """ Path from (x, y) to the target, avoiding the blocked tiles and
+            the cells in blocked. Returns the cells of the path after
+            (x, y), [] if there is none of at most max_length steps, None if
+            the target is too far for such a path """
+
+        side = self.side
+        size = self.size
+        max_length = self.max_length
+        origin_x = x - max_length - 1
+        origin_y = y - max_length - 1
+        goal_x = target_x - origin_x
+        goal_y = target_y - origin_y
+        self.expansions = 0
+        self.cut = False
+        if not (0 < goal_x < side - 1 and 0 < goal_y < side - 1):
+            return None
+
+        generation = self._next_generation()
+        self._fill_passable(game_map, origin_x, origin_y, blocked)
+        passable = self.passable
+        g = self.g
+        parent = self.parent
+        steps = self.steps
+        seen = self.seen
+        closed = self.closed
+        moves = self.moves
+        straight = self.STRAIGHT_COST
+        extra = self.diagonal_cost - self.STRAIGHT_COST
+        g_range = self.g_range
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+
+        start = (max_length + 1) * side + max_length + 1
+        goal = goal_y * side + goal_x
+        seen[start] = generation
+        g[start] = 0
+        steps[start] = 0
+        heap = [start]
+        expansions = 0
+
+        while heap:
+            current = heappop(heap) % size
+            if closed[current] == generation:
+                continue
+            closed[current] = generation
+
+            if current == goal:
+                break
+
+            expansions += 1
+            if steps[current] >= max_length:
+                self.cut = True
+
+            current_g = g[current]
+            next_steps = steps[current] + 1
+            for (offset, cost) in moves:
+                neighbour = current + offset
+                if not passable[neighbour] or closed[neighbour] == generation:
+                    continue
+                new_g = current_g + cost
+                if seen[neighbour] == generation and g[neighbour] <= new_g:
+                    continue
+                seen[neighbour] = generation
+                g[neighbour] = new_g
+                parent[neighbour] = current
+                steps[neighbour] = next_steps
+                # Octile distance to the goal
+                dx = abs(neighbour % side - goal_x)
+                dy = abs(neighbour // side - goal_y)
+                if dx > dy:
+                    h = straight * dx + extra * dy
+                else:
+                    h = straight * dy + extra * dx
+                # Ties go to the cell furthest from the start
+                heappush(heap, ((new_g + h) * g_range - new_g) * size + neighbour)
+        else:
+            self.expansions = expansions
+            return []
+
+        self.expansions = expansions
+        if steps[goal] > max_length:
+            return self._short_path(origin_x, origin_y, goal_x, goal_y)
+
+        path = []
+        cell = goal
+        while cell != start:
+            path.append((origin_x + cell % side, origin_y + cell // side))
+            cell = parent[cell]
+        path.reverse()
+        return path
+
+    def _short_path(self, origin_x, origin_y, goal_x, goal_y):
+        """ Cheapest path of at most max_length steps in the square filled
+            by the last search, [] if there is none. The search is over the
+            (cell, steps) states: a state is dropped when its cell was
+            reached by a cheaper one in as few steps """
+
+        side = self.side
+        max_length = self.max_length
+        passable = self.passable
+        moves = self.moves
+        straight = self.STRAIGHT_COST
+        extra = self.diagonal_cost - self.STRAIGHT_COST
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+
+        start = (max_length + 1) * side + max_length + 1
+        goal = goal_y * side + goal_x
+        # Fewest steps of the expanded states of each cell
+        fewest = {}
+        # Entries: f score, minus g score, steps, cell, path as
+        # (cell, previous path)
+        heap = [(0, 0, 0, start, None)]
+        expansions = 0
+        while heap:
+            # The f score only orders the heap
+            (minus_g, count, current, path) = heappop(heap)[1:]
+            if fewest.get(current, max_length + 1) <= count:
+                continue
+            fewest[current] = count
+            path = (current, path)
+            if current == goal:
+                break
+
+            expansions += 1
+            for (offset, cost) in moves:
+                neighbour = current + offset
+                if (not passable[neighbour]
+                        or fewest.get(neighbour, max_length + 1) <= count + 1):
+                    continue
+                dx = abs(neighbour % side - goal_x)
+                dy = abs(neighbour // side - goal_y)
+                # The goal must stay in reach of the steps left
+                if max(dx, dy) > max_length - count - 1:
+                    continue
+                if dx > dy:
+                    h = straight * dx + extra * dy
+                else:
+                    h = straight * dy + extra * dx
+                new_g = cost - minus_g
+                heappush(heap, (new_g + h, -new_g, count + 1, neighbour, path))
+        else:
+            self.expansions += expansions
+            return []
+
+        self.expansions += expansions
+        cells = []
+        while path[1] is not None:
+            cell = path[0]
+            cells.append((origin_x + cell % side, origin_y + cell // side))
+            path = path[1]
+        cells.reverse()
+        return cells
+
+
+class JumpPointSearch(AStar):
+    """ Jump point search over the same square as AStar. Every move costs
+        the same, so the search runs along the straight lines and the
+        diagonals and only stops on the cells where a wall or an entity
+        forces a turn, the jump points. Only the jump points go in the open
+        list, the cells in between are filled in when the path is rebuilt.
+        The jumps run up to the border of the square, a cheapest path too
+        long goes to the same second search as AStar, so the paths cost as
+        much as those of AStar """
+
+    def _jump_straight(self, cell, step, across, budget, goal):
+        """ Jump point reached from cell by straight steps, within budget
+            steps, as (cell, steps), None if a wall comes first """
+
+        passable = self.passable
+        for distance in range(1, budget + 1):
+            cell += step
+            if not passable[cell]:
+                return None
+            if cell == goal:
+                return (cell, distance)
+            # A blocked cell on a side opens a turn
+            if ((not passable[cell + across] and passable[cell + across + step])
+                    or (not passable[cell - across]
+                        and passable[cell - across + step])):
+                return (cell, distance)
+        return None
+
+    def _jump_diagonal(self, cell, step_x, step_y, budget, goal):
+        """ Jump point reached from cell by diagonal steps, within budget
+            steps, as (cell, steps), None if a wall comes first """
+
+        passable = self.passable
+        step = step_x + step_y
+        for distance in range(1, budget + 1):
+            cell += step
+            if not passable[cell]:
+                return None
+            if cell == goal:
+                return (cell, distance)
+            if ((not passable[cell - step_x] and passable[cell - step_x + step_y])
+                    or (not passable[cell - step_y]
+                        and passable[cell - step_y + step_x])):
+                return (cell, distance)
+            # A jump point in a straight line from here makes this cell
+            # one, the straight jumps are inlined as they run the most
+            left = budget - distance
+            for (straight, across) in ((step_x, step_y), (step_y, step_x)):
+                probe = cell
+                for i in range(left):
+                    probe += straight
+                    if not passable[probe]:
+                        break
+                    if (probe == goal
+                            or (not passable[probe + across]
+                                and passable[probe + across + straight])
+                            or (not passable[probe - across]
+                                and passable[probe - across + straight])):
+                        return (cell, distance)
+        return None
+
+    def _directions(self, current, parent_cell):
+        """ Moves worth trying from current when coming from parent_cell, as
+            (x step, y step) offsets """
+
+        side = self.side
+        passable = self.passable
+        if parent_cell < 0:
+            return [(dx, dy * side) for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                    if dx or dy]
+
+        dx = (current % side > parent_cell % side) - (current % side < parent_cell % side)
+        dy = ((current // side > parent_cell // side)
+              - (current // side < parent_cell // side)) * side
+        if dx and dy:
+            directions = [(dx, dy), (dx, 0), (0, dy)]
+            if not passable[current - dx]:
+                directions.append((-dx, dy))
+            if not passable[current - dy]:
+                directions.append((dx, -dy))
+        else:
+            # Straight move: the cells on the sides can be forced
+            across = side if dx else 1
+            directions = [(dx, dy)]
+            for side_step in (across, -across):
+                if not passable[current + side_step]:
+                    directions.append((dx or side_step, dy or side_step))
+        return directions
+
+    def compute(self, game_map, x, y, target_x, target_y, blocked=()):
+        """ Path from (x, y) to the target, avoiding the blocked tiles and
+            the cells in blocked. Returns the cells of the path after
+            (x, y), [] if there is none of at most max_length steps, None if
+            the target is too far for such a path """
+
+        side = self.side
+        size = self.size
+        max_length = self.max_length
+        origin_x = x - max_length - 1
+        origin_y = y - max_length - 1
+        goal_x = target_x - origin_x
+        goal_y = target_y - origin_y
+        self.expansions = 0
+        self.cut = False
+        if not (0 < goal_x < side - 1 and 0 < goal_y < side - 1):
+            return None
+
+        generation = self._next_generation()
+        self._fill_passable(game_map, origin_x, origin_y, blocked)
+        g = self.g
+        parent = self.parent
+        steps = self.steps
+        seen = self.seen
+        closed = self.closed
+        straight = self.STRAIGHT_COST
+        diagonal = self.diagonal_cost
+        extra = diagonal - straight
+        g_range = self.g_range
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+
+        start = (max_length + 1) * side + max_length + 1
+        goal = goal_y * side + goal_x
+        seen[start] = generation
+        g[start] = 0
+        parent[start] = -1
+        steps[start] = 0
+        heap = [start]
+        expansions = 0
+        # The jumps end on the border of the square at the latest
+        budget = side - 2
+
+        while heap:
+            current = heappop(heap) % size
+            if closed[current] == generation:
+                continue
+            closed[current] = generation
+
+            if current == goal:
+                break
+
+            expansions += 1
+            if steps[current] >= max_length:
+                self.cut = True
+
+            current_g = g[current]
+            for (step_x, step_y) in self._directions(current, parent[current]):
+                if step_x and step_y:
+                    jump = self._jump_diagonal(current, step_x, step_y,
+                                               budget, goal)
+                    cost = diagonal
+                else:
+                    jump = self._jump_straight(current, step_x + step_y,
+                                               side if step_x else 1,
+                                               budget, goal)
+                    cost = straight
+                if jump is None:
+                    continue
+                (neighbour, distance) = jump
+                if closed[neighbour] == generation:
+                    continue
+                new_g = current_g + cost * distance
+                if seen[neighbour] == generation and g[neighbour] <= new_g:
+                    continue
+                seen[neighbour] = generation
+                g[neighbour] = new_g
+                parent[neighbour] = current
+                steps[neighbour] = steps[current] + distance
+                dx = abs(neighbour % side - goal_x)
+                dy = abs(neighbour // side - goal_y)
+                if dx > dy:
+                    h = straight * dx + extra * dy
+                else:
+                    h = straight * dy + extra * dx
+                heappush(heap, ((new_g + h) * g_range - new_g) * size + neighbour)
+        else:
+            self.expansions = expansions
+            return []
+
+        self.expansions = expansions
+        if steps[goal] > max_length:
+            return self._short_path(origin_x, origin_y, goal_x, goal_y)
+
+        # Fill in the cells between the jump points
+        path = []
+        cell = goal
+        while cell != start:
+            previous = parent[cell]
+            dx = (cell % side > previous % side) - (cell % side < previous % side)
+            dy = (cell // side > previous // side) - (cell // side < previous // side)
+            step = dy * side + dx
+            while cell != previous:
+                path.append((origin_x + cell % side, origin_y + cell // side))
+                cell -= step
+        path.reverse()
+        return path
+
+
+# Engines usable by Entity.move_astar, by name
+PATHFINDERS = {"astar": AStar, "jps": JumpPointSearch}
+
+# Pathfinder of the monsters, its buffers are shared by all the searches
+pathfinder = AStar()
+
+
+def use_pathfinder(name):
+    """ Pick the engine behind Entity.move_astar """
+
+    global pathfinder
+    pathfinder = PATHFINDERS[name]()
+
+
+def pathfinder_name():
+    """ Name of the engine picked by use_pathfinder """
+
+    return [name for name, engine in PATHFINDERS.items()
+            if type(pathfinder) is engine][0]
+
+
+class FlowField:
+    """ Distances to a target cell from the square of radius cells around
+        it, with the moves costing as in AStar. Every cell keeps the next
+        cell toward the target, so all the monsters chasing the target share
+        one field and each of their moves is a lookup """
+
+    def __init__(self, game_map, target_x, target_y, radius=24):
+        self.radius = radius
+        self.side = side = 2 * radius + 3
+        self.size = size = side * side
+        self.origin_x = target_x - radius - 1
+        self.origin_y = target_y - radius - 1
+
+        self.passable = passable = bytearray(size)
+        fill_window(passable, side, game_map, self.origin_x, self.origin_y)
+        # Distance to the target and next cell toward it, -1 if unreached
+        self.distance = distance = array.array("i", [-1]) * size
+        self.next = following = array.array("i", [-1]) * size
+
+        moves = []
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                if dx or dy:
+                    moves.append((dy * side + dx,
+                                  pathfinder.diagonal_cost if dx and dy
+                                  else AStar.STRAIGHT_COST))
+        # Index offsets of the neighbours, to walk around a blocked cell
+        self.offsets = [offset for (offset, cost) in moves]
+
+        # Dijkstra from the target, the heap holds distance * size + cell
+        target = (radius + 1) * side + radius + 1
+        distance[target] = 0
+        heap = [target]
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+        while heap:
+            key = heappop(heap)
+            current = key % size
+            current_distance = key // size
+            if current_distance > distance[current]:
+                continue
+            for (offset, cost) in moves:
+                neighbour = current + offset
+                if not passable[neighbour]:
+                    continue
+                new_distance = current_distance + cost
+                if 0 <= distance[neighbour] <= new_distance:
+                    continue
+                distance[neighbour] = new_distance
+                following[neighbour] = current
+                heappush(heap, new_distance * size + neighbour)
+
+    def _cell(self, x, y):
+        """ Index of a map cell in the field, -1 outside of it """
+        x -= self.origin_x
+        y -= self.origin_y
+        if 0 < x < self.side - 1 and 0 < y < self.side - 1:
+            return y * self.side + x
+        return -1
+
+    def distance_at(self, x, y):
+        """ Distance from (x, y) to the target, -1 if out of reach """
+        cell = self._cell(x, y)
+        return self.distance[cell] if cell >= 0 else -1
+
+    def step(self, x, y, is_free):
+        """ Next cell from (x, y) toward the target, as (x, y), or None if
+            the target is out of reach. When is_free(x, y) rejects the next
+            cell, the free neighbour closest to the target is taken, and
+            (x, y) itself when no neighbour gets closer """
+
+        cell = self._cell(x, y)
+        if cell < 0 or self.next[cell] < 0:
+            return None
+
+        side = self.side
+        best = self.next[cell]
+        if not is_free(self.origin_x + best % side, self.origin_y + best // side):
+            # Walk around the monster in the way, or wait behind it
+            distance = self.distance
+            best = cell
+            for offset in self.offsets:
+                neighbour = cell + offset
+                if (0 <= distance[neighbour] < distance[best]
+                        and is_free(self.origin_x + neighbour % side,
+                                    self.origin_y + neighbour // side)):
+                    best = neighbour
+        return (self.origin_x + best % side, self.origin_y + best // side)
+
+
+class FlowFieldCache:
+    """ Flow fields of the last target cells of a map """
+
+    def __init__(self, size=8, radius=24):
+        self.size = size
+        self.radius = radius
+        self.game_map = None
+        self.fields = OrderedDict()
+
+    def get(self, game_map, target_x, target_y):
+        if game_map is not self.game_map:
+            self.game_map = game_map
+            self.fields.clear()
+
+        field = self.fields.get((target_x, target_y))
+        if field is None:
+            field = FlowField(game_map, target_x, target_y, self.radius)
+            path_stats.flow_fields += 1
+            self.fields[(target_x, target_y)] = field
+            if len(self.fields) > self.size:
+                self.fields.popitem(last=False)
+        else:
+            self.fields.move_to_end((target_x, target_y))
+        return field
+
+
+# Shared flow fields of the chasing monsters, None when every monster runs
+# its own pathfinding
+flow_fields = None
+
+
+def use_flow_fields(enabled=True):
+    """ Make the monsters chase along shared flow fields, or with
+        Entity.move_astar """
+
+    global flow_fields
+    flow_fields = FlowFieldCache() if enabled else None
+
+
+class DijkstraMap:
+    """ Distances to a set of goals over a rectangle of the map, every move
+        costing one step, diagonals included. Each goal has a starting
+        value, the lower the more attractive, and a cell gets the lowest
+        value of a goal plus its distance to it. Monsters roll down the map
+        with step().
+        The search runs on bitsets: the walkable cells are one int, with a
+        border of unwalkable cells, and each layer of cells at the same
+        distance is found at once by shifting the previous layer in the 8
+        directions """
+
+    UNREACHED = 2 ** 30
+    # Walkable bytes to the digits of the bitset
+    BITS = bytes.maketrans(b"\x00\x01", b"01")
+
+    def __init__(self, game_map, x, y, width, height):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        # Cell (x + i, y + j) is bit (j + 1) * stride + i + 1
+        self.stride = stride = width + 2
+        self.values = array.array("i", [self.UNREACHED]) * (stride * (height + 2))
+        # (value, bitset of the cells with this value), by increasing value
+        self.layers = []
+
+        walkable = game_map.walkable_cells()
+        rows = [bytes(stride)]
+        for map_y in range(y, y + height):
+            if not 0 <= map_y < game_map.height:
+                rows.append(bytes(stride))
+            elif walkable is not None:
+                start = map_y * game_map.width
+                row = bytearray(width)
+                x1 = max(x, 0)
+                x2 = min(x + width, game_map.width)
+                if x1 < x2:
+                    row[x1 - x:x2 - x] = walkable[start + x1:start + x2]
+                rows.append(b"\x00" + row + b"\x00")
+            else:
+                rows.append(b"\x00" + bytes([0 <= map_x < game_map.width
+                                              and not game_map.tiles[map_x][map_y].blocked
+                                              for map_x in range(x, x + width)])
+                            + b"\x00")
+        rows.append(bytes(stride))
+        # The first cell is the lowest bit
+        self.passable = int(b"".join(rows)[::-1].translate(self.BITS), 2)
+
+    def _bit(self, x, y):
+        """ Bit of a map cell, -1 outside of the rectangle """
+        x -= self.x
+        y -= self.y
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return (y + 1) * self.stride + x + 1
+        return -1
+
+    def compute(self, goals):
+        """ Fill the map from goals, (x, y, value) tuples """
+
+        starts = {}
+        for (x, y, value) in goals:
+            bit = self._bit(x, y)
+            if bit >= 0:
+                starts[value] = starts.get(value, 0) | 1 << bit
+        self._spread(starts)
+        path_stats.dijkstra_maps += 1
+        return self
+
+    def _spread(self, starts):
+        """ Grow the layers from the bitsets of starts, by value """
+
+        passable = self.passable
+        stride = self.stride
+        values = self.values
+        self.layers = layers = []
+        pending = sorted(starts)
+        reached = 0
+        frontier = 0
+        value = pending[0] if pending else 0
+
+        while frontier or pending:
+            if not frontier and pending[0] > value:
+                # Nothing left to grow before the next goals
+                value = pending[0]
+            if pending and pending[0] == value:
+                frontier |= starts[pending.pop(0)]
+            frontier &= passable & ~reached
+            if frontier:
+                reached |= frontier
+                layers.append((value, frontier))
+                frontier = ((frontier << 1) | (frontier >> 1)
+                            | (frontier << stride) | (frontier >> stride)
+                            | (frontier << stride + 1) | (frontier >> stride + 1)
+                            | (frontier << stride - 1) | (frontier >> stride - 1))
+            value += 1
+
+        for (value, layer) in layers:
+            bits = bin(layer)[:1:-1]
+            bit = bits.find("1")
+            while bit >= 0:
+                values[bit] = value
+                bit = bits.find("1", bit + 1)
+
+    def scaled(self, scale):
+        """ A map of the same rectangle whose goals are every reached cell,
+            with its value times scale. A negative scale makes a flee map:
+            its lowest cells are far from the goals of this one, and
+            rolling down it leads to open ground instead of the corners """
+
+        other = DijkstraMap.__new__(DijkstraMap)
+        other.x = self.x
+        other.y = self.y
+        other.width = self.width
+        other.height = self.height
+        other.stride = self.stride
+        other.passable = self.passable
+        other.values = array.array("i", [self.UNREACHED]) * len(self.values)
+
+        starts = {}
+        for (value, layer) in self.layers:
+            value = int(round(value * scale))
+            starts[value] = starts.get(value, 0) | layer
+        other._spread(starts)
+        path_stats.dijkstra_maps += 1
+        return other
+
+    def value_at(self, x, y):
+        """ Value of a cell, UNREACHED outside of the reached cells """
+        bit = self._bit(x, y)
+        return self.values[bit] if bit >= 0 else self.UNREACHED
+
+    def step(self, x, y, is_free):
+        """ Free neighbour of (x, y) with the lowest value, as (x, y), or
+            (x, y) itself when no free neighbour is lower. None if (x, y)
+            is out of the map """
+
+        bit = self._bit(x, y)
+        if bit < 0 or self.values[bit] == self.UNREACHED:
+            return None
+
+        values = self.values
+        stride = self.stride
+        best = (x, y)
+        best_value = values[bit]
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                value = values[bit + dy * stride + dx]
+                if value < best_value and is_free(x + dx, y + dy):
+                    best = (x + dx, y + dy)
+                    best_value = value
+        return best
+
+
+class AIFields:
+    """ Dijkstra maps shared by the monsters. A map only depends on the
+        walls and its goals, so it is computed the first time a monster
+        needs it and kept while its goals stay the same, whatever the
+        number of monsters using it """
+
+    # Flee maps are the approach maps times this, below -1 so that the
+    # monsters prefer getting away to staying in a corner
+    FLEE_SCALE = -1.2
+    # Half size of the maps of a map without walkable_cells(), around the
+    # target
+    RADIUS = 32
+
+    def __init__(self, size=8):
+        self.size = size
+        self.game_map = None
+        self.fields = OrderedDict()
+
+    def _get(self, game_map, key, make):
+        if game_map is not self.game_map:
+            self.game_map = game_map
+            self.fields.clear()
+
+        field = self.fields.get(key)
+        if field is None:
+            field = make()
+            self.fields[key] = field
+            if len(self.fields) > self.size:
+                self.fields.popitem(last=False)
+        else:
+            self.fields.move_to_end(key)
+        return field
+
+    def _region(self, game_map, target):
+        """ Rectangle of the maps: the whole map, or the square around the
+            target on the chunked world """
+
+        if game_map.walkable_cells() is not None:
+            return (0, 0, game_map.width, game_map.height)
+        return (target.x - self.RADIUS, target.y - self.RADIUS,
+                2 * self.RADIUS + 1, 2 * self.RADIUS + 1)
+
+    def approach(self, game_map, target):
+        """ Map leading to the target """
+
+        region = self._region(game_map, target)
+        return self._get(game_map, ("approach", target.x, target.y, region),
+                         lambda: DijkstraMap(game_map, *region)
+                         .compute([(target.x, target.y, 0)]))
+
+    def flee(self, game_map, target):
+        """ Map leading away from the target """
+
+        region = self._region(game_map, target)
+        return self._get(game_map, ("flee", target.x, target.y, region),
+                         lambda: self.approach(game_map, target)
+                         .scaled(self.FLEE_SCALE))
+
+    def items(self, game_map, entities, target):
+        """ Map leading to the closest item, the better healing ones
+            count as closer """
+
+        region = self._region(game_map, target)
+        goals = tuple([(entity.x, entity.y, -entity.item.healing)
+                       for entity in entities if entity.item])
+        return self._get(game_map, ("items", goals, region),
+                         lambda: DijkstraMap(game_map, *region).compute(goals))
+
+
+# Dijkstra maps of the monsters
+ai_fields = AIFields()
+
+
 class Entity:
     """ A generic object to represent players, enemies, items, etc. """
 
+    # A cached path is followed while its end stays this close to the
+    # target
+    PATH_TOLERANCE = 2
+
     def __init__(self,
                  x,
                  y,
@@ -366,6 +1810,14 @@ class Entity:
         self.fighter = fighter
         self.ai = ai
         self.item = item
+        # EntityIndex the entity belongs to, kept up to date by place()
+        self.index = None
+        # Rest of the last path computed by move_astar
+        self.path = []
+        # Whether self waited a turn for a monster on its path
+        self.waiting = False
+        # Waypoints of the last route planned across the rooms
+        self.route = []
 
         if self.fighter:
             self.fighter.owner = self
@@ -378,8 +1830,15 @@ class Entity:
 
     def move(self, dx, dy):
         """ Move the entity by a given amount """
-        self.x += dx
-        self.y += dy
+        self.place(self.x + dx, self.y + dy)
+
+    def place(self, x, y):
+        """ Put the entity at a given position """
+        if self.index:
+            self.index.move(self, x, y)
+        else:
+            self.x = x
+            self.y = y
 
     def move_towards(self, target_x, target_y, game_map, entities):
         """ Move the entity by a given amount toward a target """
@@ -395,62 +1854,207 @@ class Entity:
 
     def move_astar(self, target, entities, game_map):
         """ Pathfinding algo to chase the player """
-        # Create a FOV map that has the dimensions of the map
-        fov = libtcod.map_new(game_map.width, game_map.height)
-
-        # Scan the current map each turn and set all the walls as unwalkable
-        for y1 in range(game_map.height):
-            for x1 in range(game_map.width):
-                libtcod.map_set_properties(fov,
-                                           x1,
-                                           y1,
-                                           not game_map.tiles[x1][y1].block_sight,
-                                           not game_map.tiles[x1][y1].blocked)
-
-        # Scan all the objects to see if there are objects
-        # that must be navigated around
-        # Check also that the object isn't self or the target
-        # (so that the start and the end points are free)
-        # The AI class handles the situation if self is next to the target
-        # so it will not use this A* function anyway
-        for entity in entities:
-            if entity.blocks and entity != self and entity != target:
-                # Set the tile as a wall so it must be navigated around
-                libtcod.map_set_properties(fov, entity.x, entity.y, True, False)
-
-        # Allocate a A* path
-        # The 1.41 is the normal diagonal cost of moving,
-        # it can be set as 0.0 if diagonal moves are prohibited
-        my_path = libtcod.path_new_using_map(fov, 1.41)
-
-        # Compute the path between self's coordinates
-        # and the target's coordinates
-        libtcod.path_compute(my_path, self.x, self.y, target.x, target.y)
-
-        # Check if the path exists, and in this case,
-        # also the path is shorter than 25 tiles
-        # The path size matters if you want the monster to use
-        # alternative longer paths (for example through other rooms)
-        # if for example the player is in a corridor
-        # It makes sense to keep path size relatively low to keep the monsters
-        # from running around the map if there's an alternative path
-        # really far away
-        if not libtcod.path_is_empty(my_path) and libtcod.path_size(my_path) < 25:
-            # Find the next coordinates in the computed full path
-            x, y = libtcod.path_walk(my_path, True)
-            if x or y:
-                # Set self's coordinates to the next path tile
-                self.x = x
-                self.y = y
+        start = time.perf_counter_ns()
+        path_stats.calls += 1
+
+        # Keep following the path of the previous turns while it is good
+        if self._follow_path(target, entities):
+            path_stats.cache_hits += 1
+            path_stats.time_ns += time.perf_counter_ns() - start
+            return
+        self.path = []
+        self.waiting = False
+
+        # Paths are only followed when they are shorter than 25 tiles,
+        # such a path stays in the square of 24 tiles around self
+        radius = pathfinder.max_length
+        if self.index:
+            nearby = self.index.in_rect(self.x - radius,
+                                        self.y - radius,
+                                        2 * radius + 1,
+                                        2 * radius + 1)
+        else:
+            nearby = entities
+
+        # The other entities must be navigated around, self and the target
+        # are left out so that the start and the end points are free
+        blocked = set([(entity.x, entity.y) for entity in nearby
+                       if entity.blocks and entity != self and entity != target])
+
+        path = pathfinder.compute(game_map, self.x, self.y,
+                                  target.x, target.y, blocked)
+        path_stats.expansions += pathfinder.expansions
+
+        if path is None or (not path and pathfinder.cut):
+            # Too far for a short path, go through the rooms
+            planned = self._plan_path(target, game_map, blocked)
+            if planned:
+                path_stats.planned += 1
+                self.path = planned
+                self.place(*self.path.pop(0))
+                path_stats.time_ns += time.perf_counter_ns() - start
+                return
+
+        if path is None:
+            # Too far away for a short path
+            path_stats.fallbacks["far"] += 1
+        else:
+            path_stats.computed += 1
+            path_stats.cache_misses += 1
+
+        if path:
+            path_stats.found += 1
+            path_stats.path_length += len(path)
+            # Keep the whole path for the next turns
+            self.path = path
+            self.route = []
+            # Set self's coordinates to the next path tile
+            self.place(*self.path.pop(0))
         else:
             # Keep the old move fct as a backup so that if there are no paths
             # (for example another monster blocks a corridor)
             # it will still try to move towards the player
             # (closer to the corridor opening)
+            if path is not None:
+                if pathfinder.cut:
+                    path_stats.fallbacks["too_long"] += 1
+                else:
+                    path_stats.fallbacks["no_path"] += 1
             self.move_towards(target.x, target.y, game_map, entities)
 
-            # Delete the path to free memory
-        libtcod.path_delete(my_path)
+        path_stats.time_ns += time.perf_counter_ns() - start
+
+    def move_flow(self, target, entities, game_map):
+        """ Chase the target along the shared flow field of its cell,
+            move_astar is only used when self is out of the field """
+
+        start = time.perf_counter_ns()
+        field = flow_fields.get(game_map, target.x, target.y)
+
+        step = field.step(self.x, self.y, self._free_cells(entities))
+        if step is None:
+            path_stats.time_ns += time.perf_counter_ns() - start
+            self.move_astar(target, entities, game_map)
+            return
+
+        path_stats.calls += 1
+        if step == (self.x, self.y):
+            path_stats.flow_waits += 1
+        else:
+            path_stats.flow_moves += 1
+            self.place(*step)
+        path_stats.time_ns += time.perf_counter_ns() - start
+
+    def move_field(self, field, entities):
+        """ Roll down a Dijkstra map, around the blocking entities """
+
+        step = field.step(self.x, self.y, self._free_cells(entities))
+        if step is not None and step != (self.x, self.y):
+            self.place(*step)
+
+    def _free_cells(self, entities):
+        """ Function telling whether no entity blocks a cell """
+
+        def is_free(x, y):
+            if self.index:
+                cell = self.index.at(x, y)
+            else:
+                cell = [entity for entity in entities
+                        if entity.x == x and entity.y == y]
+            return not any(entity.blocks for entity in cell)
+        return is_free
+
+    def _plan_path(self, target, game_map, blocked):
+        """ Path to the furthest waypoint in reach on a route across the
+            rooms to the target """
+
+        graph = game_map.room_graph
+        if graph is None:
+            return None
+
+        # The route of the previous turns is kept while the target stays
+        # near its end
+        in_reach = self._route_in_reach(target)
+        if not in_reach:
+            self.route = graph.plan(self.x, self.y, target.x, target.y) or []
+            in_reach = self._route_in_reach(target)
+
+        for (x, y) in reversed(in_reach[-3:]):
+            path = pathfinder.compute(game_map, self.x, self.y, x, y, blocked)
+            path_stats.expansions += pathfinder.expansions
+            if path:
+                return path
+        return None
+
+    def _route_leads_to(self, target):
+        """ Whether the planned route still ends near the target """
+
+        if not self.route:
+            return False
+        (end_x, end_y) = self.route[-1]
+        return (max(abs(end_x - target.x), abs(end_y - target.y))
+                <= RoomGraph.WAYPOINT_SPACING)
+
+    def _route_in_reach(self, target):
+        """ Waypoints of the route in reach of the pathfinder, if the route
+            still leads to the target """
+
+        if not self._route_leads_to(target):
+            return []
+
+        in_reach = []
+        for (x, y) in self.route:
+            if max(abs(x - self.x), abs(y - self.y)) <= pathfinder.max_length:
+                in_reach.append((x, y))
+            elif in_reach:
+                break
+        return in_reach
+
+    def _follow_path(self, target, entities):
+        """ Take the next step of the cached path if it still starts next
+            to self, ends close to the target or on its route, and no
+            entity blocks its next cell for more than a turn """
+
+        path = self.path
+        if not path:
+            return False
+        # The target stepped on the path, which now ends under it
+        if (target.x, target.y) in path:
+            del path[path.index((target.x, target.y)) + 1:]
+
+        (x, y) = path[0]
+        (end_x, end_y) = path[-1]
+        if max(abs(x - self.x), abs(y - self.y)) != 1:
+            return False
+        # The path leads to the target, or to a waypoint of a route that
+        # still does
+        if (max(abs(end_x - target.x), abs(end_y - target.y)) > self.PATH_TOLERANCE
+                and ((end_x, end_y) not in self.route
+                     or not self._route_leads_to(target))):
+            return False
+
+        # The walls don't change, only the entities can block the path,
+        # the target only at the end of it. The entities further along will
+        # most likely have moved on when self gets there, only the next
+        # cell is looked at. A monster there is waited for one turn, it is
+        # most likely going the same way
+        if self.index:
+            cell = self.index.at(x, y)
+        else:
+            cell = [entity for entity in entities
+                    if entity.x == x and entity.y == y]
+        blockers = [entity for entity in cell
+                    if entity.blocks and (entity != target
+                                          or (x, y) != (end_x, end_y))]
+        if blockers:
+            if self.waiting or not all(entity.ai for entity in blockers):
+                return False
+            self.waiting = True
+            return True
+
+        self.waiting = False
+        self.place(*path.pop(0))
+        return True
 
     def distance_to(self, other):
         """ Give the distance between the current entity and another one """
@@ -468,6 +2072,52 @@ def get_blocking_entities_at_location(entities, destination_x, destination_y):
     return None
 
 
+class EntityIndex:
+    """ Spatial index of the entities, by map cell """
+
+    def __init__(self, entities=()):
+        self.cells = {}
+        for entity in entities:
+            self.add(entity)
+
+    def add(self, entity):
+        entity.index = self
+        self.cells.setdefault((entity.x, entity.y), []).append(entity)
+
+    def remove(self, entity):
+        entity.index = None
+        cell = self.cells[(entity.x, entity.y)]
+        cell.remove(entity)
+        if not cell:
+            del self.cells[(entity.x, entity.y)]
+
+    def move(self, entity, x, y):
+        """ Move an entity of the index to another cell """
+        self.remove(entity)
+        entity.x = x
+        entity.y = y
+        self.add(entity)
+
+    def at(self, x, y):
+        """ Entities in a cell """
+        return self.cells.get((x, y), [])
+
+    def in_rect(self, x, y, w, h):
+        """ Entities in a rectangle, looked up cell by cell or entity by
+            entity, whichever is shorter """
+
+        found = []
+        if w * h < len(self.cells):
+            for cy in range(y, y + h):
+                for cx in range(x, x + w):
+                    found.extend(self.cells.get((cx, cy), []))
+        else:
+            for (cx, cy), cell in self.cells.items():
+                if x <= cx < x + w and y <= cy < y + h:
+                    found.extend(cell)
+        return found
+
+
 class Rect:
     """ Base shape for room creation """
 
@@ -489,6 +2139,136 @@ class Rect:
                 and self.y1 <= other.y2 and self.y2 >= other.y1)
 
 
+class RoomGraph:
+    """ Rooms made by make_map and the tunnels linking them.
+        The nodes are the rooms and the cells where tunnels cross, the
+        edges the stretches of tunnel between them, with their cells from
+        the exit of a node to the entry of the other. Long routes are
+        planned over this graph, the pathfinder then only has to join the
+        waypoints along the route """
+
+    # Cells between the waypoints along a route
+    WAYPOINT_SPACING = 8
+
+    def __init__(self, rooms, tunnels):
+        """ tunnels are the cells dug from the center of a room to the
+            center of another one """
+
+        self.rooms = rooms
+        self.tunnels = tunnels
+        # Inner cell -> room index
+        self.room_cells = {}
+        for i, room in enumerate(rooms):
+            for x in range(room.x1 + 1, room.x2):
+                for y in range(room.y1 + 1, room.y2):
+                    self.room_cells[(x, y)] = i
+        # Node -> list of (other node, cells to it)
+        self.edges = {}
+        # Tunnel cell outside the rooms -> (node, its cell, other node,
+        # its cell, cells of the stretch, index of the cell)
+        self.corridors = {}
+
+        # Tunnels often run over each other, the network only branches
+        # where a cell has more than two tunnel neighbours
+        neighbours = {}
+        for cells in tunnels:
+            for previous_cell, cell in zip(cells, cells[1:]):
+                if previous_cell != cell:
+                    neighbours.setdefault(cell, set()).add(previous_cell)
+                    neighbours.setdefault(previous_cell, set()).add(cell)
+        self.junctions = set([cell for (cell, around) in neighbours.items()
+                              if len(around) > 2 and self.room_at(*cell) is None])
+
+        seen = set()
+        for cells in tunnels:
+            node = None
+            node_cell = None
+            stretch = []
+            for cell in cells:
+                here = self.room_at(*cell)
+                if here is None and cell in self.junctions:
+                    here = cell
+                if here is None:
+                    stretch.append(cell)
+                    continue
+                if (here != node and node is not None
+                        and (node_cell, cell) not in seen):
+                    seen.add((node_cell, cell))
+                    seen.add((cell, node_cell))
+                    self.edges.setdefault(node, []).append((here, stretch + [cell]))
+                    self.edges.setdefault(here, []).append((node, stretch[::-1] + [node_cell]))
+                    for i, corridor_cell in enumerate(stretch):
+                        self.corridors[corridor_cell] = (node, node_cell, here,
+                                                          cell, stretch, i)
+                node = here
+                node_cell = cell
+                stretch = []
+
+    def room_at(self, x, y):
+        return self.room_cells.get((x, y))
+
+    def _nodes_at(self, x, y):
+        """ Nodes a cell belongs to, with the cells from it to them """
+
+        room = self.room_at(x, y)
+        if room is not None:
+            return {room: []}
+        if (x, y) in self.junctions:
+            return {(x, y): []}
+        if (x, y) not in self.corridors:
+            return {}
+        (node, node_cell, other_node, other_cell,
+         stretch, i) = self.corridors[(x, y)]
+        return {node: stretch[i - 1::-1] + [node_cell] if i else [node_cell],
+                other_node: stretch[i + 1:] + [other_cell]}
+
+    def plan(self, x, y, target_x, target_y):
+        """ Waypoints from (x, y) to the target along the tunnels, None if
+            either end is outside the rooms and tunnels """
+
+        starts = self._nodes_at(x, y)
+        goals = self._nodes_at(target_x, target_y)
+        if not starts or not goals:
+            return None
+
+        # Dijkstra from node to node, the nodes are rooms (ints) and
+        # junctions (cells)
+        distances = dict([(node, len(cells)) for (node, cells) in starts.items()])
+        previous = {}
+        heap = [(distance, i, node)
+                for i, (node, distance) in enumerate(distances.items())]
+        heapq.heapify(heap)
+        count = len(heap)
+        while heap:
+            distance, i, node = heapq.heappop(heap)
+            if distance > distances[node]:
+                continue
+            if node in goals:
+                break
+            for (other_node, cells) in self.edges.get(node, ()):
+                new_distance = distance + len(cells)
+                if new_distance < distances.get(other_node, new_distance + 1):
+                    distances[other_node] = new_distance
+                    previous[other_node] = (node, cells)
+                    count += 1
+                    heapq.heappush(heap, (new_distance, count, other_node))
+        else:
+            return None
+
+        # Cells from the target back to the start
+        path = [(target_x, target_y)] + goals[node][-2::-1]
+        while node in previous:
+            node, cells = previous[node]
+            path.extend(cells[::-1])
+        path.extend(starts[node][::-1])
+        path.reverse()
+
+        waypoints = path[self.WAYPOINT_SPACING - 1::self.WAYPOINT_SPACING]
+        if not waypoints or waypoints[-1] != path[-1]:
+            waypoints.append(path[-1])
+        return waypoints
+
+
 class Tile:
     """ A tile on the map.
         It may or may not be blocked,
@@ -500,17 +2280,122 @@ class Tile:
         if block_sight is None:
             block_sight = blocked
         self.block_sight = block_sight
-        # Specify if the tile has been explored by the player or not
-        self.explored = False
+
+
+class ExploredMask:
+    """ Cells of the map explored by the player,
+        one bit per cell, row after row """
+
+    def __init__(self, width, height, bits=None):
+        self.width = width
+        self.height = height
+        if bits is None:
+            bits = (width * height + 7) // 8
+        self.bits = bytearray(bits)
+        # Number of updates that explored new cells
+        self.changes = 0
+
+    def set(self, x, y):
+        i = y * self.width + x
+        if not self.bits[i >> 3] & (0x80 >> (i & 7)):
+            self.bits[i >> 3] |= 0x80 >> (i & 7)
+            self.changes += 1
+
+    def test(self, x, y):
+        i = y * self.width + x
+        return self.bits[i >> 3] & (0x80 >> (i & 7)) != 0
+
+    def or_mask(self, other):
+        """ Add the cells explored in another mask of the same size """
+
+        explored = (int.from_bytes(self.bits, "big")
+                    | int.from_bytes(other.bits, "big"))
+        if explored != int.from_bytes(self.bits, "big"):
+            self.bits[:] = explored.to_bytes(len(self.bits), "big")
+            self.changes += 1
+
+    def or_rect(self, x, y, w, h, rows):
+        """ Add the cells set in a rectangle mask: rows[j] holds row y + j,
+            cell x + i being bit w - 1 - i """
+
+        for j, row in enumerate(rows):
+            if not row:
+                continue
+            start = (y + j) * self.width + x
+            first = start >> 3
+            last = (start + w - 1) >> 3
+            shift = (last + 1) * 8 - (start + w)
+            old_segment = int.from_bytes(self.bits[first:last + 1], "big")
+            segment = old_segment | row << shift
+            if segment != old_segment:
+                self.bits[first:last + 1] = segment.to_bytes(last - first + 1,
+                                                             "big")
+                self.changes += 1
+
+    def _bit_string(self):
+        bits = bin(int.from_bytes(b"\x01" + bytes(self.bits), "big"))[3:]
+        return bits[:self.width * self.height]
+
+    def runs(self):
+        """ Lengths of the alternating runs of unexplored and explored
+            cells, row after row, starting with unexplored cells """
+
+        runs = [len(run) for run in re.findall("0+|1+", self._bit_string())]
+        if self.bits and self.bits[0] & 0x80:
+            runs.insert(0, 0)
+        return runs
+
+    def to_rle(self):
+        """ Run-length encoded snapshot, the runs as varints """
+
+        data = bytearray()
+        for run in self.runs():
+            while run >= 0x80:
+                data.append(run & 0x7f | 0x80)
+                run >>= 7
+            data.append(run)
+        return bytes(data)
+
+    @classmethod
+    def from_rle(cls, width, height, data):
+        """ Mask from a snapshot made by to_rle """
+
+        runs = []
+        run = shift = 0
+        for byte in data:
+            run |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                runs.append(run)
+                run = shift = 0
+
+        bits = "".join(("1" if i % 2 else "0") * run
+                       for i, run in enumerate(runs))
+        bits += "0" * (-len(bits) % 8)
+        size = (width * height + 7) // 8
+        return cls(width, height,
+                   int("1" + bits, 2).to_bytes(len(bits) // 8 + 1, "big")[1:]
+                   .ljust(size, b"\0"))
 
 
 class GameMap:
     """ Game map creation """
 
+    # Monster stats as (hp, defense, power), healing of the items
+    SMALL_MONSTER_STATS = (10, 0, 3)
+    BIG_MONSTER_STATS = (16, 1, 4)
+    ITEM_HEALING = 5
+    # Monsters running FieldMonster instead of BasicMonster
+    FIELD_AI = False
+
     def __init__(self, width, height):
         self.width = width
         self.height = height
         self.tiles = self._initialize_tiles()
+        self.explored = ExploredMask(width, height)
+        self.walkable = None
+        # Rooms and tunnels made by make_map
+        self.room_graph = None
 
     def _initialize_tiles(self):
         tiles = [[Tile(True) for y in range(self.height)]
@@ -519,19 +2404,20 @@ class GameMap:
 
     def make_map(self, max_rooms, room_min_size, room_max_size,
                  map_width, map_height, player, entities,
-                 max_monsters_per_room, max_items_per_room):
-        """ Procedural generation of the rooms """
+                 max_monsters_per_room, max_items_per_room, rng=random):
+        """ Procedural generation of the rooms, drawing from rng """
 
         rooms = []
         num_rooms = 0
+        tunnels = []
 
         for r in range(max_rooms):
             # Random width and height
-            w = randint(room_min_size, room_max_size)
-            h = randint(room_min_size, room_max_size)
+            w = rng.randint(room_min_size, room_max_size)
+            h = rng.randint(room_min_size, room_max_size)
             # Random position without going out of the boundaries of the map
-            x = randint(0, map_width - w - 1)
-            y = randint(0, map_height - h - 1)
+            x = rng.randint(0, map_width - w - 1)
+            y = rng.randint(0, map_height - h - 1)
             # Creation of the room
             new_room = Rect(x, y, w, h)
             # Run through the other rooms and see if they
@@ -556,24 +2442,47 @@ class GameMap:
                     # Center coordinates of the previous room
                     (prev_x, prev_y) = rooms[num_rooms - 1].center()
                     # Flip a coin
-                    if randint(0, 1) == 1:
+                    if rng.randint(0, 1) == 1:
                         # First move horizontally, then vertically
                         self.create_h_tunnel(prev_x, new_x, prev_y)
                         self.create_v_tunnel(prev_y, new_y, new_x)
+                        corner = (new_x, prev_y)
                     else:
                         # First move vertically, then horizontally
                         self.create_v_tunnel(prev_y, new_y, prev_x)
                         self.create_h_tunnel(prev_x, new_x, new_y)
+                        corner = (prev_x, new_y)
+
+                    tunnels.append(self._tunnel_cells((prev_x, prev_y),
+                                                      corner,
+                                                      (new_x, new_y)))
 
                 self.place_entities(new_room,
                                     entities,
                                     max_monsters_per_room,
-                                    max_items_per_room)
+                                    max_items_per_room,
+                                    rng)
 
                 # Finally, append the new room to the list
                 rooms.append(new_room)
                 num_rooms += 1
 
+        self.room_graph = RoomGraph(rooms, tunnels)
+
+    def _tunnel_cells(self, start, corner, end):
+        """ Cells of a tunnel dug from start to end, turning at corner """
+
+        cells = []
+        for (x1, y1), (x2, y2) in ((start, corner), (corner, end)):
+            dx = (x2 > x1) - (x2 < x1)
+            dy = (y2 > y1) - (y2 < y1)
+            while (x1, y1) != (x2, y2):
+                cells.append((x1, y1))
+                x1 += dx
+                y1 += dy
+        cells.append(end)
+        return cells
+
     def create_room(self, room):
         """ Go through the tiles in the rectangle and make them passable """
 
@@ -600,23 +2509,24 @@ class GameMap:
                        room,
                        entities,
                        max_monsters_per_room,
-                       max_items_per_room):
+                       max_items_per_room,
+                       rng=random):
         """ Place entities in the rooms """
 
         # Get a random number of monsters and items
-        number_of_monster = randint(0, max_monsters_per_room)
-        number_of_items = randint(0, max_items_per_room)
+        number_of_monster = rng.randint(0, max_monsters_per_room)
+        number_of_items = rng.randint(0, max_items_per_room)
 
         for i in range(number_of_monster):
             # Choose a random location in the room
-            x = randint(room.x1 + 1, room.x2 - 1)
-            y = randint(room.y1 + 1, room.y2 - 1)
+            x = rng.randint(room.x1 + 1, room.x2 - 1)
+            y = rng.randint(room.y1 + 1, room.y2 - 1)
 
             if not any([entity for entity in entities
                         if entity.x == x and entity.y == y]):
-                if randint(0, 100) < 80:
-                    fighter_component = Fighter(hp=10, defense=0, power=3)
-                    ai_component = BasicMonster()
+                if rng.randint(0, 100) < 80:
+                    fighter_component = Fighter(*self.SMALL_MONSTER_STATS)
+                    ai_component = FieldMonster() if self.FIELD_AI else BasicMonster()
                     monster = Entity(x,
                                      y,
                                      "#",
@@ -627,8 +2537,8 @@ class GameMap:
                                      fighter=fighter_component,
                                      ai=ai_component)
                 else:
-                    fighter_component = Fighter(hp=16, defense=1, power=4)
-                    ai_component = BasicMonster()
+                    fighter_component = Fighter(*self.BIG_MONSTER_STATS)
+                    ai_component = FieldMonster() if self.FIELD_AI else BasicMonster()
                     monster = Entity(x,
                                      y,
                                      "&",
@@ -642,12 +2552,12 @@ class GameMap:
                 entities.append(monster)
 
         for i in range(number_of_items):
-            x = randint(room.x1 + 1, room.x2 - 1)
-            y = randint(room.y1 + 1, room.y2 - 1)
+            x = rng.randint(room.x1 + 1, room.x2 - 1)
+            y = rng.randint(room.y1 + 1, room.y2 - 1)
 
             if not any([entity for entity in entities
                         if entity.x == x and entity.y == y]):
-                item_component = Item(healing=5)
+                item_component = Item(healing=self.ITEM_HEALING)
                 item = Entity(x,
                               y,
                               '!',
@@ -663,6 +2573,274 @@ class GameMap:
             return True
         return False
 
+    def walkable_cells(self):
+        """ Walkable tiles, one byte per tile row after row.
+            Built on the first call, the tiles don't change once the map
+            is made """
+
+        if self.walkable is None:
+            self.walkable = bytearray([not self.tiles[x][y].blocked
+                                       for y in range(self.height)
+                                       for x in range(self.width)])
+        return self.walkable
+
+    def update_chunks(self, x, y, entities, entity_index):
+        """ Nothing to do, the whole map is generated by make_map """
+        pass
+
+
+class Chunk:
+    """ Square piece of a ChunkedGameMap, with the entities standing on it
+        when it was generated or saved """
+
+    def __init__(self, cx, cy, size):
+        self.cx = cx
+        self.cy = cy
+        self.tiles = [[Tile(True) for y in range(size)] for x in range(size)]
+        self.explored = ExploredMask(size, size)
+        self.entities = []
+        # Center of the first room
+        self.start = None
+
+
+class _ChunkedColumn:
+    """ Column x of a ChunkedGameMap, as in game_map.tiles[x] """
+
+    def __init__(self, game_map, x):
+        self.game_map = game_map
+        self.x = x
+
+    def __getitem__(self, y):
+        size = self.game_map.chunk_size
+        chunk = self.game_map.get_chunk(self.x // size, y // size)
+        return chunk.tiles[self.x % size][y % size]
+
+
+class _ChunkedTiles:
+    """ Gives access to the tiles of a ChunkedGameMap as
+        game_map.tiles[x][y], whichever chunk they are in """
+
+    def __init__(self, game_map):
+        self.game_map = game_map
+
+    def __getitem__(self, x):
+        return _ChunkedColumn(self.game_map, x)
+
+
+class _ChunkedExplored:
+    """ Gives access to the ExploredMask of each chunk of a ChunkedGameMap
+        as if it was one mask """
+
+    def __init__(self, game_map):
+        self.game_map = game_map
+
+    def _chunk_mask(self, x, y):
+        size = self.game_map.chunk_size
+        chunk = self.game_map.get_chunk(x // size, y // size)
+        return chunk.explored, x % size, y % size
+
+    def set(self, x, y):
+        mask, x, y = self._chunk_mask(x, y)
+        mask.set(x, y)
+
+    def test(self, x, y):
+        mask, x, y = self._chunk_mask(x, y)
+        return mask.test(x, y)
+
+    def or_rect(self, x, y, w, h, rows):
+        for j, row in enumerate(rows):
+            for i in range(w):
+                if row >> (w - 1 - i) & 1:
+                    self.set(x + i, y + j)
+
+
+class ChunkedGameMap(GameMap):
+    """ Game map generated chunk by chunk as the player gets near them.
+        Each chunk is generated from the seed of the map and its position,
+        so it is always the same. The chunks used the least recently are
+        saved to disk with their entities and dropped from memory """
+
+    def __init__(self, width, height, seed, chunk_size=32, max_chunks=64,
+                 cache_dir=None):
+        # Round the map up to whole chunks
+        self.chunk_size = chunk_size
+        self.width = -(-width // chunk_size) * chunk_size
+        self.height = -(-height // chunk_size) * chunk_size
+        self.seed = seed
+        self.max_chunks = max_chunks
+        self.chunks = OrderedDict()
+        self.tiles = _ChunkedTiles(self)
+        self.explored = _ChunkedExplored(self)
+        # Entities of the chunks loaded since the last update_chunks
+        self.new_entities = []
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp(prefix="selen-chunks-")
+        self.cache_dir = cache_dir
+        self.generation = None
+        # The rooms of the chunks are not kept as a graph
+        self.room_graph = None
+
+    def make_map(self, max_rooms, room_min_size, room_max_size,
+                 map_width, map_height, player, entities,
+                 max_monsters_per_room, max_items_per_room, rng=None):
+        """ Only generate the chunk in the middle of the map,
+            and start the player in its first room. The chunks draw from
+            their own generators, rng is not used """
+
+        self.generation = (max_rooms, room_min_size, room_max_size,
+                           max_monsters_per_room, max_items_per_room)
+
+        size = self.chunk_size
+        chunk = self.get_chunk(self.width // size // 2,
+                               self.height // size // 2)
+        (player.x, player.y) = chunk.start
+        self.update_chunks(player.x, player.y, entities, None)
+
+    def walkable_cells(self):
+        """ Too large to copy, the pathfinding reads the tiles """
+        return None
+
+    def _chunk_file(self, cx, cy):
+        return os.path.join(self.cache_dir, f"{cx}_{cy}.chunk")
+
+    def get_chunk(self, cx, cy):
+        """ Returns a chunk, loading or generating it if needed """
+
+        chunk = self.chunks.get((cx, cy))
+        if chunk is not None:
+            self.chunks.move_to_end((cx, cy))
+            return chunk
+
+        filename = self._chunk_file(cx, cy)
+        if os.path.exists(filename):
+            with open(filename, "rb") as f:
+                chunk = pickle.load(f)
+            os.remove(filename)
+            self.chunks[(cx, cy)] = chunk
+        else:
+            chunk = Chunk(cx, cy, self.chunk_size)
+            # Registered before generating, as carving goes through tiles
+            self.chunks[(cx, cy)] = chunk
+            self._generate_chunk(chunk)
+
+        # The entities join the game on the next update_chunks
+        self.new_entities.extend(chunk.entities)
+        chunk.entities = []
+        return chunk
+
+    def _connector(self, direction, cx, cy):
+        """ Offset along the edge of the tunnel between chunk cx, cy and its
+            neighbour to the east ("e") or to the south ("s"),
+            the same from both sides """
+
+        rng = random.Random(f"{self.seed}:{direction}:{cx}:{cy}")
+        return rng.randint(2, self.chunk_size - 3)
+
+    def _generate_chunk(self, chunk):
+        """ Procedural generation of the rooms of a chunk,
+            with tunnels to the neighbouring chunks """
+
+        (max_rooms, room_min_size, room_max_size,
+         max_monsters_per_room, max_items_per_room) = self.generation
+        rng = random.Random(f"{self.seed}:{chunk.cx}:{chunk.cy}")
+        size = self.chunk_size
+        x0 = chunk.cx * size
+        y0 = chunk.cy * size
+
+        rooms = []
+        for r in range(max_rooms):
+            w = rng.randint(room_min_size, room_max_size)
+            h = rng.randint(room_min_size, room_max_size)
+            x = rng.randint(x0, x0 + size - w - 1)
+            y = rng.randint(y0, y0 + size - h - 1)
+            new_room = Rect(x, y, w, h)
+
+            if any(new_room.intersect(other_room) for other_room in rooms):
+                continue
+
+            self.create_room(new_room)
+            (new_x, new_y) = new_room.center()
+            if rooms:
+                (prev_x, prev_y) = rooms[-1].center()
+                if rng.randint(0, 1) == 1:
+                    self.create_h_tunnel(prev_x, new_x, prev_y)
+                    self.create_v_tunnel(prev_y, new_y, new_x)
+                else:
+                    self.create_v_tunnel(prev_y, new_y, prev_x)
+                    self.create_h_tunnel(prev_x, new_x, new_y)
+
+            self.place_entities(new_room,
+                                chunk.entities,
+                                max_monsters_per_room,
+                                max_items_per_room,
+                                rng)
+            rooms.append(new_room)
+
+        # Link the first room to the middle of each edge shared with
+        # another chunk, the neighbour digs the other half of the tunnel
+        (start_x, start_y) = rooms[0].center()
+        chunk.start = (start_x, start_y)
+        last_cx = self.width // size - 1
+        last_cy = self.height // size - 1
+        if chunk.cx > 0:
+            y = y0 + self._connector("e", chunk.cx - 1, chunk.cy)
+            self.create_h_tunnel(x0, start_x, y)
+            self.create_v_tunnel(y, start_y, start_x)
+        if chunk.cx < last_cx:
+            y = y0 + self._connector("e", chunk.cx, chunk.cy)
+            self.create_h_tunnel(start_x, x0 + size - 1, y)
+            self.create_v_tunnel(y, start_y, start_x)
+        if chunk.cy > 0:
+            x = x0 + self._connector("s", chunk.cx, chunk.cy - 1)
+            self.create_v_tunnel(y0, start_y, x)
+            self.create_h_tunnel(x, start_x, start_y)
+        if chunk.cy < last_cy:
+            x = x0 + self._connector("s", chunk.cx, chunk.cy)
+            self.create_v_tunnel(start_y, y0 + size - 1, x)
+            self.create_h_tunnel(x, start_x, start_y)
+
+    def _save_chunk(self, chunk, entities, entity_index):
+        """ Write a chunk to disk with the entities standing on it,
+            and take them out of the game """
+
+        size = self.chunk_size
+        chunk.entities = [entity for entity in entities
+                          if entity.x // size == chunk.cx
+                          and entity.y // size == chunk.cy]
+        for entity in chunk.entities:
+            entities.remove(entity)
+            if entity_index:
+                entity_index.remove(entity)
+
+        with open(self._chunk_file(chunk.cx, chunk.cy), "wb") as f:
+            pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+
+    def update_chunks(self, x, y, entities, entity_index, horizon=1):
+        """ Load the chunks around x, y, bring the entities of the newly
+            loaded chunks in the game and save the least recently used
+            chunks to disk. To be called between turns, as it changes the
+            entities list """
+
+        size = self.chunk_size
+        for cy in range(y // size - horizon, y // size + horizon + 1):
+            for cx in range(x // size - horizon, x // size + horizon + 1):
+                if 0 <= cx < self.width // size and 0 <= cy < self.height // size:
+                    self.get_chunk(cx, cy)
+
+        for entity in self.new_entities:
+            entities.append(entity)
+            if entity_index:
+                entity_index.add(entity)
+        self.new_entities = []
+
+        while len(self.chunks) > self.max_chunks:
+            (cx, cy), chunk = self.chunks.popitem(last=False)
+            self._save_chunk(chunk, entities, entity_index)
+
+    def close(self):
+        """ Remove the chunks saved to disk """
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
 
 class Message:
     def __init__(self, text, color=libtcod.darkest_grey):
@@ -691,28 +2869,434 @@ class MessageLog:
             self.messages.append(Message(line, message.color))
 
 
-def main():
-    # pygame sound system init
-    pygame.mixer.init(44100)
-    sound_hurt = pygame.mixer.Sound("sound_selen_aie.wav")
-    sound_holala = pygame.mixer.Sound("sound_selen_holala.wav")
-    sound_nightmare = pygame.mixer.Sound("sound_nightmares.wav")
-    sound_steps = pygame.mixer.Sound("pas2.wav")
-    sound_steps.set_volume(0.5)
-    pygame.mixer.music.load("theme.wav")
-    pygame.mixer.music.set_volume(0.5)
+class SoundDispatcher:
+    """ Play the sounds through a fixed pool of mixer channels.
+        The sounds queued during a turn are played once per sound type
+        by flush(), with a cooldown and a cap on simultaneous instances.
+        This is the only user of pygame, so the game runs headless
+        without it """
+
+    def __init__(self, num_channels=8, cooldown=0.1, max_instances=2,
+                 frequency=44100):
+        import pygame
+        self.mixer = pygame.mixer
+        self.mixer.init(frequency)
+        self.mixer.set_num_channels(num_channels)
+        self.channels = [self.mixer.Channel(i) for i in range(num_channels)]
+        self.cooldown = cooldown
+        self.max_instances = max_instances
+        self.sounds = {}
+        self.last_played = {}
+        self.queued = []
+
+    def load(self, name, filename, volume=1.0, cooldown=None,
+             max_instances=None):
+        """ Load a sound file, played by queuing its name """
+
+        sound = self.mixer.Sound(filename)
+        sound.set_volume(volume)
+        if cooldown is None:
+            cooldown = self.cooldown
+        if max_instances is None:
+            max_instances = self.max_instances
+        self.sounds[name] = (sound, cooldown, max_instances)
+        self.last_played[name] = None
+
+    def play_music(self, filename, volume=1.0):
+        """ Loop a music, streamed from the file rather than decoded up
+            front """
+
+        self.mixer.music.load(filename)
+        self.mixer.music.set_volume(volume)
+        self.mixer.music.play(-1)
+
+    def stop_music(self):
+        self.mixer.music.stop()
+
+    def queue(self, name):
+        """ Ask for a sound to be played at the end of the turn """
+
+        # Several requests for the same sound in one turn give one playback
+        if name not in self.queued:
+            self.queued.append(name)
+
+    def flush(self):
+        """ Play the sounds queued during the turn """
+
+        now = time.monotonic()
+
+        for name in self.queued:
+            sound, cooldown, max_instances = self.sounds[name]
+
+            last_played = self.last_played[name]
+            if last_played is not None and now - last_played < cooldown:
+                continue
+
+            playing = 0
+            free_channel = None
+            for channel in self.channels:
+                if not channel.get_busy():
+                    if free_channel is None:
+                        free_channel = channel
+                elif channel.get_sound() is sound:
+                    playing += 1
+
+            # Drop the sound rather than waiting for a channel
+            if free_channel is None or playing >= max_instances:
+                continue
+
+            free_channel.play(sound)
+            self.last_played[name] = now
+
+        self.queued = []
+
+    def observe(self, session, events):
+        """ Observer of a GameSession, playing the sounds of a turn """
+
+        for event in events:
+            name = event.get("sound")
+            if name:
+                self.queue(name)
+        self.flush()
+
+
+# Save file layout, all numbers little-endian:
+# - header (SAVE_HEADER)
+# - blocked and block_sight bitmaps, one bit per tile row after row,
+#   first tile in the highest bit
+# - explored mask, run-length encoded (ExploredMask.to_rle)
+# - string table: entity names and message texts, utf-8, separated by \0
+# - entity table, one column after the other (ENTITY_COLUMNS)
+# - message table, one column after the other (MESSAGE_COLUMNS)
+# - room table, one column after the other (ROOM_COLUMNS)
+# - number of cells of each tunnel, then the x and the y columns of the
+#   cells of all the tunnels (TUNNEL_COLUMNS)
+SAVE_MAGIC = b"SELN"
+SAVE_VERSION = 4
+SAVE_HEADER = struct.Struct("<4sHIIIIIIIIBiiIII")
+
+ENTITY_COLUMNS = [("x", "i"),
+                  ("y", "i"),
+                  ("char", "I"),
+                  ("r", "B"),
+                  ("g", "B"),
+                  ("b", "B"),
+                  ("name", "I"),
+                  ("flags", "B"),
+                  ("render_order", "B"),
+                  ("max_hp", "i"),
+                  ("hp", "i"),
+                  ("defense", "i"),
+                  ("power", "i"),
+                  ("healing", "i"),
+                  ("ai", "B")]
+
+MESSAGE_COLUMNS = [("text", "I"),
+                   ("r", "B"),
+                   ("g", "B"),
+                   ("b", "B")]
+
+ROOM_COLUMNS = [("x1", "i"),
+                ("y1", "i"),
+                ("x2", "i"),
+                ("y2", "i")]
+
+TUNNEL_COLUMNS = [("x", "i"),
+                  ("y", "i")]
+
+# Entity flags
+BLOCKS = 1
+HAS_FIGHTER = 2
+HAS_AI = 4
+HAS_ITEM = 8
+
+# The AI classes, by the code of the "ai" column
+AI_KINDS = [BasicMonster, FieldMonster]
+
+
+def _pack_bits(values):
+    """ Pack a sequence of booleans, 8 per byte """
+
+    bits = "".join(["1" if value else "0" for value in values])
+    bits += "0" * (-len(bits) % 8)
+    return int("1" + bits, 2).to_bytes(len(bits) // 8 + 1, "big")[1:]
+
+
+def _unpack_bits(data, count):
+    """ Unpack count booleans packed by _pack_bits """
+
+    bits = bin(int.from_bytes(b"\x01" + bytes(data), "big"))[3:]
+    return [bit == "1" for bit in bits[:count]]
+
+
+def _column_bytes(typecode, values):
+    column = array.array(typecode, values)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column.tobytes()
+
+
+def _read_column(view, offset, typecode, count):
+    column = array.array(typecode)
+    column.frombytes(view[offset:offset + count * column.itemsize])
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column, offset + count * column.itemsize
+
+
+def save_game(filename, game_map, entities, player, message_log,
+              game_state, fov_radius, move_count):
+    """ Write the map with its rooms and tunnels, the entities and the
+        message log to a save file """
+
+    strings = []
+    string_ids = {}
+
+    def string_id(text):
+        if text not in string_ids:
+            string_ids[text] = len(strings)
+            strings.append(text)
+        return string_ids[text]
+
+    columns = {name: [] for (name, typecode) in ENTITY_COLUMNS}
+    for entity in entities:
+        flags = 0
+        if entity.blocks:
+            flags |= BLOCKS
+        if entity.fighter:
+            flags |= HAS_FIGHTER
+        if entity.ai:
+            flags |= HAS_AI
+        if entity.item:
+            flags |= HAS_ITEM
+        fighter = entity.fighter or Fighter(0, 0, 0)
+        columns["x"].append(entity.x)
+        columns["y"].append(entity.y)
+        columns["char"].append(ord(entity.char))
+        columns["r"].append(entity.color.r)
+        columns["g"].append(entity.color.g)
+        columns["b"].append(entity.color.b)
+        columns["name"].append(string_id(entity.name))
+        columns["flags"].append(flags)
+        columns["render_order"].append(entity.render_order.value)
+        columns["max_hp"].append(fighter.max_hp)
+        columns["hp"].append(fighter.hp)
+        columns["defense"].append(fighter.defense)
+        columns["power"].append(fighter.power)
+        columns["healing"].append(entity.item.healing if entity.item else 0)
+        columns["ai"].append(AI_KINDS.index(type(entity.ai)) if entity.ai else 0)
+
+    messages = message_log.messages if message_log else []
+    message_columns = {name: [] for (name, typecode) in MESSAGE_COLUMNS}
+    for message in messages:
+        message_columns["text"].append(string_id(message.text))
+        message_columns["r"].append(message.color.r)
+        message_columns["g"].append(message.color.g)
+        message_columns["b"].append(message.color.b)
+
+    # The rooms and tunnels of the level, to plan the long routes again
+    graph = game_map.room_graph
+    rooms = graph.rooms if graph else []
+    tunnels = graph.tunnels if graph else []
+    room_columns = {"x1": [room.x1 for room in rooms],
+                    "y1": [room.y1 for room in rooms],
+                    "x2": [room.x2 for room in rooms],
+                    "y2": [room.y2 for room in rooms]}
+    tunnel_cells = [cell for cells in tunnels for cell in cells]
+    tunnel_columns = {"x": [x for (x, y) in tunnel_cells],
+                      "y": [y for (x, y) in tunnel_cells]}
+
+    tiles = [game_map.tiles[x][y]
+             for y in range(game_map.height) for x in range(game_map.width)]
+    explored = game_map.explored.to_rle()
+    string_table = "\0".join(strings).encode("utf-8")
+
+    sections = [SAVE_HEADER.pack(SAVE_MAGIC,
+                                 SAVE_VERSION,
+                                 game_map.width,
+                                 game_map.height,
+                                 len(explored),
+                                 len(entities),
+                                 len(strings),
+                                 len(string_table),
+                                 len(messages),
+                                 entities.index(player),
+                                 game_state.value,
+                                 fov_radius,
+                                 move_count,
+                                 len(rooms),
+                                 len(tunnels),
+                                 len(tunnel_cells)),
+                _pack_bits([tile.blocked for tile in tiles]),
+                _pack_bits([tile.block_sight for tile in tiles]),
+                explored,
+                string_table]
+    sections.extend(_column_bytes(typecode, columns[name])
+                    for (name, typecode) in ENTITY_COLUMNS)
+    sections.extend(_column_bytes(typecode, message_columns[name])
+                    for (name, typecode) in MESSAGE_COLUMNS)
+    sections.extend(_column_bytes(typecode, room_columns[name])
+                    for (name, typecode) in ROOM_COLUMNS)
+    sections.append(_column_bytes("I", [len(cells) for cells in tunnels]))
+    sections.extend(_column_bytes(typecode, tunnel_columns[name])
+                    for (name, typecode) in TUNNEL_COLUMNS)
+
+    # Written next to the save and moved over it once complete, a crash
+    # while writing leaves the previous save
+    size = sum(len(section) for section in sections)
+    temporary = filename + ".tmp"
+    with open(temporary, "w+b") as f:
+        f.truncate(size)
+        with mmap.mmap(f.fileno(), size) as mapped:
+            offset = 0
+            for section in sections:
+                mapped[offset:offset + len(section)] = section
+                offset += len(section)
+            mapped.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, filename)
+
+
+def load_game(filename, message_log):
+    """ Read a save file written by save_game.
+        Returns the map, the entities, the player, the game state,
+        the FOV radius and the moves count, the messages go in message_log
+        if given """
+
+    with open(filename, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        try:
+            (magic, version, width, height, explored_size, num_entities,
+             num_strings,
+             strings_size, num_messages, player_id, game_state, fov_radius,
+             move_count, num_rooms, num_tunnels,
+             num_tunnel_cells) = SAVE_HEADER.unpack_from(view)
+            if magic != SAVE_MAGIC or version != SAVE_VERSION:
+                raise ValueError(f"{filename} is not a save file of this version")
+            offset = SAVE_HEADER.size
+
+            num_tiles = width * height
+            bitmap_size = (num_tiles + 7) // 8
+            bitmaps = []
+            for i in range(2):
+                bitmaps.append(_unpack_bits(view[offset:offset + bitmap_size],
+                                            num_tiles))
+                offset += bitmap_size
+            explored = bytes(view[offset:offset + explored_size])
+            offset += explored_size
+
+            strings = bytes(view[offset:offset + strings_size]).decode("utf-8")
+            strings = strings.split("\0") if num_strings else []
+            offset += strings_size
+
+            columns = {}
+            for (name, typecode) in ENTITY_COLUMNS:
+                columns[name], offset = _read_column(view, offset, typecode,
+                                                     num_entities)
+            message_columns = {}
+            for (name, typecode) in MESSAGE_COLUMNS:
+                message_columns[name], offset = _read_column(view, offset,
+                                                             typecode,
+                                                             num_messages)
+            room_columns = {}
+            for (name, typecode) in ROOM_COLUMNS:
+                room_columns[name], offset = _read_column(view, offset,
+                                                          typecode, num_rooms)
+            tunnel_sizes, offset = _read_column(view, offset, "I", num_tunnels)
+            tunnel_columns = {}
+            for (name, typecode) in TUNNEL_COLUMNS:
+                tunnel_columns[name], offset = _read_column(view, offset,
+                                                            typecode,
+                                                            num_tunnel_cells)
+        finally:
+            view.release()
+
+    game_map = GameMap(width, height)
+    (blocked, block_sight) = bitmaps
+    i = 0
+    for y in range(height):
+        for x in range(width):
+            game_map.tiles[x][y].blocked = blocked[i]
+            game_map.tiles[x][y].block_sight = block_sight[i]
+            i += 1
+    game_map.explored = ExploredMask.from_rle(width, height, explored)
+    if num_rooms:
+        rooms = [Rect(x1, y1, x2 - x1, y2 - y1)
+                 for (x1, y1, x2, y2) in zip(room_columns["x1"],
+                                             room_columns["y1"],
+                                             room_columns["x2"],
+                                             room_columns["y2"])]
+        cells = list(zip(tunnel_columns["x"], tunnel_columns["y"]))
+        tunnels = []
+        start = 0
+        for size in tunnel_sizes:
+            tunnels.append(cells[start:start + size])
+            start += size
+        game_map.room_graph = RoomGraph(rooms, tunnels)
+
+    entities = []
+    for i in range(num_entities):
+        flags = columns["flags"][i]
+        fighter = None
+        if flags & HAS_FIGHTER:
+            fighter = Fighter(columns["max_hp"][i],
+                              columns["defense"][i],
+                              columns["power"][i])
+            fighter.hp = columns["hp"][i]
+        entities.append(Entity(columns["x"][i],
+                               columns["y"][i],
+                               chr(columns["char"][i]),
+                               libtcod.Color(columns["r"][i],
+                                             columns["g"][i],
+                                             columns["b"][i]),
+                               strings[columns["name"][i]],
+                               blocks=bool(flags & BLOCKS),
+                               render_order=RenderOrder(columns["render_order"][i]),
+                               fighter=fighter,
+                               ai=AI_KINDS[columns["ai"][i]]() if flags & HAS_AI else None,
+                               item=Item(columns["healing"][i]) if flags & HAS_ITEM else None))
+
+    if message_log:
+        message_log.messages = [Message(strings[message_columns["text"][i]],
+                                        libtcod.Color(message_columns["r"][i],
+                                                      message_columns["g"][i],
+                                                      message_columns["b"][i]))
+                                for i in range(num_messages)]
+
+    return (game_map, entities, entities[player_id], GameStates(game_state),
+            fov_radius, move_count)
+
+
+def sound_file(filename):
+    """ Prefer the compressed version of a sound built by build_assets.py,
+        fall back to the WAV file """
+
+    compressed = os.path.splitext(filename)[0] + ".ogg"
+    if os.path.exists(compressed):
+        return compressed
+    return filename
+
+
+class SessionSound:
+    """ Stand-in for a sound in a GameSession: play() only records an
+        event, the audio observer decides what to actually play """
+
+    def __init__(self, session, name):
+        self.session = session
+        self.name = name
+
+    def play(self):
+        self.session.events.append({"sound": self.name})
+
+
+class GameSession:
+    """ A game played turn by turn, without window, input or sound.
+        step() plays an action of the player, as returned by handle_keys,
+        then the turn of the monsters, and returns the events of the turn.
+        Rendering and audio are observers called with these events, so
+        bots and replays can drive the game headless """
 
-    # Const definition
-    SCREEN_WIDTH = 80
-    SCREEN_HEIGHT = 50
-    BAR_WIDTH = 20
-    PANEL_HEIGHT = 7
-    PANEL_Y = SCREEN_HEIGHT - PANEL_HEIGHT
-    MESSAGE_X = BAR_WIDTH + 2
-    MESSAGE_WIDTH = SCREEN_WIDTH - BAR_WIDTH - 2
-    MESSAGE_HEIGHT = PANEL_HEIGHT - 1
-    MAP_WIDTH = 80
-    MAP_HEIGHT = 43
     ROOM_MAX_SIZE = 10
     ROOM_MIN_SIZE = 6
     MAX_ROOMS = 30
@@ -720,12 +3304,547 @@ def main():
     FOV_LIGHT_WALLS = True
     FOV_RADIUS = 6
     FOV_MONSTER_RADIUS = 3
+    # The FOV radius decreases every FOV_DECAY_MOVES moves
+    FOV_DECAY_MOVES = 8
+    FOV_MIN_RADIUS = 3
     MAX_MONSTERS_PER_ROOM = 3
     MAX_ITEMS_PER_ROOM = 2
+    # Player stats as (hp, defense, power)
+    PLAYER_STATS = (30, 2, 5)
+
+    def __init__(self, map_width=80, map_height=43, seed=None,
+                 message_log=None, chunked=False, world_width=4096,
+                 world_height=4096, stats=None):
+        # The whole game follows from the seed, through a generator of the
+        # session so that other sessions and the random module don't
+        # change it
+        if seed is None:
+            seed = randint(0, 2 ** 31)
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+        # Stat tables overriding the constants of the session and of the
+        # map, by name
+        self.stats = stats or {}
+        self.check_stats(self.stats)
+        for name, value in self.stats.items():
+            setattr(self, name, value)
+
+        # Entities init
+        fighter_component = Fighter(*self.PLAYER_STATS)
+        player = Entity(0,
+                        0,
+                        "@",
+                        libtcod.white,
+                        "Selen",
+                        blocks=True,
+                        render_order=RenderOrder.ACTOR,
+                        fighter=fighter_component)
+        entities = [player]
+
+        # Game's map init
+        if chunked:
+            game_map = ChunkedGameMap(world_width, world_height, seed=seed)
+        else:
+            game_map = GameMap(map_width, map_height)
+        for name, value in self.stats.items():
+            if hasattr(game_map, name):
+                setattr(game_map, name, value)
+        game_map.make_map(self.MAX_ROOMS,
+                          self.ROOM_MIN_SIZE,
+                          self.ROOM_MAX_SIZE,
+                          map_width,
+                          map_height,
+                          player,
+                          entities,
+                          self.MAX_MONSTERS_PER_ROOM,
+                          self.MAX_ITEMS_PER_ROOM,
+                          self.rng)
+
+        self._start(game_map, entities, player, message_log,
+                    GameStates.PLAYER_TURN, self.FOV_RADIUS, 0)
+
+    @staticmethod
+    def check_stats(stats):
+        """ Raise ValueError for a stat that is neither a constant of
+            GameSession nor of GameMap, it would change nothing """
+
+        unknown = [name for name in stats
+                   if not (name.isupper() and (hasattr(GameSession, name)
+                                               or hasattr(GameMap, name)))]
+        if unknown:
+            raise ValueError(f"Unknown stats: {', '.join(sorted(unknown))}")
+
+    @classmethod
+    def load(cls, filename, message_log):
+        """ Resume a session saved by save() """
+
+        session = cls.__new__(cls)
+        session.seed = None
+        session.rng = random.Random()
+        session.stats = {}
+        (game_map, entities, player, game_state,
+         fov_radius, move_count) = load_game(filename, message_log)
+        session._start(game_map, entities, player, message_log,
+                       game_state, fov_radius, move_count)
+        return session
+
+    def _start(self, game_map, entities, player, message_log, game_state,
+               fov_radius, move_count):
+        self.game_map = game_map
+        self.entities = entities
+        self.player = player
+        # Without a message log the messages are only sent as events
+        self.message_log = message_log
+        self.game_state = game_state
+        # FOV radius decrease variables
+        self.fov_radius = fov_radius
+        self.move_count = move_count
+
+        self.entity_index = EntityIndex(entities)
+        self.fov_map = initialize_fov(game_map)
+        self.fov_monster_map = initialize_fov(game_map)
+
+        self.observers = []
+        self.events = []
+        self.sound_hurt = SessionSound(self, "hurt")
+        self.sound_holala = SessionSound(self, "holala")
+        self.sound_nightmare = SessionSound(self, "nightmare")
+        self.sound_steps = SessionSound(self, "steps")
+
+        self._update_fov()
+
+    def _update_fov(self):
+        start = profiler.begin()
+        player = self.player
+        self.game_map.update_chunks(player.x, player.y, self.entities,
+                                    self.entity_index)
+        recompute_fov(self.fov_map,
+                      player.x,
+                      player.y,
+                      self.fov_radius,
+                      self.FOV_LIGHT_WALLS,
+                      self.FOV_ALGORITHM)
+        self.game_map.explored.or_rect(*self.fov_map.visible_rect(player.x,
+                                                                  player.y,
+                                                                  self.fov_radius))
+        recompute_fov(self.fov_monster_map,
+                      player.x,
+                      player.y,
+                      self.FOV_MONSTER_RADIUS,
+                      self.FOV_LIGHT_WALLS,
+                      self.FOV_ALGORITHM)
+        self.events.append({"fov_recompute": True})
+        profiler.end("fov", start)
+
+    def _message(self, message):
+        if self.message_log:
+            self.message_log.add_message(message)
+        self.events.append({"message": message})
+
+    def _handle_results(self, results):
+        for result in results:
+            message = result.get("message")
+            dead_entity = result.get("dead")
+
+            if message:
+                self._message(message)
+
+            if dead_entity:
+                if dead_entity == self.player:
+                    message, self.game_state = kill_player(dead_entity)
+                else:
+                    message = kill_monster(dead_entity)
+                self._message(message)
+                self.events.append({"dead": dead_entity})
+
+    def step(self, action):
+        """ Play an action of the player and the turn of the monsters.
+            Returns the events of the turn, also sent to the observers """
+
+        self.events = []
+        player = self.player
+
+        move = action.get("move")
+        pickup = action.get("pickup")
+
+        if move and self.game_state == GameStates.PLAYER_TURN:
+            dx, dy = move
+            destination_x = player.x + dx
+            destination_y = player.y + dy
+
+            if not self.game_map.is_blocked(destination_x, destination_y):
+                target = get_blocking_entities_at_location(self.entities,
+                                                           destination_x,
+                                                           destination_y)
+
+                if target:
+                    self._handle_results(player.fighter.attack(target,
+                                                               self.sound_nightmare))
+                else:
+                    player.move(dx, dy)
+                    self.sound_steps.play()
+                    # FOV radius decrease
+                    self.move_count += 1
+                    if self.move_count >= self.FOV_DECAY_MOVES:
+                        self.move_count = 0
+                        self.fov_radius -= 1
+                    if self.fov_radius <= self.FOV_MIN_RADIUS:
+                        self.fov_radius = self.FOV_MIN_RADIUS
+                    self._update_fov()
+
+                self.game_state = GameStates.ENEMY_TURN
+
+        elif pickup and self.game_state == GameStates.PLAYER_TURN:
+            for entity in self.entities:
+                if entity.item and entity.x == player.x and entity.y == player.y:
+                    message, self.fov_radius = use_item(entity,
+                                                        player,
+                                                        self.fov_radius,
+                                                        self.FOV_RADIUS,
+                                                        self.sound_holala)
+                    self._message(message)
+                    self.events.append({"item": entity})
+
+        if self.game_state == GameStates.ENEMY_TURN:
+            start = profiler.begin()
+            for entity in self.entities:
+                if entity.ai:
+                    self._handle_results(entity.ai.take_turn(player,
+                                                             self.fov_monster_map,
+                                                             self.game_map,
+                                                             self.entities,
+                                                             self.sound_hurt))
+                    if self.game_state == GameStates.PLAYER_DEAD:
+                        break
+            else:
+                self.game_state = GameStates.PLAYER_TURN
+            profiler.end("enemies", start)
+
+        events = self.events
+        for observer in self.observers:
+            observer(self, events)
+        return events
+
+    def reload(self):
+        """ Save the session and load it back, as the game does when it is
+            quit and resumed: what the save leaves out, like the paths
+            planned by the monsters, is lost. Replays reload where the
+            recording was resumed, to play the same game """
+
+        (fd, filename) = tempfile.mkstemp(suffix=".dat")
+        os.close(fd)
+        try:
+            self.save(filename)
+            (game_map, entities, player, game_state,
+             fov_radius, move_count) = load_game(filename, self.message_log)
+        finally:
+            os.remove(filename)
+        for name, value in self.stats.items():
+            if hasattr(game_map, name):
+                setattr(game_map, name, value)
+
+        observers = self.observers
+        self._start(game_map, entities, player, self.message_log,
+                    game_state, fov_radius, move_count)
+        self.observers = observers
+        events = self.events
+        events.append({"reload": True})
+        for observer in observers:
+            observer(self, events)
+
+    def save(self, filename):
+        """ Save the session, without message log the save has no
+            messages """
+
+        save_game(filename,
+                  self.game_map,
+                  self.entities,
+                  self.player,
+                  self.message_log,
+                  self.game_state,
+                  self.fov_radius,
+                  self.move_count)
+
+    def close(self):
+        """ Delete the chunk cache of a chunked world, the world is not
+            kept between sessions """
+
+        if isinstance(self.game_map, ChunkedGameMap):
+            self.game_map.close()
+
+
+class SessionRenderer:
+    """ Draw a GameSession on the root console.
+        As an observer of the session, it only redraws the map after the
+        turns that changed the field of view """
+
+    def __init__(self, session, screen_width, screen_height, bar_width,
+                 panel_height, colors, minimap_width=20, minimap_height=11):
+        self.session = session
+        self.screen_width = screen_width
+        self.screen_height = screen_height
+        self.bar_width = bar_width
+        self.panel_height = panel_height
+        self.panel_y = screen_height - panel_height
+        self.colors = colors
+
+        # Creation of the consoles
+        self.con = libtcod.console_new(screen_width, screen_height)
+        self.panel = libtcod.console_new(screen_width, panel_height)
+
+        game_map = session.game_map
+        self.camera = Camera(screen_width, self.panel_y,
+                             game_map.width, game_map.height)
+
+        # Regions of the screen to update on each frame
+        self.dirty = DirtyRects()
+
+        # Minimap of the level, not for the chunked world
+        self.minimap = None
+        if not isinstance(game_map, ChunkedGameMap):
+            self.minimap = Minimap(game_map, minimap_width, minimap_height,
+                                   colors)
+        self.minimap_x = self.camera.width - minimap_width - 1
+        self.minimap_y = 1
+
+        # Percentiles of the frame profiler, shown with the "p" key, the
+        # overlay grows with its longest line
+        self.profiler_visible = False
+        self.profiler_console = None
+        self.profiler_width = 40
+        self.profiler_height = len(profiler.lines())
+
+        self.fov_recompute = True
+
+    def __call__(self, session, events):
+        for event in events:
+            if event.get("fov_recompute"):
+                self.fov_recompute = True
+            if event.get("reload"):
+                # Same level, new objects
+                if self.minimap:
+                    self.minimap.game_map = session.game_map
+                    self.minimap.explored_changes = None
+                self.dirty.add_everything()
+
+    def draw(self, mouse):
+        """ Draw the session on the root console """
+
+        session = self.session
+        player = session.player
+
+        if self.fov_recompute:
+            self.camera.update(player)
+            self.dirty.add_fov(*self.camera.to_screen(player.x, player.y),
+                               session.fov_radius)
+
+        render_all(self.con,
+                   self.panel,
+                   session.entity_index,
+                   player,
+                   session.game_map,
+                   session.fov_map,
+                   self.fov_recompute,
+                   session.message_log,
+                   self.screen_width,
+                   self.screen_height,
+                   self.bar_width,
+                   self.panel_height,
+                   self.panel_y,
+                   mouse,
+                   self.colors,
+                   self.dirty,
+                   self.camera)
+
+        self.fov_recompute = False
+
+        # The minimap goes over the map
+        if self.minimap and self.minimap.visible:
+            self.minimap.update(player, session.entity_index,
+                                session.fov_map, session.fov_radius)
+            self.minimap.blit(self.minimap_x, self.minimap_y)
+
+        if self.profiler_visible:
+            lines = profiler.lines()
+            width = min(max([len(line) for line in lines]),
+                        self.screen_width - 1)
+            if width > self.profiler_width or len(lines) > self.profiler_height:
+                # The counters outgrew the overlay, make it larger
+                libtcod.console_delete(self.profiler_console)
+                self.profiler_width = max(width, self.profiler_width)
+                self.profiler_height = max(len(lines), self.profiler_height)
+                self.profiler_console = libtcod.console_new(self.profiler_width,
+                                                            self.profiler_height)
+            profiler.draw(self.profiler_console, lines)
+            libtcod.console_blit(self.profiler_console, 0, 0,
+                                 self.profiler_width, self.profiler_height,
+                                 0, 1, 1)
+
+    def clear(self):
+        """ Clear entities (to avoid trailing traces) """
+
+        clear_all(self.con, self.session.entity_index, self.camera)
+
+    def toggle_minimap(self):
+        if self.minimap:
+            self.minimap.visible = not self.minimap.visible
+            if not self.minimap.visible:
+                # Show the map under the minimap again
+                self.dirty.add(self.minimap_x, self.minimap_y,
+                               self.minimap.width, self.minimap.height)
+
+    def toggle_profiler(self):
+        self.profiler_visible = not self.profiler_visible
+        profiler.set_enabled(self.profiler_visible)
+        if self.profiler_visible:
+            if self.profiler_console is None:
+                self.profiler_console = libtcod.console_new(self.profiler_width,
+                                                            self.profiler_height)
+        else:
+            self.dirty.add(1, 1, self.profiler_width, self.profiler_height)
+
+
+# Recording layout, all numbers little-endian:
+# - header (REPLAY_HEADER): magic, version, seed, map size, chunked world,
+#   name of the pathfinder padded with \0, chase along flow fields
+# - one record (REPLAY_RECORD) per frame where the player did something or
+#   the mouse moved to another cell: action code, mouse cell
+# A resumed session appends to the recording of the session it resumes
+REPLAY_MAGIC = b"SELR"
+REPLAY_VERSION = 3
+REPLAY_HEADER = struct.Struct("<4sHIiiB8sB")
+REPLAY_RECORD = struct.Struct("<Bhh")
+
+# The actions of handle_keys, by code
+REPLAY_ACTIONS = [{},
+                  {"move": (0, -1)},
+                  {"move": (0, 1)},
+                  {"move": (-1, 0)},
+                  {"move": (1, 0)},
+                  {"move": (-1, -1)},
+                  {"move": (1, -1)},
+                  {"move": (-1, 1)},
+                  {"move": (1, 1)},
+                  {"pickup": True},
+                  {"minimap": True},
+                  {"fullscreen": True},
+                  {"exit": True},
+                  {"profiler": True}]
+
+
+class Recorder:
+    """ Record the actions of the player and the mouse cell, with the
+        pathfinder in use and whether the monsters chase along flow fields.
+        Each record is flushed right away, so a crash loses nothing """
+
+    def __init__(self, filename, seed=None, map_width=0, map_height=0,
+                 chunked=False):
+        if seed is not None:
+            # New session, new recording
+            self.file = open(filename, "wb")
+            self.file.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION,
+                                               seed, map_width, map_height,
+                                               chunked,
+                                               pathfinder_name().encode("ascii"),
+                                               flow_fields is not None))
+            self.file.flush()
+        else:
+            self.file = open(filename, "ab")
+        self.mouse_cell = None
+
+    def record(self, action, mouse):
+        cell = (mouse.cx, mouse.cy)
+        if not action and cell == self.mouse_cell:
+            return
+        self.mouse_cell = cell
+        self.file.write(REPLAY_RECORD.pack(REPLAY_ACTIONS.index(action),
+                                           *cell))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_recording(filename):
+    """ Read a recording written by Recorder.
+        Returns the seed, the map size, whether the world is chunked, the
+        name of the pathfinder, whether the monsters chase along flow
+        fields and the records as (action, mouse x, mouse y) """
+
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    (magic, version, seed, map_width, map_height,
+     chunked, engine, flow) = REPLAY_HEADER.unpack_from(data)
+    if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+        raise ValueError(f"{filename} is not a recording of this version")
+    engine = engine.rstrip(b"\0").decode("ascii")
+    if engine not in PATHFINDERS:
+        raise ValueError(f"{filename} was made with an unknown pathfinder "
+                         f"{engine}")
+
+    # A record cut by a crash is dropped
+    end = len(data) - (len(data) - REPLAY_HEADER.size) % REPLAY_RECORD.size
+    records = [(REPLAY_ACTIONS[code], cx, cy)
+               for (code, cx, cy) in REPLAY_RECORD.iter_unpack(
+                   data[REPLAY_HEADER.size:end])]
+
+    return (seed, map_width, map_height, bool(chunked), engine, bool(flow),
+            records)
+
+
+def replay_headless(filename):
+    """ Replay a recording without window nor sound, as fast as possible,
+        with the pathfinder and the flow fields it was made with.
+        Returns the session at the end and the time taken by the turns """
+
+    (seed, map_width, map_height, chunked, engine, flow,
+     records) = read_recording(filename)
+    use_pathfinder(engine)
+    use_flow_fields(flow)
+    session = GameSession(map_width, map_height, seed=seed, chunked=chunked)
+
+    start = time.perf_counter()
+    # The mouse cells only change the names shown under the mouse, nothing
+    # to replay without a window
+    for record in records:
+        action = record[0]
+        if action.get("exit"):
+            # The game was saved and quit, the records that follow are
+            # the resumed session
+            if not chunked:
+                session.reload()
+        else:
+            session.step(action)
+    elapsed = time.perf_counter() - start
+
+    session.close()
+    return session, elapsed
+
+
+def main(record_file="session.rec", replay_file=None, profile_file=None,
+         chunked_world=False):
+    """ Play the game, recording it in record_file, or replay replay_file
+        as fast as possible. The frame times go to profile_file if given.
+        With chunked_world, a new game is played on a large world generated
+        chunk by chunk around the player instead of a single level """
 
-    # FOV radius decrease variables
-    fov_radius_change = FOV_RADIUS
-    count = 0
+    # Const definition
+    SCREEN_WIDTH = 80
+    SCREEN_HEIGHT = 50
+    BAR_WIDTH = 20
+    PANEL_HEIGHT = 7
+    MESSAGE_X = BAR_WIDTH + 2
+    MESSAGE_WIDTH = SCREEN_WIDTH - BAR_WIDTH - 2
+    MESSAGE_HEIGHT = PANEL_HEIGHT - 1
+    MAP_WIDTH = 80
+    MAP_HEIGHT = 43
+    WORLD_WIDTH = 4096
+    WORLD_HEIGHT = 4096
+    SAVE_FILE = "savegame.dat"
+    MINIMAP_WIDTH = 20
+    MINIMAP_HEIGHT = 11
 
     # Colors dict
     colors = {
@@ -735,17 +3854,14 @@ def main():
         "light_ground": libtcod.lightest_sepia,
     }
 
-    # Entities init
-    fighter_component = Fighter(hp=30, defense=2, power=5)
-    player = Entity(0,
-                    0,
-                    "@",
-                    libtcod.white,
-                    "Selen",
-                    blocks=True,
-                    render_order=RenderOrder.ACTOR,
-                    fighter=fighter_component)
-    entities = [player]
+    sounds = None
+    if not replay_file:
+        # pygame sound system init
+        sounds = SoundDispatcher()
+        sounds.load("hurt", sound_file("sound_selen_aie.wav"))
+        sounds.load("holala", sound_file("sound_selen_holala.wav"))
+        sounds.load("nightmare", sound_file("sound_nightmares.wav"))
+        sounds.load("steps", sound_file("pas2.wav"), volume=0.5)
 
     # Font setting
     libtcod.console_set_custom_font("arial10x10.png",
@@ -758,182 +3874,182 @@ def main():
                               "Selen dans les limbes",
                               False)
 
-    # Creation of the consoles
-    con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
-    panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
-
-    # Game's map init
-    game_map = GameMap(MAP_WIDTH, MAP_HEIGHT)
-    game_map.make_map(MAX_ROOMS,
-                      ROOM_MIN_SIZE,
-                      ROOM_MAX_SIZE,
-                      MAP_WIDTH,
-                      MAP_HEIGHT,
-                      player,
-                      entities,
-                      MAX_MONSTERS_PER_ROOM,
-                      MAX_ITEMS_PER_ROOM)
-
-    # field of view init
-    fov_recompute = True
-    fov_map = initialize_fov(game_map)
-    fov_monster_map = initialize_fov(game_map)
-
     # message log init
     message_log = MessageLog(MESSAGE_X, MESSAGE_WIDTH, MESSAGE_HEIGHT)
 
+    recorder = None
+    records = None
+    if replay_file:
+        (seed, map_width, map_height, chunked, engine, flow,
+         records) = read_recording(replay_file)
+        use_pathfinder(engine)
+        use_flow_fields(flow)
+        session = GameSession(map_width,
+                              map_height,
+                              seed=seed,
+                              message_log=message_log,
+                              chunked=chunked,
+                              world_width=WORLD_WIDTH,
+                              world_height=WORLD_HEIGHT)
+        records = iter(records)
+    elif not chunked_world and os.path.exists(SAVE_FILE):
+        # Resume the saved session, and its recording
+        session = GameSession.load(SAVE_FILE, message_log)
+        if os.path.exists(record_file):
+            # The recording goes on with its own pathfinding
+            recording = read_recording(record_file)
+            use_pathfinder(recording[4])
+            use_flow_fields(recording[5])
+            recorder = Recorder(record_file)
+    else:
+        session = GameSession(MAP_WIDTH,
+                              MAP_HEIGHT,
+                              message_log=message_log,
+                              chunked=chunked_world,
+                              world_width=WORLD_WIDTH,
+                              world_height=WORLD_HEIGHT)
+        recorder = Recorder(record_file,
+                            session.seed,
+                            MAP_WIDTH,
+                            MAP_HEIGHT,
+                            chunked_world)
+
+    # Rendering and sounds follow the turns of the session
+    renderer = SessionRenderer(session,
+                               SCREEN_WIDTH,
+                               SCREEN_HEIGHT,
+                               BAR_WIDTH,
+                               PANEL_HEIGHT,
+                               colors,
+                               MINIMAP_WIDTH,
+                               MINIMAP_HEIGHT)
+    session.observers.append(renderer)
+    if sounds:
+        session.observers.append(sounds.observe)
+        sounds.play_music(sound_file("theme.wav"), volume=0.5)
+
+    if profile_file:
+        profiler.open(profile_file)
+
     # Holding keyboard and mouse input
     key = libtcod.Key()
     mouse = libtcod.Mouse()
 
-    # Game state init
-    game_state = GameStates.PLAYER_TURN
-
-    pygame.mixer.music.play(-1)
+    frames = 0
+    start = time.perf_counter()
 
     # Main game Loop
     while not libtcod.console_is_window_closed():
-        # Capture new events
-        libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS | libtcod.EVENT_MOUSE,
-                                    key,
-                                    mouse)
-
-        # Recompute fov if needed
-        if fov_recompute:
-            recompute_fov(fov_map,
-                          player.x,
-                          player.y,
-                          fov_radius_change,
-                          FOV_LIGHT_WALLS,
-                          FOV_ALGORITHM)
-            recompute_fov(fov_monster_map,
-                          player.x,
-                          player.y,
-                          FOV_MONSTER_RADIUS,
-                          FOV_LIGHT_WALLS,
-                          FOV_ALGORITHM)
+        if records is not None:
+            # Next frame of the replay, no waiting for input
+            record = next(records, None)
+            if record is None:
+                break
+            action, mouse.cx, mouse.cy = record
+        else:
+            # Capture new events
+            libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS | libtcod.EVENT_MOUSE,
+                                        key,
+                                        mouse)
 
         # Render all
-        render_all(con,
-                   panel,
-                   entities,
-                   player,
-                   game_map,
-                   fov_map,
-                   fov_recompute,
-                   message_log,
-                   SCREEN_WIDTH,
-                   SCREEN_HEIGHT,
-                   BAR_WIDTH,
-                   PANEL_HEIGHT,
-                   PANEL_Y,
-                   mouse,
-                   colors)
-
-        fov_recompute = False
+        renderer.draw(mouse)
 
         # Present everything on the screen
+        start_flush = profiler.begin()
         libtcod.console_flush()
+        profiler.end("flush", start_flush)
+        frames += 1
 
-        # Clear entities (to avoid trailing traces)
-        clear_all(con, entities)
+        renderer.clear()
 
         # Manage events
-        action = handle_keys(key)
+        if records is None:
+            action = handle_keys(key)
+            if recorder:
+                recorder.record(action, mouse)
 
-        move = action.get("move")
-        pickup = action.get("pickup")
         exit = action.get("exit")
         fullscreen = action.get("fullscreen")
+        show_minimap = action.get("minimap")
+        show_profiler = action.get("profiler")
 
-        player_turn_results = []
-
-        if move and game_state == GameStates.PLAYER_TURN:
-            dx, dy = move
-            destination_x = player.x + dx
-            destination_y = player.y + dy
-
-            if not game_map.is_blocked(destination_x, destination_y):
-                target = get_blocking_entities_at_location(entities,
-                                                           destination_x,
-                                                           destination_y)
-
-                if target:
-                    attack_results = player.fighter.attack(target, sound_nightmare)
-                    player_turn_results.extend(attack_results)
-                else:
-                    player.move(dx, dy)
-                    sound_steps.play()
-                    fov_recompute = True
-                    # FOV radius decrease every 4 moves
-                    count += 1
-                    if count >= 8:
-                        count = 0
-                        fov_radius_change -= 1
-                    if fov_radius_change <= 3:
-                        fov_radius_change = 3
-
-                game_state = GameStates.ENEMY_TURN
-
-        elif pickup and game_state == GameStates.PLAYER_TURN:
-            for entity in entities:
-                if entity.item and entity.x == player.x and entity.y == player.y:
-                    message, fov_radius_change = use_item(entity,
-                                                          player,
-                                                          fov_radius_change,
-                                                          FOV_RADIUS,
-                                                          sound_holala)
-                    message_log.add_message(message)
+        if exit and records is not None:
+            # The replay goes on with the resumed session
+            if not isinstance(session.game_map, ChunkedGameMap):
+                session.reload()
+            continue
 
         if exit:
-            pygame.mixer.music.stop()
+            if sounds:
+                sounds.stop_music()
+            if recorder:
+                recorder.close()
+            profiler.close()
+            if chunked_world:
+                session.close()
+            elif session.game_state == GameStates.PLAYER_DEAD:
+                # Selen woke up, the next session is a new night
+                if os.path.exists(SAVE_FILE):
+                    os.remove(SAVE_FILE)
+            else:
+                session.save(SAVE_FILE)
             return True
 
-        if fullscreen:
+        if fullscreen and records is None:
             libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen)
+            renderer.dirty.add_everything()
 
-        for player_turn_result in player_turn_results:
-            message = player_turn_result.get("message")
-            dead_entity = player_turn_result.get("dead")
+        if show_minimap:
+            renderer.toggle_minimap()
 
-            if message:
-                message_log.add_message(message)
+        if show_profiler:
+            renderer.toggle_profiler()
 
-            if dead_entity:
-                if dead_entity == player:
-                    message, game_state = kill_player(dead_entity)
-                else:
-                    message = kill_monster(dead_entity)
-                message_log.add_message(message)
+        # Play the turn
+        session.step(action)
 
-        if game_state == GameStates.ENEMY_TURN:
-            for entity in entities:
-                if entity.ai:
-                    enemy_turn_results = entity.ai.take_turn(player,
-                                                             fov_monster_map,
-                                                             game_map,
-                                                             entities,
-                                                             sound_hurt)
-                    for enemy_turn_result in enemy_turn_results:
-                        message = enemy_turn_result.get("message")
-                        dead_entity = enemy_turn_result.get("dead")
-
-                        if message:
-                            message_log.add_message(message)
-
-                        if dead_entity:
-                            if dead_entity == player:
-                                message, game_state = kill_player(dead_entity)
-                            else:
-                                message = kill_monster(dead_entity)
-                            message_log.add_message(message)
-                            if game_state == GameStates.PLAYER_DEAD:
-                                break
-                    if game_state == GameStates.PLAYER_DEAD:
-                        break
-            else:
-                game_state = GameStates.PLAYER_TURN
+        profiler.end_frame()
+
+    profiler.close()
+    if records is not None:
+        session.close()
+        elapsed = time.perf_counter() - start
+        print(f"{frames} frames in {elapsed:.3f} s, "
+              f"{1000 * elapsed / max(frames, 1):.3f} ms per frame")
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Selen dans les limbes")
+    parser.add_argument("--record", default="session.rec",
+                        help="file recording the session")
+    parser.add_argument("--replay",
+                        help="replay a recording as fast as possible")
+    parser.add_argument("--headless", action="store_true",
+                        help="replay without window")
+    parser.add_argument("--profile",
+                        help="write the frame times to a .csv or .jsonl file")
+    parser.add_argument("--pathfinder", choices=sorted(PATHFINDERS),
+                        default="astar",
+                        help="engine of the monsters' pathfinding, the "
+                        "recordings keep theirs for the replays and the "
+                        "resumed sessions")
+    parser.add_argument("--chunked-world", action="store_true",
+                        help="play a new game on a large world generated "
+                        "around the player, not saved when quitting")
+    parser.add_argument("--flow-fields", action="store_true",
+                        help="make the monsters chase along shared flow "
+                        "fields, kept by the recordings like the "
+                        "pathfinder")
+    args = parser.parse_args()
+    use_pathfinder(args.pathfinder)
+    use_flow_fields(args.flow_fields)
+
+    if args.replay and args.headless:
+        session, elapsed = replay_headless(args.replay)
+        print(f"Replayed in {elapsed:.3f} s, player at "
+              f"({session.player.x}, {session.player.y}) "
+              f"with {session.player.fighter.hp} hp")
+        print(f"Pathfinding: {path_stats.stats()}")
+    else:
+        main(args.record, args.replay, args.profile, args.chunked_world)
@@ -29,8 +29,11 @@
 from __future__ import print_function
 import os
 import sys
+import math
+import array
 import ctypes
 import struct
+import tempfile
 from ctypes import *
 
 # We do not have a fully unicode API on libtcod, so all unicode strings have to
@@ -69,13 +72,119 @@ MAC=False
 MINGW=False
 MSVC=False
 
+class _LazyFunction(object):
+    '''
+        stands for a library function until its first call: restype,
+        argtypes and errcheck set on it are recorded and only applied to
+        the real ctypes function when it is looked up in the library
+    '''
+    def __init__(self, lib, name):
+        self._lazy_lib = lib
+        self._lazy_name = name
+
+    def _bind(self):
+        func = self._lazy_lib._resolve(self._lazy_name)
+        for attr in ('restype', 'argtypes', 'errcheck'):
+            if attr in self.__dict__:
+                setattr(func, attr, self.__dict__[attr])
+        # from now on _lib.name is the ctypes function itself
+        setattr(self._lazy_lib, self._lazy_name, func)
+        return func
+
+    def __call__(self, *args):
+        return self._bind()(*args)
+
+class _LazyLibrary(object):
+    '''
+        wraps the ctypes lib object so that declaring the prototype of a
+        function costs nothing until the function is actually used
+
+        returns a _LazyFunction for any function not used yet
+    '''
+    def __init__(self, cdll):
+        self._cdll = cdll
+        self._aliases = {}
+
+    def alias(self, name, target):
+        # calls to name go to the target function of the library
+        self._aliases[name] = target
+
+    def _resolve(self, name):
+        return getattr(self._cdll, self._aliases.get(name, name))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        func = _LazyFunction(self, name)
+        setattr(self, name, func)
+        return func
+
+def _lib_cache_file():
+    cacheDir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cacheDir, "libtcodpy", "libpaths")
+
+def _lib_cache_key(libname):
+    # the same package used from another interpreter may need another
+    # library, and the search also depends on the script directory (or the
+    # current one) and on LIBTCOD_DLL_PATH
+    scriptPath = os.path.dirname(sys.argv[0]) or os.getcwd()
+    return "%s|%d.%d|%s|%s|%s|%s" % (sys.executable, sys.version_info[0], sys.version_info[1], __path__[0],
+                                     os.path.abspath(scriptPath), os.environ.get("LIBTCOD_DLL_PATH", ""), libname)
+
+def _read_lib_cache():
+    cache = {}
+    try:
+        with open(_lib_cache_file()) as f:
+            for line in f:
+                key, sep, libPath = line.rstrip("\n").partition("\t")
+                if sep:
+                    cache[key] = libPath
+    except (IOError, OSError):
+        pass
+    return cache
+
+def _write_lib_cache(key, libPath):
+    cache = _read_lib_cache()
+    cache[key] = libPath
+    cacheFile = _lib_cache_file()
+    try:
+        if not os.path.isdir(os.path.dirname(cacheFile)):
+            os.makedirs(os.path.dirname(cacheFile))
+        # written aside then renamed, so that another process never reads
+        # a half written file
+        fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(cacheFile))
+        try:
+            with os.fdopen(fd, "w") as f:
+                for key in sorted(cache):
+                    f.write("%s\t%s\n" % (key, cache[key]))
+            os.replace(tempPath, cacheFile)
+        except BaseException:
+            os.remove(tempPath)
+            raise
+    except (IOError, OSError):
+        # the cache is only an optimization
+        pass
+
 def _get_cdll(libname):
     '''
         get the library libname using a manual search path that will first
         check the package directory and then the development path
 
+        the environment variable LIBTCOD_LIBRARY, when set, is the path of
+        the library to load and skips the search. Otherwise the path found
+        by the search is cached in ~/.cache/libtcodpy, per interpreter and
+        search directories, and reused as long as the file exists
+
         returns the ctypes lib object
     '''
+    if os.environ.get("LIBTCOD_LIBRARY"):
+        return ctypes.cdll[os.environ["LIBTCOD_LIBRARY"]]
+
+    cacheKey = _lib_cache_key(libname)
+    cachedPath = _read_lib_cache().get(cacheKey)
+    if cachedPath is not None and os.path.exists(cachedPath):
+        return ctypes.cdll[cachedPath]
+
     def get_pe_architecture(filePath):
         # From: https://github.com/tgandor/meats/blob/master/missing/arch_of.py
         with open(filePath, 'rb') as f:
@@ -99,8 +208,12 @@ def _get_cdll(libname):
                 return 'x64'
             return 'unknown'
 
-    pythonExePath = sys.executable
-    pythonExeArchitecture = get_pe_architecture(pythonExePath)
+    # Only Windows DLLs are PE files, ELF and Mach-O libraries can not be
+    # checked this way
+    checkArchitecture = libname.endswith('.dll')
+    if checkArchitecture:
+        pythonExePath = sys.executable
+        pythonExeArchitecture = get_pe_architecture(pythonExePath)
 
     pathsToTry = []
     # 1. Try the directory this script is located in.
@@ -127,27 +240,30 @@ def _get_cdll(libname):
     for libPath in pathsToTry:
         if os.path.exists(libPath):
             # get library from the package
-            libArchitecture = get_pe_architecture(libPath)
-            if libArchitecture != pythonExeArchitecture:
-                libName = os.path.basename(libPath)
-                print ("Error: Incompatible architecture, python is %s, %s is %s" % (pythonExeArchitecture, libName, libArchitecture))
-                sys.exit(1)
+            if checkArchitecture:
+                libArchitecture = get_pe_architecture(libPath)
+                if libArchitecture != pythonExeArchitecture:
+                    libName = os.path.basename(libPath)
+                    print ("Error: Incompatible architecture, python is %s, %s is %s" % (pythonExeArchitecture, libName, libArchitecture))
+                    sys.exit(1)
+            libPath = os.path.abspath(libPath)
+            _write_lib_cache(cacheKey, libPath)
             return ctypes.cdll[libPath]
 
     raise Exception("unable to locate: "+ libname)
 
 if sys.platform.find('linux') != -1:
-    _lib = _get_cdll('libtcod.so')
+    _lib = _LazyLibrary(_get_cdll('libtcod.so'))
     LINUX=True
 elif sys.platform.find('darwin') != -1:
-    _lib = _get_cdll('libtcod.dylib')
+    _lib = _LazyLibrary(_get_cdll('libtcod.dylib'))
     MAC = True
 elif sys.platform.find('haiku') != -1:
-    _lib = _get_cdll('libtcod.so')
+    _lib = _LazyLibrary(_get_cdll('libtcod.so'))
     HAIKU = True
 else:
     _get_cdll('SDL2.dll')
-    _lib = _get_cdll('libtcod.dll')
+    _lib = _LazyLibrary(_get_cdll('libtcod.dll'))
     MSVC=True
     # On Windows, ctypes doesn't work well with function returning structs,
     # so we have to user the _wrapper functions instead
@@ -182,9 +298,9 @@ else:
         "TCOD_parser_get_color_property",
         "TCOD_console_set_key_color",
     ]:
-        wrapper_func = getattr(_lib, function_name +"_wrapper", None)
+        wrapper_func = getattr(_lib._cdll, function_name +"_wrapper", None)
         if wrapper_func is not None:
-            setattr(_lib, function_name, wrapper_func)
+            _lib.alias(function_name, function_name +"_wrapper")
         else:
             raise Exception("unable to find wrapper", function_name)
 
@@ -203,20 +319,39 @@ class Color(Structure):
                 ('b', c_uint8),
                 ]
 
+    # The arithmetic is done in Python with the same clamping as the
+    # TCOD_color_* functions, which saves a foreign call per operation.
+
     def __eq__(self, c):
-        return _lib.TCOD_color_equals(self, c)
+        if not isinstance(c, Color):
+            return NotImplemented
+        return self.r == c.r and self.g == c.g and self.b == c.b
+
+    def __ne__(self, c):
+        if not isinstance(c, Color):
+            return NotImplemented
+        return not (self.r == c.r and self.g == c.g and self.b == c.b)
 
     def __mul__(self, c):
         if isinstance(c,Color):
-            return _lib.TCOD_color_multiply(self, c)
+            return Color(self.r * c.r // 255,
+                         self.g * c.g // 255,
+                         self.b * c.b // 255)
         else:
-            return _lib.TCOD_color_multiply_scalar(self, c_float(c))
+            c = _float32(c)
+            return Color(_clamp_channel(int(self.r * c)),
+                         _clamp_channel(int(self.g * c)),
+                         _clamp_channel(int(self.b * c)))
 
     def __add__(self, c):
-        return _lib.TCOD_color_add(self, c)
+        return Color(min(255, self.r + c.r),
+                     min(255, self.g + c.g),
+                     min(255, self.b + c.b))
 
     def __sub__(self, c):
-        return _lib.TCOD_color_subtract(self, c)
+        return Color(max(0, self.r - c.r),
+                     max(0, self.g - c.g),
+                     max(0, self.b - c.b))
 
     def __repr__(self):
         return "Color(%d,%d,%d)" % (self.r, self.g, self.b)
@@ -238,20 +373,16 @@ class Color(Structure):
         yield self.g
         yield self.b
 
-_lib.TCOD_color_equals.restype=c_bool
-_lib.TCOD_color_equals.argtypes=[Color, Color]
+def _float32(f):
+    # the libtcod color functions take their coefficients as C floats
+    return c_float(f).value
 
-_lib.TCOD_color_add.restype=Color
-_lib.TCOD_color_add.argtypes=[Color, Color]
-
-_lib.TCOD_color_subtract.restype=Color
-_lib.TCOD_color_subtract.argtypes=[Color, Color]
-
-_lib.TCOD_color_multiply.restype=Color
-_lib.TCOD_color_multiply.argtypes=[Color , Color ]
-
-_lib.TCOD_color_multiply_scalar.restype=Color
-_lib.TCOD_color_multiply_scalar.argtypes=[Color , c_float ]
+def _clamp_channel(v):
+    if v < 0:
+        return 0
+    if v > 255:
+        return 255
+    return v
 
 # Should be valid on any platform, check it!  Has to be done after Color is defined.
 # NOTE(rmtew): This should ideally be deleted.  Most of it is moved or duplicated here.
@@ -483,28 +614,79 @@ celadon=Color(172,255,175)
 peach=Color(255,159,127)
 
 # color functions
-_lib.TCOD_color_lerp.restype = Color
 def color_lerp(c1, c2, a):
-    return _lib.TCOD_color_lerp(c1, c2, c_float(a))
+    a = _float32(a)
+    return Color(int(c1.r + (c2.r - c1.r) * a),
+                 int(c1.g + (c2.g - c1.g) * a),
+                 int(c1.b + (c2.b - c1.b) * a))
+
+def color_lerp_array(c1, c2, a):
+    '''
+        color_lerp over a sequence of coefficients, for gradients
+
+        returns the r, g and b channels ready for console_fill_foreground
+        and console_fill_background: int32 NumPy arrays with the shape of a
+        when NumPy is available, lists otherwise
+    '''
+    if numpy_available:
+        a = numpy.asarray(a, dtype=numpy.float32)
+        return tuple((c1[i] + (c2[i] - c1[i]) * a).astype(numpy.int32)
+                     for i in range(3))
+    a = [_float32(f) for f in a]
+    return tuple([int(c1[i] + (c2[i] - c1[i]) * f) for f in a]
+                 for i in range(3))
 
-_lib.TCOD_color_set_HSV.restype=c_void
-_lib.TCOD_color_set_HSV.argtypes=[POINTER(Color),c_float , c_float , c_float ]
 def color_set_hsv(c, h, s, v):
-    _lib.TCOD_color_set_HSV(byref(c), c_float(h), c_float(s), c_float(v))
+    s = min(1.0, max(0.0, s))
+    v = min(1.0, max(0.0, v))
+    if s == 0.0:
+        # achromatic (grey)
+        c.r = c.g = c.b = int(v * 255.0 + 0.5)
+        return
+    h = (h % 360.0) / 60.0
+    i = int(math.floor(h))
+    f = h - i
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    if i == 0:
+        r, g, b = v, t, p
+    elif i == 1:
+        r, g, b = q, v, p
+    elif i == 2:
+        r, g, b = p, v, t
+    elif i == 3:
+        r, g, b = p, q, v
+    elif i == 4:
+        r, g, b = t, p, v
+    else:
+        r, g, b = v, p, q
+    c.r = int(r * 255.0 + 0.5)
+    c.g = int(g * 255.0 + 0.5)
+    c.b = int(b * 255.0 + 0.5)
 
-_lib.TCOD_color_get_HSV.restype=c_void
-_lib.TCOD_color_get_HSV.argtypes=[Color ,POINTER(c_float) , POINTER(c_float) , POINTER(c_float) ]
 def color_get_hsv(c):
-    h = c_float()
-    s = c_float()
-    v = c_float()
-    _lib.TCOD_color_get_HSV(c, byref(h), byref(s), byref(v))
-    return h.value, s.value, v.value
-
-_lib.TCOD_color_scale_HSV.restype=c_void
-_lib.TCOD_color_scale_HSV.argtypes=[POINTER(Color), c_float , c_float ]
+    imax = max(c.r, c.g, c.b)
+    imin = min(c.r, c.g, c.b)
+    v = imax / 255.0
+    if imax == imin:
+        return 0.0, 0.0, v
+    delta = float(imax - imin)
+    s = delta / imax
+    if c.r == imax:
+        h = (c.g - c.b) / delta
+    elif c.g == imax:
+        h = 2.0 + (c.b - c.r) / delta
+    else:
+        h = 4.0 + (c.r - c.g) / delta
+    h *= 60.0
+    if h < 0.0:
+        h += 360.0
+    return h, s, v
+
 def color_scale_HSV(c, scoef, vcoef) :
-    _lib.TCOD_color_scale_HSV(byref(c),c_float(scoef),c_float(vcoef))
+    h, s, v = color_get_hsv(c)
+    color_set_hsv(c, h, min(1.0, max(0.0, s * scoef)), min(1.0, max(0.0, v * vcoef)))
 
 _lib.TCOD_color_gen_map.restype=c_void
 _lib.TCOD_color_gen_map.argtypes=[POINTER(Color), c_int, POINTER(Color), POINTER(c_int)]
@@ -535,6 +717,8 @@ class Key(Structure):
 class ConsoleBuffer:
     # simple console that allows direct (fast) access to cells. simplifies
     # use of the "fill" functions.
+    # each plane is an array of C ints, handed to the "fill" functions by
+    # pointer without any conversion.
     def __init__(self, width, height, back_r=0, back_g=0, back_b=0, fore_r=0, fore_g=0, fore_b=0, char=' '):
         # initialize with given width and height. values to fill the buffer
         # are optional, defaults to black with no characters.
@@ -547,26 +731,26 @@ class ConsoleBuffer:
         # clears the console. values to fill it with are optional, defaults
         # to black with no characters.
         n = self.width * self.height
-        self.back_r = [back_r] * n
-        self.back_g = [back_g] * n
-        self.back_b = [back_b] * n
-        self.fore_r = [fore_r] * n
-        self.fore_g = [fore_g] * n
-        self.fore_b = [fore_b] * n
-        self.char = [ord(char)] * n
+        self.back_r = array.array('i', [back_r]) * n
+        self.back_g = array.array('i', [back_g]) * n
+        self.back_b = array.array('i', [back_b]) * n
+        self.fore_r = array.array('i', [fore_r]) * n
+        self.fore_g = array.array('i', [fore_g]) * n
+        self.fore_b = array.array('i', [fore_b]) * n
+        self.char = array.array('i', [ord(char)]) * n
 
     def copy(self):
         # returns a copy of this ConsoleBuffer.
         other = ConsoleBuffer(0, 0)
         other.width = self.width
         other.height = self.height
-        other.back_r = list(self.back_r)  # make explicit copies of all lists
-        other.back_g = list(self.back_g)
-        other.back_b = list(self.back_b)
-        other.fore_r = list(self.fore_r)
-        other.fore_g = list(self.fore_g)
-        other.fore_b = list(self.fore_b)
-        other.char = list(self.char)
+        other.back_r = self.back_r[:]  # slicing an array copies it in one go
+        other.back_g = self.back_g[:]
+        other.back_b = self.back_b[:]
+        other.fore_r = self.fore_r[:]
+        other.fore_g = self.fore_g[:]
+        other.fore_b = self.fore_b[:]
+        other.char = self.char[:]
         return other
 
     def set_fore(self, x, y, r, g, b, char):
@@ -595,20 +779,71 @@ class ConsoleBuffer:
         self.fore_b[i] = int(fore_b)
         self.char[i] = ord(char)
 
+    def _fill_rect(self, planes, values, x, y, w, h):
+        # write one value per plane in a rectangle, clipped to the buffer.
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, self.width), min(y + h, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        for plane, value in zip(planes, values):
+            row = array.array('i', [int(value)]) * (x1 - x0)
+            for j in range(y0, y1):
+                i = self.width * j + x0
+                plane[i:i + x1 - x0] = row
+
+    def _fill_mask(self, planes, values, mask):
+        # write one value per plane in every cell where mask is true. mask
+        # holds one entry per cell, in the same order as the planes, a 2-D
+        # numpy mask is read row after row.
+        if numpy_available:
+            mask = numpy.asarray(mask, dtype=bool).ravel()
+        if len(mask) != self.width * self.height:
+            raise ValueError('ConsoleBuffer: the mask must have one value per cell.')
+        if numpy_available:
+            for plane, value in zip(planes, values):
+                numpy.frombuffer(plane, dtype=numpy.intc)[mask] = int(value)
+        else:
+            cells = [i for i, m in enumerate(mask) if m]
+            for plane, value in zip(planes, values):
+                value = int(value)
+                for i in cells:
+                    plane[i] = value
+
+    def set_fore_rect(self, x, y, w, h, r, g, b, char):
+        # set the character and foreground color of a rectangle of cells.
+        self._fill_rect((self.fore_r, self.fore_g, self.fore_b, self.char),
+                        (r, g, b, ord(char)), x, y, w, h)
+
+    def set_back_rect(self, x, y, w, h, r, g, b):
+        # set the background color of a rectangle of cells.
+        self._fill_rect((self.back_r, self.back_g, self.back_b),
+                        (r, g, b), x, y, w, h)
+
+    def set_fore_mask(self, mask, r, g, b, char):
+        # set the character and foreground color of the cells in mask.
+        self._fill_mask((self.fore_r, self.fore_g, self.fore_b, self.char),
+                        (r, g, b, ord(char)), mask)
+
+    def set_back_mask(self, mask, r, g, b):
+        # set the background color of the cells in mask.
+        self._fill_mask((self.back_r, self.back_g, self.back_b),
+                        (r, g, b), mask)
+
     def blit(self, dest, fill_fore=True, fill_back=True):
         # use libtcod's "fill" functions to write the buffer to a console.
         if (console_get_width(dest) != self.width or
             console_get_height(dest) != self.height):
             raise ValueError('ConsoleBuffer.blit: Destination console has an incorrect size.')
 
-        s = struct.Struct('%di' % len(self.back_r))
+        # ctypes views sharing the memory of the planes, nothing is copied
+        c_plane = c_int * (self.width * self.height)
 
         if fill_back:
-            _lib.TCOD_console_fill_background(c_void_p(dest), (c_int * len(self.back_r))(*self.back_r), (c_int * len(self.back_g))(*self.back_g), (c_int * len(self.back_b))(*self.back_b))
+            _lib.TCOD_console_fill_background(c_void_p(dest), c_plane.from_buffer(self.back_r), c_plane.from_buffer(self.back_g), c_plane.from_buffer(self.back_b))
 
         if fill_fore:
-            _lib.TCOD_console_fill_foreground(c_void_p(dest), (c_int * len(self.fore_r))(*self.fore_r), (c_int * len(self.fore_g))(*self.fore_g), (c_int * len(self.fore_b))(*self.fore_b))
-            _lib.TCOD_console_fill_char(c_void_p(dest), (c_int * len(self.char))(*self.char))
+            _lib.TCOD_console_fill_foreground(c_void_p(dest), c_plane.from_buffer(self.fore_r), c_plane.from_buffer(self.fore_g), c_plane.from_buffer(self.fore_b))
+            _lib.TCOD_console_fill_char(c_void_p(dest), c_plane.from_buffer(self.char))
 
 _lib.TCOD_console_is_fullscreen.restype = c_bool
 _lib.TCOD_console_is_window_closed.restype = c_bool
@@ -835,6 +1070,7 @@ CENTER=2
 _lib.TCOD_console_init_root.restype=c_void
 _lib.TCOD_console_init_root.argtypes=[c_int, c_int, c_char_p , c_bool , c_uint ]
 def console_init_root(w, h, title, fullscreen=False, renderer=RENDERER_SDL):
+    _forget_console_size(0)
     _lib.TCOD_console_init_root(w, h, convert_to_ascii(title), fullscreen, renderer)
 
 _lib.TCOD_console_set_custom_font.restype=c_void
@@ -1156,29 +1392,67 @@ def console_set_dirty(x, y, w, h):
 
 _lib.TCOD_console_delete.argtypes=[c_void_p ]
 def console_delete(con):
+    _forget_console_size(con)
     _lib.TCOD_console_delete(con)
 
 # fast color filling
+# the fill functions read one C int per cell of the console. The number of
+# cells of each console is looked up once, and lists and other sequences are
+# copied into C int buffers kept from one call to the next.
+_console_sizes = {}
+_fill_buffers = {}
+
+def _console_size(con):
+    size = _console_sizes.get(con)
+    if size is None:
+        size = console_get_width(con) * console_get_height(con)
+        _console_sizes[con] = size
+    return size
+
+def _forget_console_size(con):
+    # to call whenever a console is deleted or may change size
+    _console_sizes.pop(con, None)
+
+def _fill_array(values, slot):
+    # returns values as a ctypes array of C ints, sharing its memory when
+    # values already holds contiguous C ints (array.array('i'), NumPy
+    # arrays, memoryviews...), using the scratch buffer of this argument
+    # slot otherwise
+    if numpy_available and isinstance(values, numpy.ndarray):
+        values = numpy.ascontiguousarray(values, dtype=numpy.intc).reshape(-1)
+        if not values.flags.writeable:
+            values = values.copy()
+        return (c_int * values.size).from_buffer(values)
+
+    try:
+        view = memoryview(values)
+    except TypeError:
+        view = None
+    if (view is not None and not view.readonly and view.c_contiguous and
+        view.format.lstrip('@') in ('i', 'l') and view.itemsize == sizeof(c_int)):
+        return (c_int * (view.nbytes // view.itemsize)).from_buffer(view)
+
+    n = len(values)
+    buf = _fill_buffers.get((slot, n))
+    if buf is None:
+        buf = (c_int * n)()
+        _fill_buffers[(slot, n)] = buf
+    buf[:] = values
+    return buf
+
+def _check_fill_size(con, n):
+    if n != _console_size(con):
+        raise ValueError('The arrays must have one value per cell of the console.')
+
 _lib.TCOD_console_fill_foreground.restype=c_void
 _lib.TCOD_console_fill_foreground.argtypes=[c_void_p , POINTER(c_int), POINTER(c_int), POINTER(c_int)]
 def console_fill_foreground(con,r,g,b) :
-    if len(r) != len(g) or len(r) != len(b):
+    cr = _fill_array(r, 0)
+    cg = _fill_array(g, 1)
+    cb = _fill_array(b, 2)
+    if len(cr) != len(cg) or len(cr) != len(cb):
         raise TypeError('R, G and B must all have the same size.')
-
-    if (numpy_available and isinstance(r, numpy.ndarray) and
-        isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
-        #numpy arrays, use numpy's ctypes functions
-        r = numpy.ascontiguousarray(r, dtype=numpy.int32)
-        g = numpy.ascontiguousarray(g, dtype=numpy.int32)
-        b = numpy.ascontiguousarray(b, dtype=numpy.int32)
-        cr = r.ctypes.data_as(POINTER(c_int))
-        cg = g.ctypes.data_as(POINTER(c_int))
-        cb = b.ctypes.data_as(POINTER(c_int))
-    else:
-        # otherwise convert using ctypes arrays
-        cr = (c_int * len(r))(*r)
-        cg = (c_int * len(g))(*g)
-        cb = (c_int * len(b))(*b)
+    _check_fill_size(con, len(cr))
 
     _lib.TCOD_console_fill_foreground(c_void_p(con), cr, cg, cb)
 
@@ -1186,23 +1460,12 @@ _lib.TCOD_console_fill_background.restype=c_void
 _lib.TCOD_console_fill_background.argtypes=[c_void_p , POINTER(c_int), POINTER(c_int), POINTER(c_int)]
 
 def console_fill_background(con,r,g,b) :
-    if len(r) != len(g) or len(r) != len(b):
+    cr = _fill_array(r, 0)
+    cg = _fill_array(g, 1)
+    cb = _fill_array(b, 2)
+    if len(cr) != len(cg) or len(cr) != len(cb):
         raise TypeError('R, G and B must all have the same size.')
-
-    if (numpy_available and isinstance(r, numpy.ndarray) and
-        isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
-        #numpy arrays, use numpy's ctypes functions
-        r = numpy.ascontiguousarray(r, dtype=numpy.int32)
-        g = numpy.ascontiguousarray(g, dtype=numpy.int32)
-        b = numpy.ascontiguousarray(b, dtype=numpy.int32)
-        cr = r.ctypes.data_as(POINTER(c_int))
-        cg = g.ctypes.data_as(POINTER(c_int))
-        cb = b.ctypes.data_as(POINTER(c_int))
-    else:
-        # otherwise convert using ctypes arrays
-        cr = (c_int * len(r))(*r)
-        cg = (c_int * len(g))(*g)
-        cb = (c_int * len(b))(*b)
+    _check_fill_size(con, len(cr))
 
     _lib.TCOD_console_fill_background(c_void_p(con), cr, cg, cb)
 
@@ -1210,18 +1473,15 @@ def console_fill_background(con,r,g,b) :
 _lib.TCOD_console_fill_char.restype=c_void
 _lib.TCOD_console_fill_char.argtypes=[c_void_p , POINTER(c_int)]
 def console_fill_char(con,arr) :
-    if (numpy_available and isinstance(arr, numpy.ndarray) ):
-        #numpy arrays, use numpy's ctypes functions
-        arr = numpy.ascontiguousarray(arr, dtype=numpy.int32)
-        carr = arr.ctypes.data_as(POINTER(c_int))
-    else:
-        carr = (c_int * len(arr))(*arr)
+    carr = _fill_array(arr, 0)
+    _check_fill_size(con, len(carr))
 
     _lib.TCOD_console_fill_char(c_void_p(con), carr)
 
 _lib.TCOD_console_load_asc.restype=c_bool
 _lib.TCOD_console_load_asc.argtypes=[c_void_p , c_char_p]
 def console_load_asc(con, filename) :
+    _forget_console_size(con)
     return _lib.TCOD_console_load_asc(con,convert_to_ascii(filename))
 
 _lib.TCOD_console_save_asc.restype=c_bool
@@ -1232,6 +1492,7 @@ def console_save_asc(con, filename) :
 _lib.TCOD_console_load_apf.restype=c_bool
 _lib.TCOD_console_load_apf.argtypes=[c_void_p , c_char_p]
 def console_load_apf(con, filename) :
+    _forget_console_size(con)
     return _lib.TCOD_console_load_apf(con,convert_to_ascii(filename))
 
 _lib.TCOD_console_save_apf.restype=c_bool
@@ -1247,6 +1508,7 @@ def console_from_xp(filename):
 _lib.TCOD_console_load_xp.restype = c_bool
 _lib.TCOD_console_load_xp.argtypes = [c_void_p, c_char_p]
 def console_load_xp(con, filename):
+    _forget_console_size(con)
     return _lib.TCOD_console_load_xp(con, filename.encode('utf-8'))
 
 _lib.TCOD_console_save_xp.restype = c_bool
@@ -2098,6 +2360,16 @@ _lib.TCOD_map_get_nb_cells.argtypes=[c_void_p ]
 def map_get_nb_cells(map):
     return TCOD_map_get_nb_cells(map)
 
+def map_get_fov_rect(m, x, y, w, h):
+    # fov flags of the cells of a rectangle, row after row, as bytes of 0 or
+    # 1. Only the public getter is used, called straight in one loop
+    is_in_fov = _lib.TCOD_map_is_in_fov
+    if isinstance(is_in_fov, _LazyFunction):
+        is_in_fov = is_in_fov._bind()
+    return bytes(bytearray([is_in_fov(m, cx, cy)
+                            for cy in range(y, y + h)
+                            for cx in range(x, x + w)]))
+
 ############################
 # pathfinding module
 ############################